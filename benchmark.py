@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""Headless benchmarks of the rendering, contouring and reprojection hot
+paths on synthetic meshes.
+
+Meshes are generated once per kind and size, each case then runs in its
+own process so that its peak memory is measured alone. Time, throughput
+and peak memory are written as JSON, with the git commit, so that runs
+on different commits can be compared:
+
+    python benchmark.py --sizes 10000,1000000 --output after.json
+    python benchmark.py --compare before.json after.json
+
+OpenGL and legend cases need a display, under xvfb-run with
+LIBGL_ALWAYS_SOFTWARE=1 they measure the software rasterizer.
+"""
+
+import numpy
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import traceback
+import subprocess
+import multiprocessing
+
+try:
+    from scipy.spatial import Delaunay
+except ImportError:
+    Delaunay = None
+
+# synthetic meshes cover a square of WIDTH meters from ORIGIN in SOURCE_CRS
+SOURCE_CRS = 'EPSG:2154'
+DEST_CRS = 'EPSG:3857'
+ORIGIN = (700000., 6600000.)
+WIDTH = 10000.
+
+IMAGE_SIZE = (1024, 768)
+
+# number of isovalues of the contour case
+NB_LEVELS = 10
+
+# number of points of the locate case
+NB_POINTS = 1000000
+
+def structuredMesh(nbTriangles):
+    """return (vtx, idx) of a square grid of about nbTriangles triangles,
+    each cell is split in two triangles"""
+    n = max(int(round(numpy.sqrt(nbTriangles/2.))), 1)
+    x = numpy.linspace(0, WIDTH, n + 1)
+    vtx = numpy.zeros(((n + 1)**2, 3))
+    vtx[:, 0] = ORIGIN[0] + numpy.tile(x, n + 1)
+    vtx[:, 1] = ORIGIN[1] + numpy.repeat(x, n + 1)
+    corner = (numpy.arange(n)[:, numpy.newaxis]*(n + 1)
+            + numpy.arange(n)[numpy.newaxis, :]).reshape((-1,))
+    idx = numpy.empty((2*len(corner), 3), dtype=numpy.int32)
+    idx[0::2] = numpy.column_stack((corner, corner + 1, corner + n + 2))
+    idx[1::2] = numpy.column_stack((corner, corner + n + 2, corner + n + 1))
+    return vtx, idx
+
+def delaunayMesh(nbTriangles, seed=0):
+    """return (vtx, idx) of the Delaunay triangulation of about nbTriangles
+    triangles of random nodes, scipy is needed"""
+    if Delaunay is None:
+        raise RuntimeError("scipy is needed for delaunay meshes")
+    xy = numpy.random.RandomState(seed).uniform(0, WIDTH, (nbTriangles//2 + 2, 2))
+    xy[:4] = ((0, 0), (WIDTH, 0), (WIDTH, WIDTH), (0, WIDTH))
+    vtx = numpy.zeros((len(xy), 3))
+    vtx[:, :2] = xy + ORIGIN
+    return vtx, numpy.require(Delaunay(xy).simplices, numpy.int32, 'C')
+
+MESHES = {'structured': structuredMesh, 'delaunay': delaunayMesh}
+
+def nodeValues(vtx, date):
+    """return float32 node values of a wave crossing the mesh with dates"""
+    x = (vtx[:, 0] - ORIGIN[0])/WIDTH
+    y = (vtx[:, 1] - ORIGIN[1])/WIDTH
+    return (1 + x + numpy.sin(2*numpy.pi*(3*x - .1*date))
+            *numpy.cos(4*numpy.pi*y)).astype(numpy.float32)
+
+def writeMesh(directory, vtx, idx, nbDates):
+    """save the mesh and its node and element values for nbDates dates
+    as .npy files in directory"""
+    numpy.save(os.path.join(directory, "nodeCoord.npy"), vtx)
+    numpy.save(os.path.join(directory, "triangles.npy"), idx)
+    nodes = numpy.lib.format.open_memmap(os.path.join(directory, "nodeValues.npy"),
+            'w+', numpy.float32, (nbDates, len(vtx)))
+    elements = numpy.lib.format.open_memmap(os.path.join(directory, "elementValues.npy"),
+            'w+', numpy.float32, (nbDates, len(idx)))
+    for date in range(nbDates):
+        nodes[date] = nodeValues(vtx, date)
+        elements[date] = nodes[date][idx].mean(axis=1)
+    del nodes, elements
+
+def loadMesh(directory):
+    """return a dictionary with the mesh saved by writeMesh, values are
+    memory mapped"""
+    return {'vtx': numpy.load(os.path.join(directory, "nodeCoord.npy")),
+            'idx': numpy.load(os.path.join(directory, "triangles.npy")),
+            'nodeValues': numpy.load(os.path.join(directory, "nodeValues.npy"), mmap_mode='r'),
+            'elementValues': numpy.load(os.path.join(directory, "elementValues.npy"), mmap_mode='r')}
+
+def _view(vtx, imageSize):
+    """return (center, mapUnitsPerPixel) of a view of the whole mesh"""
+    xmin, ymin = vtx[:, 0].min(), vtx[:, 1].min()
+    xmax, ymax = vtx[:, 0].max(), vtx[:, 1].max()
+    mupp = max((xmax - xmin)/imageSize[0], (ymax - ymin)/imageSize[1])
+    return (.5*(xmin + xmax), .5*(ymin + ymax)), (mupp, mupp)
+
+def _colorParameters():
+    """return colorize parameters of a blue to red ramp, without Qt"""
+    t = numpy.linspace(0, 1, 256)
+    return {'colorTable': numpy.column_stack((t, numpy.zeros_like(t), 1 - t, numpy.ones_like(t))),
+            'minValue': 0.,
+            'maxValue': 3.,
+            'logscale': False,
+            'transparency': 0.,
+            'graduated': False,
+            'graduation': []}
+
+def _application():
+    from PyQt4.QtGui import QApplication
+    return QApplication.instance() or QApplication(sys.argv)
+
+# Each case prepares its data from the mesh and returns (run, count, unit):
+# run() is the timed function and count the number of units it processes.
+
+def numpyRender(mesh, dates, perElement=False):
+    from numpymesh import rasterize, colorize
+    vtx, idx = mesh['vtx'], mesh['idx']
+    values = mesh['elementValues' if perElement else 'nodeValues']
+    center, mupp = _view(vtx, IMAGE_SIZE)
+    colorParameters = _colorParameters()
+    def run():
+        for date in range(dates):
+            colorize(rasterize(vtx, idx, values[date], IMAGE_SIZE, center, mupp,
+                perElement=perElement), colorParameters)
+    return run, dates*len(idx), "triangles"
+
+def numpyRenderElement(mesh, dates):
+    return numpyRender(mesh, dates, True)
+
+def glRender(mesh, dates, perElement=False):
+    from PyQt4.QtCore import QSize
+    from glmesh import GlMesh, ColorLegend
+    app = _application()
+    legend = ColorLegend()
+    legend.setMinValue(0.)
+    legend.setMaxValue(3.)
+    glMesh = GlMesh(mesh['vtx'], mesh['idx'], legend)
+    glMesh.setColorPerElement(perElement)
+    values = mesh['elementValues' if perElement else 'nodeValues']
+    center, mupp = _view(mesh['vtx'], IMAGE_SIZE)
+    size = QSize(*IMAGE_SIZE)
+    # the first frame creates the context, compiles and uploads
+    glMesh.array(numpy.asarray(values[0]), size, center, mupp)
+    def run():
+        frames = ((numpy.asarray(values[date]), size, center, mupp, 0) for date in range(dates))
+        for array in glMesh.arrays(frames):
+            pass
+        # keeps the application alive until the mesh is drawn
+        app.processEvents()
+    return run, dates*len(mesh['idx']), "triangles"
+
+def glRenderElement(mesh, dates):
+    return glRender(mesh, dates, True)
+
+def contour(mesh, dates):
+    from contour import MarchingTriangles
+    marching = MarchingTriangles(mesh['vtx'][:, :2], mesh['idx'])
+    levels = numpy.linspace(0, 3, NB_LEVELS + 2)[1:-1]
+    def run():
+        for date in range(dates):
+            marching.lines(mesh['nodeValues'][date], levels)
+    return run, dates*len(mesh['idx']), "triangles"
+
+def reprojection(mesh, dates):
+    from qgis.core import QgsApplication, QgsCoordinateReferenceSystem
+    from reprojection import transformCoordinates
+    app = QgsApplication([], False)
+    QgsApplication.setPrefixPath(os.environ.get('QGIS_PREFIX_PATH', '/usr'), True)
+    QgsApplication.initQgis()
+    sourceCrs = QgsCoordinateReferenceSystem(SOURCE_CRS)
+    destCrs = QgsCoordinateReferenceSystem(DEST_CRS)
+    def run():
+        transformCoordinates(mesh['vtx'], sourceCrs, destCrs)
+        # keeps the application alive until the transformation is done
+        app.processEvents()
+    return run, len(mesh['vtx']), "nodes"
+
+def locate(mesh, dates):
+    from spatialindex import TriangleGrid
+    grid = TriangleGrid(mesh['vtx'], mesh['idx'])
+    points = numpy.random.RandomState(0).uniform(0, WIDTH, (NB_POINTS, 2)) + ORIGIN
+    def run():
+        grid.locate(points)
+    return run, NB_POINTS, "points"
+
+def pointLocator(mesh, dates):
+    """locate with the finer grid of MeshLayer.valuesAt"""
+    from spatialindex import TriangleGrid
+    grid = TriangleGrid(mesh['vtx'], mesh['idx'], .5)
+    points = numpy.random.RandomState(0).uniform(0, WIDTH, (NB_POINTS, 2)) + ORIGIN
+    def run():
+        grid.locate(points)
+    return run, NB_POINTS, "points"
+
+def legend(mesh, dates):
+    from glmesh import ColorLegend
+    app = _application()
+    colorLegend = ColorLegend()
+    colorLegend.setTitle("benchmark")
+    colorLegend.setUnits("m")
+    def run():
+        for date in range(dates):
+            # a change of range makes the legend draw again
+            colorLegend.setMaxValue(3. + date)
+            colorLegend.image()
+        app.processEvents()
+    return run, dates, "images"
+
+CASES = [numpyRender, numpyRenderElement, glRender, glRenderElement, contour,
+        reprojection, locate, pointLocator, legend]
+
+def _peakMemory():
+    """return the peak resident memory of the process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return peak if sys.platform == 'darwin' else 1024*peak
+
+def _runCase(case, meshDirectory, dates, queue):
+    """run a case in a child process, put the result dictionary in queue"""
+    try:
+        mesh = loadMesh(meshDirectory)
+        loaded = _peakMemory()
+        start = time.time()
+        run, count, unit = case(mesh, dates)
+        setupSeconds = time.time() - start
+        start = time.time()
+        run()
+        seconds = time.time() - start
+        queue.put({'setupSeconds': setupSeconds,
+                   'seconds': seconds,
+                   'count': count,
+                   'unit': unit,
+                   'throughput': count/seconds if seconds else None,
+                   'meshMemory': loaded,
+                   'peakMemory': _peakMemory() - loaded})
+    except Exception:
+        queue.put({'error': traceback.format_exc().strip().split('\n')[-1]})
+
+def runCase(case, meshDirectory, dates, timeout=None):
+    """return the result dictionary of a case run in a child process,
+    with an 'error' if the case fails, crashes or times out"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_runCase, args=(case, meshDirectory, dates, queue))
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        return {'error': "timeout after %gs"%timeout}
+    try:
+        return queue.get(True, 1)
+    except Exception:
+        return {'error': "process exited with code %s"%process.exitcode}
+
+def gitCommit():
+    """return (commit, dirty) of the working tree, (None, None) outside git"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=directory)
+        status = subprocess.check_output(['git', 'status', '--porcelain', '-uno'], cwd=directory)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.decode().strip(), bool(status.strip())
+
+def benchmark(meshes, sizes, cases, dates, timeout=None, log=None):
+    """run the cases on each kind of mesh and size, return the results
+    as a dictionary that can be dumped as JSON"""
+    commit, dirty = gitCommit()
+    results = {'commit': commit,
+               'dirty': dirty,
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'numpy': numpy.__version__,
+               'platform': platform.platform(),
+               'cpus': multiprocessing.cpu_count(),
+               'softwareGl': os.environ.get('LIBGL_ALWAYS_SOFTWARE') == '1',
+               'imageSize': IMAGE_SIZE,
+               'dates': dates,
+               'results': []}
+    for kind in meshes:
+        for size in sizes:
+            directory = tempfile.mkdtemp(prefix="meshlayer_benchmark_")
+            try:
+                start = time.time()
+                try:
+                    vtx, idx = MESHES[kind](size)
+                except RuntimeError as e:
+                    if log:
+                        log("%s mesh skipped: %s"%(kind, e))
+                    break
+                writeMesh(directory, vtx, idx, dates)
+                nbNodes, nbTriangles = len(vtx), len(idx)
+                del vtx, idx
+                if log:
+                    log("%s mesh of %d triangles generated in %.1fs"%(
+                        kind, nbTriangles, time.time() - start))
+                for case in cases:
+                    result = {'case': case.__name__,
+                              'mesh': kind,
+                              'nodes': nbNodes,
+                              'triangles': nbTriangles}
+                    result.update(runCase(case, directory, dates, timeout))
+                    results['results'].append(result)
+                    if log:
+                        log(formatResult(result))
+            finally:
+                shutil.rmtree(directory)
+    return results
+
+def formatResult(result):
+    prefix = "%-20s %-10s %10d"%(result['case'], result['mesh'], result['triangles'])
+    if 'error' in result:
+        return prefix + "  " + result['error']
+    return prefix + "  %8.3fs %12.4g %s/s %8.1fMB"%(result['seconds'],
+            result['throughput'] or 0, result['unit'], result['peakMemory']/1e6)
+
+def compare(reference, results):
+    """return the lines of a comparison of the throughput and peak memory
+    of two results, ratios above 1 mean results are faster or bigger"""
+    key = lambda r: (r['case'], r['mesh'], r['triangles'])
+    before = dict((key(r), r) for r in reference['results'] if 'error' not in r)
+    lines = ["%s -> %s"%(reference.get('commit'), results.get('commit'))]
+    for r in results['results']:
+        ref = before.get(key(r))
+        if ref is None or 'error' in r:
+            continue
+        speedup = r['throughput']/ref['throughput'] if ref['throughput'] and r['throughput'] else 0
+        memory = float(r['peakMemory'])/ref['peakMemory'] if ref['peakMemory'] else 0
+        lines.append("%-20s %-10s %10d  speedup %6.2f  memory %6.2f"%(
+            r['case'], r['mesh'], r['triangles'], speedup, memory))
+    return lines
+
+def main(argv=None):
+    names = [case.__name__ for case in CASES]
+    parser = argparse.ArgumentParser(description="benchmark meshlayer hot paths on synthetic meshes")
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+            help="comma separated numbers of triangles, up to 10000000")
+    parser.add_argument('--meshes', default=','.join(sorted(MESHES)),
+            help="comma separated kinds of mesh among %s"%', '.join(sorted(MESHES)))
+    parser.add_argument('--cases', default=','.join(names),
+            help="comma separated cases among %s"%', '.join(names))
+    parser.add_argument('--dates', type=int, default=10,
+            help="number of dates of the values, rendered or contoured in turn")
+    parser.add_argument('--timeout', type=float, default=3600.,
+            help="maximum duration of a case in seconds")
+    parser.add_argument('--output', help="JSON file of the results, printed if not given")
+    parser.add_argument('--compare', nargs=2, metavar=('REFERENCE', 'RESULTS'),
+            help="compare two JSON files of results instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as reference:
+            with open(args.compare[1]) as results:
+                sys.stdout.write('\n'.join(compare(json.load(reference), json.load(results))) + '\n')
+        return 0
+
+    unknown = set(args.cases.split(',')) - set(names)
+    if unknown:
+        parser.error("unknown cases %s"%', '.join(sorted(unknown)))
+    cases = [CASES[names.index(name)] for name in args.cases.split(',')]
+    log = lambda msg: sys.stderr.write(msg + '\n')
+    results = benchmark(args.meshes.split(','), [int(s) for s in args.sizes.split(',')],
+            cases, args.dates, args.timeout, log)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        sys.stdout.write(json.dumps(results, indent=2) + '\n')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
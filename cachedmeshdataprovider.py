@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+from PyQt4.QtCore import *
+
+import threading
+from collections import OrderedDict
+
+from meshdataprovider import MeshDataProvider
+
+class CachedMeshDataProvider(MeshDataProvider):
+    """Wraps a MeshDataProvider to keep the values of recently used dates
+    in memory and to load the next dates in the playback direction in a
+    background thread.
+
+    setDate only emits dataChanged once the values of the requested date
+    are loaded, date() keeps returning the previous date until then.
+
+    To be restored from a project file, the wrapper must be registered
+    under its own key, e.g.:
+        MeshDataProviderRegistry.instance().addDataProviderType("wind_cached",
+            lambda uri: CachedMeshDataProvider(WindDataProvider(uri), "wind_cached"))
+    """
+
+    # default memory budget of the cache in bytes
+    MAX_BYTES = 512*1024*1024
+
+    # default number of dates loaded in advance
+    PREFETCH = 4
+
+    __loaded = pyqtSignal(int)
+
+    def __init__(self, provider, providerKey=None, maxBytes=MAX_BYTES, prefetch=PREFETCH):
+        MeshDataProvider.__init__(self, provider.dataSourceUri())
+        self.__provider = provider
+        self.__providerKey = providerKey
+        self.__maxBytes = maxBytes
+        self.__prefetch = prefetch
+        # guards access to the wrapped provider, which is not thread safe
+        self.__providerLock = threading.Lock()
+        # guards the cache and the queue of dates to load
+        self.__condition = threading.Condition()
+        self.__cache = OrderedDict()
+        self.__nbBytes = 0
+        self.__queue = []
+        self.__requested = None
+        self.__direction = 1
+        self.__stopped = False
+        self.__loaded.connect(self.__dateLoaded)
+        self.__provider.dataChanged.connect(self.__providerDataChanged)
+        self.__worker = threading.Thread(target=self.__work)
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def provider(self):
+        """return the wrapped provider"""
+        return self.__provider
+
+    def name(self):
+        return self.__providerKey or self.__provider.name()
+
+    def crs(self):
+        return self.__provider.crs()
+
+    def extent(self):
+        return self.__provider.extent()
+
+    def description(self):
+        return self.__provider.description()
+
+    def isValid(self):
+        return self.__provider.isValid()
+
+    def geometryKey(self):
+        return self.__provider.geometryKey()
+
+    def nodeCoord(self):
+        with self.__providerLock:
+            return self.__provider.nodeCoord()
+
+    def triangles(self):
+        with self.__providerLock:
+            return self.__provider.triangles()
+
+    def dates(self):
+        return self.__provider.dates()
+
+    def setDates(self, dates):
+        self.__provider.setDates(dates)
+
+    def valueAtElement(self):
+        return self.__provider.valueAtElement()
+
+    def setDate(self, didx):
+        """request a date, dataChanged is emitted when its values are loaded"""
+        if didx != self.date():
+            self.__direction = 1 if didx > self.date() else -1
+        with self.__condition:
+            self.__requested = didx
+            ready = didx in self.__cache
+            # the requested date is loaded first, then the next ones
+            nbDates = len(self.dates())
+            self.__queue = [d for d in range(didx, didx + self.__direction*(self.__prefetch + 1), self.__direction)
+                    if (0 <= d < nbDates or not nbDates) and d not in self.__cache]
+            self.__condition.notify()
+        if ready:
+            self.__dateLoaded(didx)
+
+    def __dateLoaded(self, didx):
+        if didx == self.__requested:
+            self.__requested = None
+            MeshDataProvider.setDate(self, didx)
+
+    def nodeValues(self):
+        return self.dateValues(self.date())
+
+    def elementValues(self):
+        return self.dateValues(self.date())
+
+    def dateValues(self, didx):
+        with self.__condition:
+            if didx in self.__cache:
+                self.__cache[didx] = self.__cache.pop(didx)
+                return self.__cache[didx]
+        return self.__load(didx)
+
+    def threadSafeDateValues(self):
+        # the wrapped provider is only used holding its lock
+        return True
+
+    def __load(self, didx):
+        with self.__providerLock:
+            values = self.__provider.dateValues(didx)
+        with self.__condition:
+            if didx not in self.__cache:
+                self.__cache[didx] = values
+                self.__nbBytes += values.nbytes
+                # the least recently used dates are evicted, not the last one
+                while self.__nbBytes > self.__maxBytes and len(self.__cache) > 1:
+                    self.__nbBytes -= self.__cache.popitem(last=False)[1].nbytes
+        return values
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                while not self.__queue and not self.__stopped:
+                    self.__condition.wait()
+                if self.__stopped:
+                    return
+                didx = self.__queue.pop(0)
+                if didx in self.__cache:
+                    continue
+            self.__load(didx)
+            # queued to the main thread
+            self.__loaded.emit(didx)
+
+    def stop(self):
+        """stop the background loading, the cache is still used"""
+        with self.__condition:
+            self.__stopped = True
+            self.__queue = []
+            self.__condition.notify()
+
+    def clearCache(self):
+        with self.__condition:
+            self.__cache.clear()
+            self.__nbBytes = 0
+
+    def __providerDataChanged(self):
+        self.clearCache()
+        self.dataChanged.emit()
+
+    def readXml(self, node):
+        if not self.__provider.readXml(node):
+            return False
+        return MeshDataProvider.readXml(self, node)
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+import struct
+
+from utilities import stitch
+
+def meshEdges(idx):
+    """return the unique edges of a triangulation as an (nbEdges, 2) array of
+    sorted node indices, and the (nbTriangles, 3) array of edge indices for
+    each triangle, edge i of a triangle joins its nodes i and (i+1)%3"""
+    idx = numpy.asarray(idx, dtype=numpy.int64).reshape((-1, 3))
+    if not len(idx):
+        return (numpy.empty((0, 2), dtype=numpy.int64),
+                numpy.empty((0, 3), dtype=numpy.int64))
+    nbNodes = int(idx.max()) + 1
+    edges = numpy.empty((len(idx), 3, 2), dtype=numpy.int64)
+    edges[:, :, 0] = idx
+    edges[:, :, 1] = numpy.roll(idx, -1, axis=1)
+    edges = edges.reshape((-1, 2))
+    edges.sort(axis=1)
+    key, inverse = numpy.unique(edges[:, 0]*nbNodes + edges[:, 1], return_inverse=True)
+    return (numpy.column_stack((key // nbNodes, key % nbNodes)),
+            inverse.reshape((-1, 3)))
+
+def elementToNodeValues(idx, elementValues, nbNodes):
+    """return node values computed as the mean of the values of the elements
+    sharing the node"""
+    idx = numpy.asarray(idx).reshape((-1, 3))
+    val = numpy.repeat(numpy.asarray(elementValues, dtype=numpy.float64), 3)
+    count = numpy.bincount(idx.reshape((-1,)), minlength=nbNodes)
+    sum_ = numpy.bincount(idx.reshape((-1,)), weights=val, minlength=nbNodes)
+    return sum_/numpy.maximum(count, 1)
+
+class MarchingTriangles(object):
+    """Contouring of values defined at the nodes of a triangular mesh.
+
+    The edge table of the mesh is computed once, crossing edges and
+    interpolated points are then computed for all requested levels
+    in batched array operations.
+
+    A node is considered above a level if its value is greater or equal
+    to the level, so that each crossed triangle yields exactly one segment.
+    """
+
+    # maximum number of (level, triangle) pairs processed at once
+    BATCH_SIZE = 1 << 22
+
+    def __init__(self, vtx, idx, edges=None, triangleEdges=None):
+        """edges and triangleEdges, as returned by meshEdges, are computed
+        if not provided"""
+        self.__vtx = numpy.require(vtx, numpy.float64)
+        self.__idx = numpy.require(idx, numpy.int64).reshape((-1, 3))
+        if edges is None or triangleEdges is None:
+            edges, triangleEdges = meshEdges(self.__idx)
+        self.__edges, self.__triEdges = edges, triangleEdges
+
+    def edges(self):
+        """return the (nbEdges, 2) array of node indices of mesh edges"""
+        return self.__edges
+
+    def triangleEdges(self):
+        """return the (nbTriangles, 3) array of edge indices of triangles"""
+        return self.__triEdges
+
+    def segments(self, values, levels):
+        """return a tuple (levelIdx, edgeIdx, points) describing the isoline
+        segments of node values for all levels:
+            levelIdx is the (nbSegments,) array of the index of the level
+            edgeIdx is the (nbSegments, 2) array of crossed mesh edges
+            points is the (nbSegments, 2, dim) array of segment end points
+        segments are sorted by level, the end points of adjacent segments
+        are located on the same mesh edge and are equal"""
+        val = numpy.require(values, numpy.float64).reshape((-1,))
+        levels = numpy.require(levels, numpy.float64).reshape((-1,))
+        nbTri = len(self.__idx)
+        dim = self.__vtx.shape[1]
+        if not nbTri or not len(levels):
+            return (numpy.empty((0,), dtype=numpy.int64),
+                    numpy.empty((0, 2), dtype=numpy.int64),
+                    numpy.empty((0, 2, dim), dtype=numpy.float64))
+
+        batch = max(1, MarchingTriangles.BATCH_SIZE // nbTri)
+        levelIdx, edgeIdx, points = [], [], []
+        for start in range(0, len(levels), batch):
+            lev = levels[start:start+batch]
+            above = val[numpy.newaxis, :] >= lev[:, numpy.newaxis]
+            triAbove = above[:, self.__idx]
+            count = triAbove.sum(axis=2)
+            lvl, tri = numpy.nonzero(numpy.logical_and(count > 0, count < 3))
+            if not len(tri):
+                continue
+            triAbove = triAbove[lvl, tri]
+            # exactly two edges of a crossed triangle are crossed, the
+            # remaining one is the one with the smallest 'crosses' flag
+            crosses = triAbove != numpy.roll(triAbove, -1, axis=1)
+            k = numpy.argmin(crosses, axis=1)
+            edg = numpy.column_stack((
+                self.__triEdges[tri, (k + 1) % 3],
+                self.__triEdges[tri, (k + 2) % 3]))
+
+            # interpolation along sorted edges, so that the point computed
+            # for an edge does not depend on the triangle it is computed from
+            nodes = self.__edges[edg]
+            v0 = val[nodes[:, :, 0]]
+            v1 = val[nodes[:, :, 1]]
+            alpha = ((lev[lvl, numpy.newaxis] - v0)/(v1 - v0))[:, :, numpy.newaxis]
+            x0 = self.__vtx[nodes[:, :, 0]]
+            x1 = self.__vtx[nodes[:, :, 1]]
+
+            levelIdx.append(lvl + start)
+            edgeIdx.append(edg)
+            points.append((1 - alpha)*x0 + alpha*x1)
+
+        if not len(levelIdx):
+            return self.segments(values, [])
+        return (numpy.concatenate(levelIdx),
+                numpy.concatenate(edgeIdx),
+                numpy.concatenate(points))
+
+    def lines(self, values, levels):
+        """return a list with, for each level, a list of (nbPoints, dim)
+        arrays of stitched isoline points, closed isolines end with
+        their first point"""
+        levelIdx, edgeIdx, points = self.segments(values, levels)
+        lines = [[] for l in levels]
+        if not len(levelIdx):
+            return lines
+        # end points are identified by level and crossed edge
+        nbEdges = len(self.__edges)
+        ids = levelIdx[:, numpy.newaxis]*nbEdges + edgeIdx
+        polylines = stitch(ids[:, 0], ids[:, 1])
+        vertexIds, first = numpy.unique(ids.reshape((-1,)), return_index=True)
+        coordinates = points.reshape((-1, points.shape[2]))[first]
+        chained = coordinates[numpy.searchsorted(vertexIds, numpy.concatenate(polylines))]
+        ends = numpy.cumsum([len(p) for p in polylines])
+        for polyline, line in zip(polylines, numpy.split(chained, ends[:-1])):
+            lines[polyline[0] // nbEdges].append(line)
+        return lines
+
+    def bands(self, values, classes):
+        """return a list with, for each class (min, max) of classes, a list
+        of polygons covering the mesh where min < value <= max, as the
+        classes of ColorLegend.graduation() are rendered, the lowest bound
+        of classes is included so that classes spanning the range of values
+        cover the mesh. A polygon is a list of closed (nbPoints, dim) rings,
+        the counterclockwise exterior ring first, followed by its clockwise
+        holes.
+
+        Each triangle is clipped against each class in batched operations,
+        the vertices of the pieces are identified by mesh node or by (mesh
+        edge, bound) so that pieces are dissolved by removing the piece
+        edges shared by two pieces of a class. Rings touch each other only
+        at nodes where the value is equal to a bound, they do not cross"""
+        val = numpy.require(values, numpy.float64).reshape((-1,))
+        classes = numpy.require(classes, numpy.float64).reshape((-1, 2))
+        out = [[] for c in classes]
+        if not len(self.__idx) or not len(classes):
+            return out
+
+        levels = numpy.unique(classes)
+        triangles, triangleEdges = self.__orientedTriangles()
+        triVal = val[triangles]
+        with numpy.errstate(invalid='ignore'):
+            triMin, triMax = triVal.min(axis=1), triVal.max(axis=1)
+
+        for c, (lo, hi) in enumerate(classes):
+            with numpy.errstate(invalid='ignore'):
+                tri = numpy.nonzero(numpy.logical_and(_above(triMax, levels, lo), triMin <= hi))[0]
+            starts, ends = [], []
+            for start in range(0, len(tri), MarchingTriangles.BATCH_SIZE // 9):
+                s, e = self.__clip(tri[start:start + MarchingTriangles.BATCH_SIZE // 9],
+                        triangles, triangleEdges, val, levels,
+                        numpy.searchsorted(levels, [lo, hi]))
+                starts.append(s)
+                ends.append(e)
+            if not len(starts):
+                continue
+            starts, ends = _boundary(numpy.concatenate(starts), numpy.concatenate(ends))
+            ids, edges = numpy.unique(numpy.concatenate((starts, ends)), return_inverse=True)
+            edges = edges.reshape((2, -1))
+            out[c] = _polygons(_rings(edges[0], edges[1],
+                self.__pointCoordinates(ids, val, levels)))
+        return out
+
+    def __orientedTriangles(self):
+        """return triangles and their edge indices ordered counterclockwise"""
+        v = self.__vtx[:, :2][self.__idx]
+        clockwise = ((v[:, 1, 0] - v[:, 0, 0])*(v[:, 2, 1] - v[:, 0, 1])
+                   - (v[:, 1, 1] - v[:, 0, 1])*(v[:, 2, 0] - v[:, 0, 0])) < 0
+        triangles = self.__idx.copy()
+        triangleEdges = numpy.array(self.__triEdges, dtype=numpy.int64)
+        # swapping nodes 1 and 2 reverses the order of edges
+        triangles[clockwise] = triangles[clockwise][:, [0, 2, 1]]
+        triangleEdges[clockwise] = triangleEdges[clockwise][:, [2, 1, 0]]
+        return triangles, triangleEdges
+
+    def __crossing(self, edg, levelIdx, val, levels):
+        """return the vertex identifiers of the crossings of mesh edges at
+        levels, a crossing at a node, where the value equals the level,
+        is identified by the node"""
+        nodes = self.__edges[edg]
+        lev = levels[levelIdx]
+        return numpy.where(val[nodes[..., 0]] == lev, nodes[..., 0],
+               numpy.where(val[nodes[..., 1]] == lev, nodes[..., 1],
+                   len(self.__vtx) + edg*len(levels) + levelIdx))
+
+    def __clip(self, tri, triangles, triangleEdges, val, levels, bounds):
+        """return the (start, end) vertex identifiers of the edges of the
+        pieces of triangles tri between levels of indices bounds, pieces
+        are counterclockwise"""
+        lo, hi = levels[bounds]
+        nodes = triangles[tri]
+        v = val[nodes]
+        aboveLo, aboveHi = _above(v, levels, lo), _above(v, levels, hi)
+        inside = numpy.logical_and(aboveLo, numpy.logical_not(aboveHi))
+
+        # up to three vertices per triangle edge: its first node and the
+        # crossings of the bounds in the order they are met
+        ids = numpy.full((len(tri), 9), -1, dtype=numpy.int64)
+        for k in range(3):
+            a, b = k, (k + 1) % 3
+            edg = triangleEdges[tri, k]
+            crossLo = aboveLo[:, a] != aboveLo[:, b]
+            crossHi = aboveHi[:, a] != aboveHi[:, b]
+            idLo = numpy.where(crossLo, self.__crossing(edg, bounds[0], val, levels), -1)
+            idHi = numpy.where(crossHi, self.__crossing(edg, bounds[1], val, levels), -1)
+            rising = v[:, a] < v[:, b]
+            ids[:, 3*k] = numpy.where(inside[:, a], nodes[:, a], -1)
+            ids[:, 3*k + 1] = numpy.where(rising, idLo, idHi)
+            ids[:, 3*k + 2] = numpy.where(rising, idHi, idLo)
+
+        # remove vertices repeated by crossings at nodes, the last vertex
+        # is also removed if it repeats the first, pieces with less than
+        # three vertices have no area
+        ids, count = _compact(ids)
+        ids[:, 1:][ids[:, 1:] == ids[:, :-1]] = -1
+        ids, count = _compact(ids)
+        rows = numpy.arange(len(ids))
+        last = numpy.maximum(count - 1, 0)
+        ids[rows, last] = numpy.where(numpy.logical_and(count > 1, ids[rows, last] == ids[:, 0]),
+                -1, ids[rows, last])
+        count = (ids >= 0).sum(axis=1)
+        keep = count >= 3
+        ids, count = ids[keep], count[keep]
+
+        column = numpy.arange(ids.shape[1])[numpy.newaxis, :]
+        rows = numpy.arange(len(ids))[:, numpy.newaxis]
+        following = ids[rows, (column + 1) % count[:, numpy.newaxis]]
+        valid = column < count[:, numpy.newaxis]
+        return ids[valid], following[valid]
+
+    def __pointCoordinates(self, ids, val, levels):
+        """return the coordinates of vertex identifiers, crossings are
+        interpolated as in segments()"""
+        nbNodes = len(self.__vtx)
+        crossing = ids >= nbNodes
+        points = self.__vtx[numpy.minimum(ids, nbNodes - 1)]
+        edg = (ids[crossing] - nbNodes) // len(levels)
+        levelIdx = (ids[crossing] - nbNodes) % len(levels)
+        nodes = self.__edges[edg]
+        v0, v1 = val[nodes[:, 0]], val[nodes[:, 1]]
+        alpha = ((levels[levelIdx] - v0)/(v1 - v0))[:, numpy.newaxis]
+        points[crossing] = (1 - alpha)*self.__vtx[nodes[:, 0]] + alpha*self.__vtx[nodes[:, 1]]
+        return points
+
+def _compact(ids):
+    """return ids with the non negative values of each row moved first, in
+    order, and the number of those values per row"""
+    valid = ids >= 0
+    order = numpy.argsort(numpy.logical_not(valid), axis=1, kind='mergesort')
+    return ids[numpy.arange(len(ids))[:, numpy.newaxis], order], valid.sum(axis=1)
+
+def _above(v, levels, level):
+    """return v > level, or v >= level for the lowest level"""
+    return v >= level if level == levels[0] else v > level
+
+def _boundary(starts, ends):
+    """return the directed edges (starts, ends) that are not shared, in the
+    opposite direction, by another edge"""
+    lo, hi = numpy.minimum(starts, ends), numpy.maximum(starts, ends)
+    order = numpy.lexsort((hi, lo))
+    lo, hi = lo[order], hi[order]
+    same = numpy.logical_and(lo[1:] == lo[:-1], hi[1:] == hi[:-1])
+    shared = numpy.zeros((len(order),), dtype=bool)
+    shared[1:] |= same
+    shared[:-1] |= same
+    kept = order[numpy.logical_not(shared)]
+    return starts[kept], ends[kept]
+
+def _rings(starts, ends, points):
+    """return the list of closed rings, (nbPoints, dim) arrays with the
+    first point repeated last, formed by the directed boundary edges
+    (starts, ends) between points. At a vertex where rings meet, an
+    incoming edge is followed by the first outgoing edge met turning
+    clockwise from it, so that rings touch without crossing"""
+    nbOutgoing = numpy.bincount(starts, minlength=len(points))
+    incoming = numpy.nonzero(nbOutgoing[ends] > 1)[0]
+    if not len(incoming):
+        return [points[r] for r in stitch(starts, ends, directed=True)]
+
+    outgoing = numpy.nonzero(nbOutgoing[starts] > 1)[0]
+    # rays from the meeting vertices, in clockwise order around them
+    vertex = numpy.concatenate((ends[incoming], starts[outgoing]))
+    ray = numpy.concatenate((points[starts[incoming], :2] - points[ends[incoming], :2],
+                             points[ends[outgoing], :2] - points[starts[outgoing], :2]))
+    isOutgoing = numpy.repeat(numpy.array([False, True]), (len(incoming), len(outgoing)))
+    edge = numpy.concatenate((incoming, outgoing))
+    order = numpy.lexsort((-numpy.arctan2(ray[:, 1], ray[:, 0]), vertex))
+    vertex, isOutgoing, edge = vertex[order], isOutgoing[order], edge[order]
+    first = numpy.ones((len(order),), dtype=bool)
+    first[1:] = vertex[1:] != vertex[:-1]
+    groupStart = numpy.maximum.accumulate(numpy.where(first, numpy.arange(len(order)), 0))
+    nxt = numpy.arange(1, len(order) + 1)
+    wrap = numpy.append(first[1:], True)
+    nxt[wrap] = groupStart[wrap]
+    # each pair (incoming, next outgoing) meets at its own copy of the
+    # vertex, unpaired edges keep the vertex
+    pair = numpy.nonzero(numpy.logical_and(numpy.logical_not(isOutgoing), isOutgoing[nxt]))[0]
+    copies = len(points) + numpy.arange(len(pair))
+    ends[edge[pair]] = copies
+    starts[edge[nxt[pair]]] = copies
+    origin = numpy.concatenate((numpy.arange(len(points)), vertex[pair]))
+    rings = stitch(starts, ends, directed=True)
+
+    # a ring around a region touching itself, e.g. around a hole, passes
+    # twice through a vertex, it is split there in two rings
+    ringIdx = numpy.repeat(numpy.arange(len(rings)), [len(r) - 1 for r in rings])
+    vertices = origin[numpy.concatenate([r[:-1] for r in rings])]
+    order = numpy.lexsort((vertices, ringIdx))
+    repeated = numpy.logical_and(ringIdx[order][1:] == ringIdx[order][:-1],
+                                 vertices[order][1:] == vertices[order][:-1])
+    touching = set(ringIdx[order][1:][repeated].tolist())
+    out = []
+    for i, ring in enumerate(rings):
+        if i not in touching:
+            out.append(points[origin[ring]])
+            continue
+        stack, position = [], {}
+        for v in origin[ring[:-1]].tolist():
+            if v in position:
+                k = position[v]
+                out.append(points[stack[k:] + [v]])
+                for u in stack[k + 1:]:
+                    del position[u]
+                del stack[k + 1:]
+            else:
+                position[v] = len(stack)
+                stack.append(v)
+        out.append(points[stack + [stack[0]]])
+    return out
+
+def _signedArea(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return .5*numpy.sum(x[:-1]*y[1:] - x[1:]*y[:-1])
+
+def _contains(ring, x, y):
+    """return True if point (x, y) is inside the closed ring (even-odd rule)"""
+    x0, y0, x1, y1 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+    straddle = (y0 > y) != (y1 > y)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        xCross = x0 + (y - y0)*(x1 - x0)/(y1 - y0)
+    return bool(numpy.count_nonzero(numpy.logical_and(straddle, x < xCross)) % 2)
+
+def _interiorPoint(ring):
+    """return a point strictly inside a closed ring, in the middle of the
+    widest inside interval of the horizontal line between the two most
+    distant consecutive ordinates of its vertices"""
+    ys = numpy.unique(ring[:, 1])
+    if len(ys) < 2:
+        return ring[0, 0], ring[0, 1]
+    gap = numpy.argmax(numpy.diff(ys))
+    y = .5*(ys[gap] + ys[gap + 1])
+    x0, y0, x1, y1 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+    straddle = (y0 > y) != (y1 > y)
+    xs = numpy.sort(x0[straddle] + (y - y0[straddle])*(x1[straddle] - x0[straddle])
+            /(y1[straddle] - y0[straddle]))
+    widest = 2*numpy.argmax(xs[1::2] - xs[0::2])
+    return .5*(xs[widest] + xs[widest + 1]), y
+
+def _polygons(rings):
+    """return polygons, lists of rings with the exterior first, from
+    counterclockwise exteriors and clockwise holes. A hole is assigned to
+    the smallest exterior larger than the hole that contains a point inside
+    the hole, the exteriors inside the hole being smaller, or to the
+    smallest exterior larger than the hole if none contains it"""
+    areas = numpy.array([_signedArea(r) for r in rings])
+    exteriors = numpy.nonzero(areas > 0)[0]
+    exteriors = exteriors[numpy.argsort(areas[exteriors], kind='mergesort')]
+    boxes = numpy.array([(rings[i][:, 0].min(), rings[i][:, 1].min(),
+        rings[i][:, 0].max(), rings[i][:, 1].max()) for i in exteriors]).reshape((-1, 4))
+    polygons = dict((i, [rings[i]]) for i in exteriors)
+    for i in numpy.nonzero(areas < 0)[0]:
+        larger = exteriors[areas[exteriors] > -areas[i]]
+        if not len(larger):
+            # a hole without exterior is kept as a polygon
+            polygons[i] = [rings[i][::-1]]
+            exteriors = numpy.append(exteriors, i)
+            continue
+        x, y = _interiorPoint(rings[i])
+        box = boxes[areas[exteriors] > -areas[i]]
+        candidates = larger[(box[:, 0] <= x) & (x <= box[:, 2]) & (box[:, 1] <= y) & (y <= box[:, 3])]
+        containing = [j for j in candidates if _contains(rings[j], x, y)]
+        polygons[containing[0] if containing else larger[0]].append(rings[i])
+    return [polygons[i] for i in sorted(polygons)]
+
+def multiPolygonWkb(polygons):
+    """return the little endian 2D WKB of a multipolygon, as accepted by
+    QgsGeometry.fromWkb, for a list of polygons returned by
+    MarchingTriangles.bands()"""
+    parts = [struct.pack("<BII", 1, 6, len(polygons))]
+    for polygon in polygons:
+        parts.append(struct.pack("<BII", 1, 3, len(polygon)))
+        for ring in polygon:
+            parts.append(struct.pack("<I", len(ring)))
+            parts.append(numpy.require(ring[:, :2], numpy.float64, 'C').astype('<f8').tobytes())
+    return b"".join(parts)
+
+# run as script for testing
+if __name__ == "__main__":
+    from shapely import wkb
+
+    def unitSquareMesh(n):
+        """return the nodes and triangles of a regular n by n grid of the
+        unit square, two triangles per cell"""
+        x, y = numpy.meshgrid(numpy.linspace(0, 1, n + 1), numpy.linspace(0, 1, n + 1))
+        vtx = numpy.column_stack((x.reshape((-1,)), y.reshape((-1,))))
+        cell = (numpy.arange(n)[:, numpy.newaxis]*(n + 1) + numpy.arange(n)).reshape((-1,))
+        return vtx, numpy.concatenate((
+            numpy.column_stack((cell, cell + 1, cell + n + 2)),
+            numpy.column_stack((cell, cell + n + 2, cell + n + 1))))
+
+    # isolines of a linear field are exact straight lines crossing the
+    # square, isolines of a radial field are closed and nearly circular
+    vtx, idx = unitSquareMesh(40)
+    x, y = vtx[:, 0], vtx[:, 1]
+    contour = MarchingTriangles(vtx, idx)
+    levels = [.3, 1., 2.5, 4.]
+    lines = contour.lines(x + 2*y, levels)
+    assert(len(lines) == 4 and not len(lines[3]))
+    for level, multiline in zip(levels[:3], lines[:3]):
+        assert(len(multiline) == 1)
+        line = multiline[0]
+        assert(numpy.all(numpy.abs(line[:, 0] + 2*line[:, 1] - level) < 1e-12))
+        assert(numpy.any(line[[0, -1]] < 1e-12) or numpy.any(line[[0, -1]] > 1 - 1e-12))
+        assert(numpy.all(numpy.linalg.norm(line[0] - line[-1]) > .1))
+
+    lines = contour.lines((x - .5)**2 + (y - .5)**2, [.01, .1])
+    for level, multiline in zip([.01, .1], lines):
+        assert(len(multiline) == 1)
+        ring = multiline[0]
+        assert(numpy.all(ring[0] == ring[-1]))
+        radius = numpy.linalg.norm(ring - .5, axis=1)
+        assert(numpy.all(numpy.abs(radius - numpy.sqrt(level)) < 2e-3))
+        assert(abs(abs(_signedArea(ring)) - numpy.pi*level) < 3e-2*numpy.pi*level)
+
+    # bands of classes spanning the values cover the mesh with valid
+    # polygons, values on bounds create rings touching at nodes
+    rand = numpy.random.RandomState(0)
+    vtx, idx = unitSquareMesh(24)
+    flipped = rand.rand(len(idx)) < .5
+    idx[flipped] = idx[flipped][:, [0, 2, 1]]
+    x, y = vtx[:, 0], vtx[:, 1]
+    for val in (numpy.round(numpy.sin(6*x)*numpy.cos(5*y), 1),
+                numpy.round(numpy.maximum(0, .5*numpy.sin(7*x)*numpy.sin(6*y)), 2),
+                rand.randint(0, 4, len(vtx)).astype(numpy.float64)):
+        bounds = numpy.linspace(val.min(), val.max(), 5)
+        bands = MarchingTriangles(vtx, idx).bands(val, list(zip(bounds[:-1], bounds[1:])))
+        area = 0.
+        for polygons in bands:
+            for polygon in polygons:
+                assert(wkb.loads(multiPolygonWkb([polygon])).is_valid)
+                area += sum(_signedArea(ring) for ring in polygon)
+            assert(wkb.loads(multiPolygonWkb(polygons)).is_valid)
+        assert(abs(area - 1) < 1e-9)
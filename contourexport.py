@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+from qgis.core import QgsVectorFileWriter, QgsFields, QgsField, QgsFeature, \
+        QgsGeometry, QgsPoint, QGis
+from PyQt4.QtCore import QVariant
+
+import numpy
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from contour import MarchingTriangles, meshEdges, elementToNodeValues
+from utilities import processPool, imapByGroup
+
+# number of dates whose values are saved for the workers ahead of the
+# pairs being contoured
+DATES_AHEAD = 2
+
+class IsolineFileWriter(object):
+    """Vector file writer of isolines, one multilinestring feature per level
+    and date with the attributes 'value' and 'date' (the date index).
+    Features are written as they are received, the file is complete when
+    close() is called"""
+
+    def __init__(self, fileName, crs, driverName="ESRI Shapefile", encoding="utf-8"):
+        fields = QgsFields()
+        fields.append(QgsField("value", QVariant.Double))
+        fields.append(QgsField("date", QVariant.Int))
+        self.__writer = QgsVectorFileWriter(fileName, encoding, fields,
+                QGis.WKBMultiLineString, crs, driverName)
+        if self.__writer.hasError() != QgsVectorFileWriter.NoError:
+            raise RuntimeError("Cannot create "+fileName+": "+self.__writer.errorMessage())
+
+    def __call__(self, didx, value, lines):
+        feature = QgsFeature()
+        feature.setGeometry(QgsGeometry.fromMultiPolyline([
+            [QgsPoint(float(p[0]), float(p[1])) for p in line] for line in lines]))
+        feature.setAttributes([float(value), int(didx)])
+        self.__writer.addFeature(feature)
+
+    def close(self):
+        """flush and close the file"""
+        # the file is closed when the writer is deleted
+        self.__writer = None
+
+# state of a worker process, set by _initWorker
+_worker = {}
+
+def _initWorker(meshDirectory, perElement, levels):
+    load = lambda name: numpy.load(os.path.join(meshDirectory, name+".npy"), mmap_mode='r')
+    idx = load("triangles")
+    _worker.clear()
+    _worker.update({
+        'meshDirectory': meshDirectory,
+        'nbNodes': len(load("nodeCoord")),
+        'idx': idx,
+        'contour': MarchingTriangles(load("nodeCoord"), idx,
+            load("edges"), load("triangleEdges")),
+        'perElement': perElement,
+        'levels': levels,
+        'values': {}})
+
+def _values(didx):
+    """return node values of a date, cached for the current date"""
+    cache = _worker['values']
+    if cache.get('date') != didx:
+        cache.clear()
+        values = numpy.load(os.path.join(_worker['meshDirectory'], "values_%d.npy"%didx),
+                mmap_mode='r')
+        if _worker['perElement']:
+            values = elementToNodeValues(_worker['idx'], values, _worker['nbNodes'])
+        cache['date'] = didx
+        cache['values'] = values
+    return cache['values']
+
+def _contour(task):
+    """return (didx, level index, lines) of a task (didx, level index)"""
+    didx, lidx = task
+    lines = _worker['contour'].lines(_values(didx), [_worker['levels'][lidx]])[0]
+    return didx, lidx, lines
+
+def exportIsolines(provider, levels, writer, dates=None, processes=None,
+        progress=None, cancelled=None, contour=None):
+    """compute the isolines of the values of a MeshDataProvider for each of
+    levels and each date index in dates (the current date by default).
+    (date, level) pairs are contoured by a pool of processes (one per cpu by
+    default) that memory map the mesh and its edge table, the edge table of
+    contour, a MarchingTriangles of the provider mesh, is used if provided.
+    writer(didx, level, lines) is called in the calling process as soon as
+    the isolines of a pair are computed, in no particular order, lines is a
+    non empty list of (nbPoints, dim) arrays. The values of a date are saved
+    for the workers DATES_AHEAD dates before its pairs are contoured and
+    removed after.
+    progress(done, total, pairsPerSecond) is called as pairs are contoured,
+    the export stops as soon as cancelled(), if provided, returns True.
+    Return a dictionary with the number of 'features' written, of 'empty'
+    pairs, if the export was 'cancelled', the 'seconds' spent and
+    'pairsPerSecond'"""
+    start = time.time()
+    dates = [provider.date()] if dates is None else list(dates)
+    levels = [float(l) for l in levels]
+    meshDirectory = tempfile.mkdtemp(prefix="meshlayer_isolines_")
+    features, done, isCancelled = 0, 0, False
+    try:
+        triangles = numpy.require(provider.triangles(), numpy.int64).reshape((-1, 3))
+        if contour is not None:
+            edges, triangleEdges = contour.edges(), contour.triangleEdges()
+        else:
+            edges, triangleEdges = meshEdges(triangles)
+        # coordinates are saved in the dtype used by MarchingTriangles so
+        # that workers contour the memory map without a copy
+        nodeCoord = numpy.require(provider.nodeCoord(), numpy.float64)
+        for name, array in (("nodeCoord", nodeCoord), ("triangles", triangles),
+                ("edges", edges), ("triangleEdges", triangleEdges)):
+            numpy.save(os.path.join(meshDirectory, name+".npy"), numpy.asarray(array))
+
+        total = len(dates)*len(levels)
+        processes = processes or multiprocessing.cpu_count()
+        chunkSize = max(1, min(len(levels), total//(4*processes)))
+
+        valuesFile = lambda didx: os.path.join(meshDirectory, "values_%d.npy"%didx)
+        def saveValues(didx):
+            numpy.save(valuesFile(didx), numpy.asarray(provider.dateValues(didx)))
+        def removeValues(didx):
+            try:
+                os.remove(valuesFile(didx))
+            except OSError:
+                # still mapped by a worker on Windows, removed with the directory
+                pass
+
+        pool = processPool(processes, _initWorker,
+                (meshDirectory, provider.valueAtElement(), levels))
+        try:
+            # the pairs of a date share the values cached by the worker
+            for didx, lidx, lines in imapByGroup(pool, _contour,
+                    [(didx, [(didx, lidx) for lidx in range(len(levels))]) for didx in dates],
+                    saveValues, removeValues, chunkSize, DATES_AHEAD):
+                done += 1
+                if len(lines):
+                    writer(didx, levels[lidx], lines)
+                    features += 1
+                if progress:
+                    progress(done, total, done/(time.time() - start))
+                if cancelled and cancelled():
+                    isCancelled = True
+                    break
+            if isCancelled:
+                pool.terminate()
+            else:
+                pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        shutil.rmtree(meshDirectory)
+
+    seconds = time.time() - start
+    return {'features': features,
+            'empty': done - features,
+            'cancelled': isCancelled,
+            'seconds': seconds,
+            'pairsPerSecond': done/seconds if seconds else 0.}
+
+def exportLayerIsolines(layer, levels, fileName, dates=None, driverName="ESRI Shapefile",
+        processes=None, progress=None, cancelled=None):
+    """write the isolines of a MeshLayer in a vector file, see exportIsolines"""
+    writer = IsolineFileWriter(fileName, layer.dataProvider().crs(), driverName)
+    try:
+        return exportIsolines(layer.dataProvider(), levels, writer, dates,
+                processes, progress, cancelled, layer.contour())
+    finally:
+        writer.close()
@@ -5,12 +5,30 @@ from OpenGL.GL import shaders
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
-from PyQt4.QtOpenGL import QGLPixelBuffer, QGLFormat, QGLContext
+from PyQt4.QtOpenGL import QGLPixelBuffer, QGLFormat, QGLContext, QGLFramebufferObject, QGLWidget
 
 import numpy
+import ctypes
+import hashlib
+from collections import OrderedDict
 from math import log, ceil, exp
 
-from utilities import complete_filename, format_
+from utilities import complete_filename, format_, SharedObjects
+from spatialindex import TriangleGrid, viewExtent
+from lod import MeshHierarchy
+from instrumentation import stage, count
+
+def elementGeometry(vtx, idx):
+    """return vertices duplicated for each triangle, and the matching
+    triangles, so that values can be defined per triangle"""
+    vtx = numpy.concatenate((vtx[idx[:,0]], vtx[idx[:,1]], vtx[idx[:,2]]))
+    nbElem = len(idx)
+    idx = numpy.require(numpy.reshape(
+        numpy.array([numpy.arange(nbElem),
+                     numpy.arange(nbElem, 2*nbElem),
+                     numpy.arange(2*nbElem, 3*nbElem)]),
+        (3,-1)).transpose(), numpy.int32, 'C')
+    return vtx, idx
 
 def roundUpSize(size):
     """return size roudup to the nearest power of 2"""
@@ -26,8 +44,11 @@ class ColorLegend(QGraphicsScene):
 
     symbologyChanged = pyqtSignal()
 
-    __pixelColorContinuous = """
-        vec4 pixelColor(float value)
+    # graduations with more classes are compiled in the shader
+    MAX_CLASSES = 32
+
+    __rampColor = """
+        vec4 rampColor(float value)
         {
             float normalizedValue = clamp(
                 logscale
@@ -38,6 +59,43 @@ class ColorLegend(QGraphicsScene):
         }
         """
 
+    # classes are uniform arrays, sorted by min value when they do not
+    # overlap so that the class of a value is found by binary search
+    __classColorUniforms = """
+        uniform int nbClasses;
+        uniform bool sortedClasses;
+        uniform vec2 classRanges[%(maxClasses)d];
+        uniform vec3 classColors[%(maxClasses)d];
+        vec4 classColor(float value)
+        {
+            int found = -1;
+            if (sortedClasses){
+                // number of classes whose min is below value
+                int lo = 0;
+                int hi = nbClasses;
+                for (int step = 0; step < %(searchSteps)d; ++step){
+                    if (lo < hi){
+                        int mid = (lo + hi)/2;
+                        if (classRanges[mid].x < value) lo = mid + 1;
+                        else hi = mid;
+                    }
+                }
+                if (lo > 0 && value <= classRanges[lo-1].y) found = lo-1;
+            }
+            else {
+                for (int i = 0; i < %(maxClasses)d; ++i){
+                    if (i >= nbClasses) break;
+                    if (classRanges[i].x < value && value <= classRanges[i].y){
+                        found = i;
+                        break;
+                    }
+                }
+            }
+            return found >= 0 ? vec4(classColors[found], 1.) : vec4(0., 0., 0., 0.);
+        }
+        """ % {'maxClasses': MAX_CLASSES,
+               'searchSteps': int(ceil(log(MAX_CLASSES + 1)/log(2)))}
+
 
     def __init__(self, parent=None):
         #QGraphicsScene.__init__(self, parent)
@@ -45,14 +103,16 @@ class ColorLegend(QGraphicsScene):
         self.__minValue = 0
         self.__maxValue = 1
         self.__transparency = 0
+        # uniform locations by shader program
         self.__uniformLocations = {}
+        self.__program = None
         self.__title = "no title"
         self.__colorRampFile = ColorLegend.availableRamps()[u"Bleu - Rouge"]
         self.__colorRamp = QImage(self.__colorRampFile)
         self.__units = ""
         self.__scale = "linear"
-        self.__pixelColor = ColorLegend.__pixelColorContinuous
         self.__graduation = []
+        self.__classes = ColorLegend.__classUniforms([])
         self.__graduated = False
         self.__maskUnits = False
 
@@ -67,27 +127,32 @@ class ColorLegend(QGraphicsScene):
 
     def toggleGraduation(self, flag):
         self.__graduated = bool(flag)
-        if self.__graduated:
-            self.__pixelColor = "vec4 pixelColor(float value)\n{\n"
-
-            for c, min_, max_ in self.__graduation:
-                self.__pixelColor += "    if (float(%g) < value && value <= float(%g)) return vec4(%g, %g, %g, 1.);\n"%(
-                        min_, max_, c.redF(), c.greenF(), c.blueF())
-            self.__pixelColor += "    return vec4(0., 0., 0., 0.);\n"
-            self.__pixelColor += "}\n";
-        else:
-            self.__pixelColor = ColorLegend.__pixelColorContinuous
         self.symbologyChanged.emit()
 
     def setGraduation(self, graduation):
         """graduation is a list of tuple (color, min, max) the alpha componant is not considered"""
         self.__graduation = graduation
+        self.__classes = ColorLegend.__classUniforms(graduation)
         self.toggleGraduation(bool(self.__graduation))
 
+    @staticmethod
+    def __classUniforms(graduation):
+        """return (ranges, colors, sorted) the values of the class uniforms,
+        classes are sorted by min value if they do not overlap"""
+        ranges = numpy.array([(min_, max_) for c, min_, max_ in graduation],
+                dtype=numpy.float32).reshape((-1, 2))
+        colors = numpy.array([(c.redF(), c.greenF(), c.blueF()) for c, min_, max_ in graduation],
+                dtype=numpy.float32).reshape((-1, 3))
+        order = numpy.argsort(ranges[:, 0], kind='mergesort')
+        sorted_ = bool(numpy.all(ranges[order[1:], 0] >= ranges[order[:-1], 1]))
+        if sorted_:
+            ranges, colors = ranges[order], colors[order]
+        return numpy.require(ranges, requirements='C'), numpy.require(colors, requirements='C'), sorted_
+
     def graduation(self):
         return self.__graduation
 
-    def _fragmentShader(self):
+    def _fragmentShader(self, perElement=False):
         """Return a string containing the definition of the GLSL pixel shader
             vec4 pixelColor(float value)
         This may contain global shader variables and should therefore
@@ -96,8 +161,24 @@ class ColorLegend(QGraphicsScene):
         Note that:
             varying float value
         must be defined by the vertex shader
+
+        With perElement, the value is instead read at the index of the
+        primitive in the elementValues buffer texture, this requires the
+        GL_EXT_gpu_shader4 extension
+
+        The source only changes when the number of classes exceeds
+        MAX_CLASSES, symbology changes are otherwise applied by _setUniforms
         """
-        return """
+        if len(self.__graduation) <= ColorLegend.MAX_CLASSES:
+            classColor = ColorLegend.__classColorUniforms
+        else:
+            classColor = "vec4 classColor(float value)\n{\n"
+            for c, min_, max_ in self.__graduation:
+                classColor += "    if (float(%g) < value && value <= float(%g)) return vec4(%g, %g, %g, 1.);\n"%(
+                        min_, max_, c.redF(), c.greenF(), c.blueF())
+            classColor += "    return vec4(0., 0., 0., 0.);\n"
+            classColor += "}\n";
+        return ("#extension GL_EXT_gpu_shader4 : require\n" if perElement else "")+"""
             varying float value;
             varying float w;
             varying vec3 normal;
@@ -108,17 +189,24 @@ class ColorLegend(QGraphicsScene):
             uniform bool logscale;
             uniform bool withNormals;
             uniform sampler2D tex;
-            """+self.__pixelColor+"""
+            uniform bool graduated;
+            """+("uniform samplerBuffer elementValues;" if perElement else "") \
+            +ColorLegend.__rampColor+classColor+"""
+            vec4 pixelColor(float value)
+            {
+                return graduated ? classColor(value) : rampColor(value);
+            }
             void main()
             {
+                float v = """+("texelFetchBuffer(elementValues, gl_PrimitiveID).r" if perElement else "value")+""";
                 vec3 lightDir = vec3(gl_LightSource[0].position-ecPos);
                 if (withNormals){
-                    gl_FragColor.rgb = pixelColor(value).rgb *
+                    gl_FragColor.rgb = pixelColor(v).rgb *
                         max(dot(normalize(normal), normalize(lightDir)),0.0);
                     gl_FragColor.a = 1.;
                 }
                 else {
-                    gl_FragColor = pixelColor(value)*(1.-transparency);
+                    gl_FragColor = pixelColor(v)*(1.-transparency);
                 }
             }
             """
@@ -300,18 +388,62 @@ class ColorLegend(QGraphicsScene):
     def colorRamp(self):
         return self.__colorRampFile
 
+    def colorParameters(self):
+        """return a dictionary of plain python values and numpy arrays describing
+        the translation of values into color, it can be passed to other threads
+        or processes (see numpymesh.colorize)"""
+        ramp = self.__colorRamp.convertToFormat(QImage.Format_ARGB32)
+        x = ramp.width()/2
+        # the bottom of the ramp image is the min value
+        colorTable = numpy.array([QColor.fromRgba(ramp.pixel(x, y)).getRgbF()
+            for y in reversed(range(ramp.height()))], dtype=numpy.float64)
+        return {'colorTable': colorTable.reshape((-1, 4)),
+                'minValue': float(self.__minValue),
+                'maxValue': float(self.__maxValue),
+                'logscale': self.hasLogScale(),
+                'transparency': float(self.__transparency),
+                'graduated': self.__graduated,
+                'graduation': [(c.redF(), c.greenF(), c.blueF(), float(min_), float(max_))
+                    for c, min_, max_ in self.__graduation]}
+
+    def fingerprint(self):
+        """return a hashable value that changes when the colors of the
+        rendered mesh change, titles and units are not considered"""
+        return (self.__colorRampFile,
+                float(self.__minValue),
+                float(self.__maxValue),
+                self.hasLogScale(),
+                float(self.__transparency),
+                self.__graduated,
+                tuple((c.rgba(), float(min_), float(max_))
+                    for c, min_, max_ in self.__graduation))
+
     def _setUniformsLocation(self, shaders_):
-        """Should be called once the shaders are compiled"""
-        for name in ["transparency", "minValue", "maxValue", "tex", "logscale", "withNormals"]:
-            self.__uniformLocations[name] = glGetUniformLocation(shaders_, name)
+        """Should be called when the shader program is used, before _setUniforms"""
+        if shaders_ not in self.__uniformLocations:
+            self.__uniformLocations[shaders_] = dict((name, glGetUniformLocation(shaders_, name))
+                for name in ["transparency", "minValue", "maxValue", "tex", "logscale", "withNormals",
+                    "graduated", "nbClasses", "sortedClasses", "classRanges", "classColors"])
+        self.__program = shaders_
 
     def _setUniforms(self, glcontext, withNormals=False):
         """Should be called before the draw"""
-        glUniform1f(self.__uniformLocations["transparency"], self.__transparency)
-        glUniform1f(self.__uniformLocations["minValue"], self.__minValue)
-        glUniform1f(self.__uniformLocations["maxValue"], self.__maxValue)
-        glUniform1f(self.__uniformLocations["logscale"], int(self.hasLogScale()))
-        glUniform1f(self.__uniformLocations["withNormals"], int(withNormals))
+        locations = self.__uniformLocations[self.__program]
+        glUniform1f(locations["transparency"], self.__transparency)
+        glUniform1f(locations["minValue"], self.__minValue)
+        glUniform1f(locations["maxValue"], self.__maxValue)
+        glUniform1f(locations["logscale"], int(self.hasLogScale()))
+        glUniform1f(locations["withNormals"], int(withNormals))
+        glUniform1i(locations["graduated"], int(self.__graduated))
+
+        # the uniforms do not exist if classes are compiled in the shader
+        ranges, colors, sorted_ = self.__classes
+        if len(ranges) <= ColorLegend.MAX_CLASSES:
+            glUniform1i(locations["nbClasses"], len(ranges))
+            glUniform1i(locations["sortedClasses"], int(sorted_))
+            if len(ranges):
+                glUniform2fv(locations["classRanges"], len(ranges), ranges)
+                glUniform3fv(locations["classColors"], len(colors), colors)
 
         # texture
         glEnable(GL_TEXTURE_2D)
@@ -352,57 +484,188 @@ class ColorLegend(QGraphicsScene):
         element.setAttribute("graduation", " ".join([g[0].name()+" "+str(g[1])+" "+str(g[2]) for g in self.__graduation]))
         return True
 
+class _GeometryBuffers(object):
+    """vertex and index buffer objects of a geometry shared by the contexts
+    of GlMesh instances, created in a context of the share group"""
+
+    # buffers of collected instances, deleted when a context of the
+    # share group is current
+    released = []
+
+    def __init__(self):
+        self.vtxBuffer, self.idxBuffer = glGenBuffers(2)
+        self.uploaded = False
+
+    def __del__(self):
+        _GeometryBuffers.released += [self.vtxBuffer, self.idxBuffer]
+
 class GlMesh(QObject):
     """This class provides basic function to render results on a 2D mesh.
     The class must be instanciated in the main thread, but the draw function
     can be called in another thread.
     This class encapsulates the transformation between an extend and an image size.
+
+    Instances created with the same geometryKey share their node arrays,
+    spatial index, level of detail hierarchy and, if the contexts of their
+    pixel buffers can be shared, the buffer objects of the geometry.
     """
-    def __init__(self, vtx, idx, legend):
+
+    # above this fraction of visible triangles, all triangles are drawn
+    CULLING_RATIO = .5
+
+    # number of framebuffer objects kept for reuse, one per image size
+    MAX_FRAMEBUFFERS = 4
+
+    # size of the pixel buffer that only holds the context when
+    # framebuffer objects are available
+    CONTEXT_SIZE = QSize(16, 16)
+
+    # arrays and indices shared by geometry key
+    __shared = SharedObjects()
+
+    # hidden widget holding the context shared by pixel buffers, False
+    # if contexts cannot be shared
+    __shareWidget = None
+
+    def __init__(self, vtx, idx, legend, geometryKey=None):
         QObject.__init__(self)
-        self.__vtx = numpy.require(vtx, numpy.float32, 'F')
-        self.__idx = numpy.require(idx, numpy.int32, 'F')
+        self.__geometryKey = geometryKey
+        self.__nodeVtx = GlMesh.__shared.get(self.__sharedKey("vtx"),
+                lambda: GlMesh.__flatVertices(vtx))
+        self.__nodeIdx = GlMesh.__shared.get(self.__sharedKey("idx"),
+                lambda: _readOnly(numpy.require(idx, numpy.int32, 'C')))
         self.__pixBuf = None
+        self.__dynamicTexture = None
+        # framebuffer objects of the pixel buffer context by image size,
+        # least recently used first
+        self.__framebuffers = OrderedDict()
+        self.__useFramebuffers = False
+        # pixel buffer objects the images are read into, in turn
+        self.__packBuffers = [None, None]
+        self.__packSizes = [0, 0]
+        self.__packSlot = 0
         self.__legend = legend
-
-        self.__legend.symbologyChanged.connect(self.__recompileNeeded)
+        # shader programs of the pixel buffer context by source hash
+        self.__programs = {}
 
         self.__colorPerElement = False
-        self.__recompileShader = False
 
-        self.__vtx[:,2] = 0
+        self.__vtx = self.__nodeVtx
+        self.__idx = self.__nodeIdx
+
+        # buffer objects of the pixel buffer context, the geometry is
+        # uploaded once and the values only when they change
+        self.__vtxBuffer = None
+        self.__idxBuffer = None
+        self.__ownVtxBuffer = None
+        self.__ownIdxBuffer = None
+        # the geometry buffers shared with other instances, if any
+        self.__sharing = False
+        self.__geometryBuffers = None
+        self.__valBuffer = None
+        self.__geometryChanged = True
+        self.__uploadedValues = None
+
+        # with primitive index support, element values are read by the
+        # shader from a buffer texture in the order of drawn triangles,
+        # otherwise vertices are duplicated for each element
+        self.__primitiveValues = False
+        self.__valTexture = None
+        self.__valuesDrawn = None
+
+        # spatial index of triangles and triangles drawn for the last extent
+        self.__grid = None
+        self.__visibleBuffer = None
+        self.__visibleExtent = None
+        self.__visibleLevel = None
+        self.__visible = None
+        self.__nbVisible = 0
+
+        # coarse versions of the mesh, only the level in use is uploaded
+        self.__hierarchy = None
+        # (MeshCacheEntry, prefix) the indices are stored in, if any
+        self.__indexCache = None
+        self.__lodVtxBuffer = None
+        self.__lodIdxBuffer = None
+        self.__lodLevel = None
+        self.__lodIdx = None
+        self.__lodNbIdx = 0
+        self.__valuesLevel = None
+
+    def setLegend(self, legend):
+        self.__legend = legend
+
+    def __sharedKey(self, name):
+        return (name, self.__geometryKey) if self.__geometryKey is not None else None
+
+    def setIndexCache(self, entry, prefix=""):
+        """set the MeshCacheEntry the spatial index and hierarchy of the
+        current coordinates are stored in, under names starting with
+        prefix, so that they are read instead of built by next sessions"""
+        self.__indexCache = (entry, prefix) if entry else None
+
+    def __index(self, name, fromArrays, build):
+        if self.__indexCache is None:
+            return build()
+        entry, prefix = self.__indexCache
+        return entry.index(prefix + name + ".", fromArrays, build)
+
+    @staticmethod
+    def __flatVertices(vtx):
+        """return a read only float32 copy of vtx with z set to 0"""
+        flat = numpy.require(vtx, numpy.float32, 'C').copy()
+        flat[:,2] = 0
+        return _readOnly(flat)
 
-    def __recompileNeeded(self):
-        self.__recompileShader = True
+    @staticmethod
+    def __contextShareWidget():
+        """return the widget whose context is shared by the pixel buffers,
+        None if it cannot be created"""
+        if GlMesh.__shareWidget is None:
+            widget = QGLWidget()
+            GlMesh.__shareWidget = widget if widget.isValid() else False
+        return GlMesh.__shareWidget or None
+
+    def __tripled(self):
+        """return True if vertices are duplicated for each element"""
+        return self.__colorPerElement and not self.__primitiveValues
+
+    def __updateGeometry(self):
+        if self.__tripled():
+            # we duplicate vertices
+            with stage("elementExpansion"):
+                self.__vtx, self.__idx = elementGeometry(self.__nodeVtx, self.__nodeIdx)
+        else:
+           self.__idx = self.__nodeIdx
+           self.__vtx = self.__nodeVtx
+        self.__geometryChanged = True
+        self.__uploadedValues = None
+        self.__visibleExtent = None
+        self.__lodLevel = None
 
     def setColorPerElement(self, flag):
         if self.__colorPerElement == flag:
             return # nothing to do
         self.__colorPerElement = flag
-        if self.__colorPerElement:
-            # we duplicate vertices
-            idx = self.__idx
-            self.__origVtx = self.__vtx
-            self.__vtx = numpy.concatenate((
-                    self.__origVtx[self.__idx[:,0]],
-                    self.__origVtx[self.__idx[:,1]],
-                    self.__origVtx[self.__idx[:,2]]))
-            self.__origIdx = self.__idx
-            nbElem = len(self.__idx)
-            self.__idx = numpy.reshape(
-                numpy.array([numpy.arange(nbElem),
-                             numpy.arange(nbElem, 2*nbElem),
-                             numpy.arange(2*nbElem, 3*nbElem)]),
-                (3,-1)).transpose()
-        else:
-           self.__idx = self.__origIdx
-           self.__vtx = self.__origVtx
-
+        self.__updateGeometry()
 
     def colorPerElement(self):
         return self.__colorPerElement
 
-    def __compileShaders(self):
+    def __program(self):
+        """return the shader program for the legend, programs are compiled
+        once per context and cached by source, the context must be current"""
+        source = self.__legend._fragmentShader(
+                self.__colorPerElement and self.__primitiveValues)
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        if key not in self.__programs:
+            with stage("shaderCompile"):
+                self.__programs[key] = self.__compileShaders(source)
+        program = self.__programs[key]
+        self.__legend._setUniformsLocation(program)
+        return program
+
+    def __compileShaders(self, fragmentSource):
         vertex_shader = shaders.compileShader("""
             varying float value;
             varying float w;
@@ -418,14 +681,14 @@ class GlMesh(QObject):
             }
             """, GL_VERTEX_SHADER)
 
-        fragment_shader = shaders.compileShader(
-            self.__legend._fragmentShader(), GL_FRAGMENT_SHADER)
+        fragment_shader = shaders.compileShader(fragmentSource, GL_FRAGMENT_SHADER)
 
-        self.__shaders = shaders.compileProgram(vertex_shader, fragment_shader)
-        self.__legend._setUniformsLocation(self.__shaders)
-        self.__recompileShader = False
+        return shaders.compileProgram(vertex_shader, fragment_shader)
 
     def __resize(self, roundupImageSize):
+        """create the pixel buffer whose context holds the buffer objects,
+        shaders and framebuffer objects, images are rendered in the pixel
+        buffer itself only if framebuffer objects are not supported"""
         # QGLPixelBuffer size must be power of 2
         assert roundupImageSize == roundUpSize(roundupImageSize)
 
@@ -434,48 +697,325 @@ class GlMesh(QObject):
         fmt = QGLFormat()
         fmt.setAlpha(True)
 
-        self.__pixBuf = QGLPixelBuffer(roundupImageSize, fmt)
+        if self.__pixBuf:
+            self.__releaseContextObjects()
+        # framebuffer objects of the previous context are released with it
+        self.__framebuffers = OrderedDict()
+        shareWidget = GlMesh.__contextShareWidget()
+        self.__pixBuf = QGLPixelBuffer(roundupImageSize, fmt, shareWidget)
         assert self.__pixBuf.format().alpha()
         self.__pixBuf.makeCurrent()
-        self.__pixBuf.bindToDynamicTexture(self.__pixBuf.generateDynamicTexture())
-        self.__compileShaders()
+        # buffer objects are shared with the other pixel buffers
+        self.__sharing = shareWidget is not None \
+                and QGLContext.areSharing(QGLContext.currentContext(), shareWidget.context())
+        self.__geometryBuffers = None
+        self.__useFramebuffers = QGLFramebufferObject.hasOpenGLFramebufferObjects()
+        self.__dynamicTexture = self.__pixBuf.generateDynamicTexture()
+        self.__pixBuf.bindToDynamicTexture(self.__dynamicTexture)
+        self.__programs = {}
+        self.__ownVtxBuffer, self.__ownIdxBuffer, self.__valBuffer, self.__visibleBuffer, \
+            self.__lodVtxBuffer, self.__lodIdxBuffer, \
+            self.__packBuffers[0], self.__packBuffers[1] = glGenBuffers(8)
+        self.__packSizes = [0, 0]
+        self.__valTexture = glGenTextures(1)
+        extensions = (glGetString(GL_EXTENSIONS) or "").split()
+        primitiveValues = "GL_EXT_gpu_shader4" in extensions and bool(glTexBuffer)
+        if primitiveValues != self.__primitiveValues:
+            self.__primitiveValues = primitiveValues
+            self.__updateGeometry()
+        self.__geometryChanged = True
+        self.__uploadedValues = None
+        self.__visibleExtent = None
+        self.__lodLevel = None
         self.__pixBuf.doneCurrent()
 
-    def resetCoord(self, vtx):
-        self.__vtx = numpy.require(vtx, numpy.float32, 'F')
+    def __releaseContextObjects(self):
+        """delete the buffer objects, textures and programs created by
+        __resize in the pixel buffer context, they belong to its share
+        group which outlives the pixel buffer"""
+        self.__pixBuf.makeCurrent()
+        buffers = [self.__ownVtxBuffer, self.__ownIdxBuffer, self.__valBuffer,
+                self.__visibleBuffer, self.__lodVtxBuffer, self.__lodIdxBuffer,
+                self.__packBuffers[0], self.__packBuffers[1]]
+        glDeleteBuffers(len(buffers), buffers)
+        glDeleteTextures([self.__valTexture])
+        for program in self.__programs.values():
+            glDeleteProgram(program)
+        self.__programs = {}
+        self.__pixBuf.releaseFromDynamicTexture()
+        self.__pixBuf.deleteTexture(self.__dynamicTexture)
+        self.__pixBuf.doneCurrent()
 
+    def __framebuffer(self, size):
+        """return a framebuffer object of the exact size, reused if one
+        was created for the same size, the pixel buffer context must be
+        current"""
+        key = (size.width(), size.height())
+        if key in self.__framebuffers:
+            fbo = self.__framebuffers.pop(key)
+        else:
+            while len(self.__framebuffers) >= GlMesh.MAX_FRAMEBUFFERS:
+                self.__framebuffers.popitem(last=False)
+            fbo = QGLFramebufferObject(size, QGLFramebufferObject.NoAttachment,
+                    GL_TEXTURE_2D, GL_RGBA8)
+        self.__framebuffers[key] = fbo
+        return fbo
+
+    def resetCoord(self, vtx, geometryKey=None):
+        """set the node coordinates, geometryKey identifies them to share
+        them with other instances"""
+        self.__geometryKey = geometryKey
+        self.__nodeVtx = GlMesh.__shared.get(self.__sharedKey("vtx"),
+                lambda: _readOnly(numpy.require(vtx, numpy.float32, 'C')))
+        self.__grid = None
+        self.__hierarchy = None
+        self.__indexCache = None
+        self.__updateGeometry()
+
+    def resetMesh(self, vtx, idx, geometryKey=None):
+        """set the node coordinates and triangles, e.g. to draw the blocks of
+        a partitioned mesh one after the other in the same context"""
+        self.__geometryKey = geometryKey
+        self.__nodeVtx = GlMesh.__shared.get(self.__sharedKey("vtx"),
+                lambda: GlMesh.__flatVertices(vtx))
+        self.__nodeIdx = GlMesh.__shared.get(self.__sharedKey("idx"),
+                lambda: _readOnly(numpy.require(idx, numpy.int32, 'C')))
+        self.__grid = None
+        self.__hierarchy = None
+        self.__indexCache = None
+        # the buffers of the geometry are looked up on next draw
+        self.__geometryBuffers = None
+        self.__updateGeometry()
+
+    def sharedResources(self):
+        """return (resources, nbBytes), the list of the node arrays, spatial
+        index, hierarchy and buffer objects of the geometry, shared with the
+        instances of the same geometryKey while the list is referenced, and
+        their size in main and GPU memory. Indices and buffer objects are
+        only listed once created by a draw"""
+        resources = [r for r in (self.__nodeVtx, self.__nodeIdx, self.__grid,
+            self.__hierarchy, self.__geometryBuffers) if r is not None]
+        nbBytes = self.__nodeVtx.nbytes + self.__nodeIdx.nbytes
+        if self.__grid is not None:
+            nbBytes += self.__grid.nbytes()
+        if self.__hierarchy is not None:
+            nbBytes += self.__hierarchy.nbytes()
+        if self.__geometryBuffers is not None:
+            nbBytes += self.__vtx.nbytes + self.__idx.nbytes
+        return resources, nbBytes
+
+    def hierarchy(self):
+        """return the level of detail hierarchy, built on first call
+        after each change of coordinates"""
+        if self.__hierarchy is None:
+            self.__hierarchy = GlMesh.__shared.get(self.__sharedKey("hierarchy"),
+                    lambda: self.__index("hierarchy", MeshHierarchy.fromArrays,
+                        lambda: MeshHierarchy(self.__nodeVtx, self.__nodeIdx)))
+        return self.__hierarchy
+
+    def spatialIndex(self):
+        """return the spatial index of triangles, built on first call
+        after each change of coordinates"""
+        if self.__grid is None:
+            self.__grid = GlMesh.__shared.get(self.__sharedKey("grid"),
+                    lambda: self.__index("grid",
+                        lambda arrays: TriangleGrid.fromArrays(self.__nodeVtx, self.__nodeIdx, arrays),
+                        lambda: TriangleGrid(self.__nodeVtx, self.__nodeIdx)))
+        return self.__grid
+
+    def __uploadVisible(self, extent, level):
+        """upload the indices of triangles of the level intersecting the
+        extent, return the buffer and number of indices to draw"""
+        if extent != self.__visibleExtent or level != self.__visibleLevel:
+            if level:
+                visible = self.hierarchy().spatialIndex(level).query(*extent)
+                allIdx = self.__lodIdx
+            else:
+                visible = self.spatialIndex().query(*extent)
+                allIdx = self.__idx
+            if len(visible) > GlMesh.CULLING_RATIO*len(allIdx):
+                self.__nbVisible = None
+                self.__visible = None
+            else:
+                idx = numpy.require(allIdx[visible], numpy.int32, 'C')
+                with stage("upload"):
+                    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.__visibleBuffer)
+                    glBufferData(GL_ELEMENT_ARRAY_BUFFER, idx, GL_STREAM_DRAW)
+                count("bytesUploaded", idx.nbytes)
+                self.__nbVisible = 3*len(visible)
+                self.__visible = visible
+            self.__visibleExtent = extent
+            self.__visibleLevel = level
+        if self.__nbVisible is not None:
+            return (self.__visibleBuffer, self.__nbVisible)
+        return (self.__lodIdxBuffer, self.__lodNbIdx) if level \
+                else (self.__idxBuffer, self.__idx.size)
+
+    def __uploadGeometry(self, level):
+        """upload geometry of the level in buffer objects if it changed,
+        the pixel buffer context must be current"""
+        if _GeometryBuffers.released and self.__sharing:
+            glDeleteBuffers(len(_GeometryBuffers.released), _GeometryBuffers.released)
+            _GeometryBuffers.released = []
+
+        if self.__geometryChanged:
+            key = self.__sharedKey(("buffers", self.__tripled()))
+            if self.__sharing and key is not None:
+                # the instance keeps the shared buffers alive
+                self.__geometryBuffers = GlMesh.__shared.get(key, _GeometryBuffers)
+                self.__vtxBuffer = self.__geometryBuffers.vtxBuffer
+                self.__idxBuffer = self.__geometryBuffers.idxBuffer
+                upload = not self.__geometryBuffers.uploaded
+                self.__geometryBuffers.uploaded = True
+            else:
+                self.__geometryBuffers = None
+                self.__vtxBuffer, self.__idxBuffer = self.__ownVtxBuffer, self.__ownIdxBuffer
+                upload = True
+            if upload:
+                with stage("upload"):
+                    glBindBuffer(GL_ARRAY_BUFFER, self.__vtxBuffer)
+                    glBufferData(GL_ARRAY_BUFFER, self.__vtx, GL_STATIC_DRAW)
+                    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.__idxBuffer)
+                    glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.__idx, GL_STATIC_DRAW)
+                count("bytesUploaded", self.__vtx.nbytes + self.__idx.nbytes)
+            self.__geometryChanged = False
+
+        if level and level != self.__lodLevel:
+            vtx = self.hierarchy().vertices(level)
+            idx = self.hierarchy().triangles(level)
+            if self.__tripled():
+                with stage("elementExpansion"):
+                    vtx, idx = elementGeometry(vtx, idx)
+            vtx = numpy.require(vtx, numpy.float32, 'C')
+            with stage("upload"):
+                glBindBuffer(GL_ARRAY_BUFFER, self.__lodVtxBuffer)
+                glBufferData(GL_ARRAY_BUFFER, vtx, GL_STATIC_DRAW)
+                glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.__lodIdxBuffer)
+                glBufferData(GL_ELEMENT_ARRAY_BUFFER, idx, GL_STATIC_DRAW)
+            count("bytesUploaded", vtx.nbytes + idx.nbytes)
+            self.__lodLevel = level
+            self.__lodIdx = idx
+            self.__lodNbIdx = idx.size
+            self.__visibleExtent = None
+
+    def __uploadValues(self, values, level):
+        """upload values of the level if they changed, the pixel buffer
+        context must be current and the drawn triangles uploaded"""
+        # element values read by primitive index follow the drawn triangles
+        drawn = self.__visible if self.__colorPerElement and self.__primitiveValues \
+                else None
+        # values are compared as they are uploaded, in float32
+        val = numpy.require(values, numpy.float32, 'C')
+        if self.__uploadedValues is None \
+                or level != self.__valuesLevel \
+                or drawn is not self.__valuesDrawn \
+                or not _sameValues(self.__uploadedValues, val):
+            self.__uploadedValues = numpy.array(val)
+            if level:
+                val = self.hierarchy().elementValues(level, val) if self.__colorPerElement \
+                        else self.hierarchy().nodeValues(level, val)
+            if drawn is not None:
+                with stage("elementExpansion"):
+                    val = val[drawn]
+            if self.__tripled():
+                with stage("elementExpansion"):
+                    val = numpy.concatenate((val,val,val))
+            val = numpy.require(val, numpy.float32, 'C')
+            with stage("upload"):
+                glBindBuffer(GL_ARRAY_BUFFER, self.__valBuffer)
+                glBufferData(GL_ARRAY_BUFFER, val, GL_DYNAMIC_DRAW)
+                glBindBuffer(GL_ARRAY_BUFFER, 0)
+            count("bytesUploaded", val.nbytes)
+            self.__valuesLevel = level
+            self.__valuesDrawn = drawn
 
     def image(self, values, imageSize, center, mapUnitsPerPixel, rotation=0):
         """Return the rendered image of a given size for values defined at each vertex
         or at each element depending on setColorPerElement.
         Values are normalized using valueRange = (minValue, maxValue).
         transparency is in the range [0,1]"""
-
+        bgra = self.array(values, imageSize, center, mapUnitsPerPixel, rotation)
+        with stage("crop"):
+            # the image owns its pixels, it may be copied or queued to
+            # another thread once the array is collected
+            return bgra2qimage(bgra).copy()
+
+    def array(self, values, imageSize, center, mapUnitsPerPixel, rotation=0):
+        """Return the rendered image as a (height, width, 4) uint8 array of
+        premultiplied BGRA colors, the memory layout of
+        QImage.Format_ARGB32_Premultiplied"""
+        return next(self.arrays([(values, imageSize, center, mapUnitsPerPixel, rotation)]))
+
+    def arrays(self, frames):
+        """Generate the arrays rendered for a sequence of frames given as
+        (values, imageSize, center, mapUnitsPerPixel, rotation) tuples, e.g.
+        the dates of an animation. Each frame is drawn before the pixels of
+        the previous one are read back, so that drawing and transfer overlap"""
         if QApplication.instance().thread() != QThread.currentThread():
             raise RuntimeError("trying to use gl draw calls in a thread")
 
-        if not len(values):
-            img = QImage(imageSize, QImage.Format_ARGB32)
-            img.fill(Qt.transparent)
-            return img
-
-        roundupSz = roundUpSize(imageSize)
-        if not self.__pixBuf \
-                or roundupSz.width() != self.__pixBuf.size().width() \
-                or roundupSz.height() != self.__pixBuf.size().height():
-            self.__resize(roundupSz)
-
-
-        val = numpy.require(values, numpy.float32) \
-                if not isinstance(values, numpy.ndarray)\
-                else values
-        if self.__colorPerElement:
-            val = numpy.concatenate((val,val,val))
-
+        pending = None
+        for frame in frames:
+            if pending is not None and not self.__useFramebuffers:
+                # the pixel buffer, with its pixel buffer objects, may be
+                # recreated for the size of the next frame
+                yield self.__readback(pending)
+                pending = None
+            current = self.__draw(*frame)
+            if pending is not None:
+                yield self.__readback(pending)
+            pending = current
+        if pending is not None:
+            yield self.__readback(pending)
+
+    def __readback(self, pending):
+        """return the array of a frame drawn by __draw"""
+        slot, size = pending
+        if slot is None:
+            return numpy.zeros((size.height(), size.width(), 4), dtype=numpy.uint8)
+        bgra = numpy.empty((size.height(), size.width(), 4), dtype=numpy.uint8)
         self.__pixBuf.makeCurrent()
+        with stage("readback"):
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, self.__packBuffers[slot])
+            # waits for the end of the transfer, this is the only copy of pixels
+            address = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+            ctypes.memmove(bgra.ctypes.data, address, bgra.nbytes)
+            glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.__pixBuf.doneCurrent()
+        return bgra
+
+    def __draw(self, values, imageSize, center, mapUnitsPerPixel, rotation=0):
+        """draw a frame and start the transfer of its pixels in a pixel buffer
+        object, return the (slot, imageSize) to pass to __readback, slot is
+        None if nothing is drawn"""
+        extent = viewExtent((imageSize.width(), imageSize.height()),
+                center, mapUnitsPerPixel, rotation)
+        if not len(values) or not self.spatialIndex().intersects(*extent):
+            return (None, imageSize)
+
+        if not self.__pixBuf:
+            self.__resize(GlMesh.CONTEXT_SIZE)
+
+        # without framebuffer objects, the pixel buffer is the render
+        # target, its size must be a power of 2
+        targetSize = imageSize if self.__useFramebuffers else roundUpSize(imageSize)
+        if not self.__useFramebuffers and targetSize != self.__pixBuf.size():
+            self.__resize(targetSize)
 
-        if self.__recompileShader:
-            self.__compileShaders()
+        self.__pixBuf.makeCurrent()
+        fbo = self.__framebuffer(imageSize) if self.__useFramebuffers else None
+        if fbo:
+            fbo.bind()
+        glViewport(0, 0, targetSize.width(), targetSize.height())
+
+        # zoomed out, the triangles of a coarse level in view are drawn
+        level = self.hierarchy().level(mapUnitsPerPixel)
+        self.__uploadGeometry(level)
+        vtxBuffer = self.__lodVtxBuffer if level else self.__vtxBuffer
+        idxBuffer, nbIdx = self.__uploadVisible(extent, level)
+        self.__uploadValues(values, level)
+        primitiveValues = self.__colorPerElement and self.__primitiveValues
 
         glClearColor(0., 0., 0., 0.)
         glEnableClientState(GL_VERTEX_ARRAY)
@@ -488,9 +1028,9 @@ class GlMesh(QObject):
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
 
-        # scale
-        glScalef(2./(roundupSz.width()*mapUnitsPerPixel[0]),
-                 2./(roundupSz.height()*mapUnitsPerPixel[1]),
+        # scale, y is flipped so that pixels are read top row first
+        glScalef(2./(targetSize.width()*mapUnitsPerPixel[0]),
+                 -2./(targetSize.height()*mapUnitsPerPixel[1]),
                  1)
         # rotate
         glRotatef(-rotation, 0, 0, 1)
@@ -500,22 +1040,65 @@ class GlMesh(QObject):
                      -center[1],
                      0)
 
-        glUseProgram(self.__shaders)
+        program = self.__program()
+        glUseProgram(program)
 
         self.__legend._setUniforms(self.__pixBuf)
 
-        glVertexPointerf(self.__vtx)
-        glTexCoordPointer(1, GL_FLOAT, 0, val)
-        glDrawElementsui(GL_TRIANGLES, self.__idx)
-
-        img = self.__pixBuf.toImage()
+        with stage("draw"):
+            glBindBuffer(GL_ARRAY_BUFFER, vtxBuffer)
+            glVertexPointer(3, GL_FLOAT, 0, None)
+            if primitiveValues:
+                # the value buffer is read as a texture on unit 1
+                glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+                glActiveTexture(GL_TEXTURE1)
+                glBindTexture(GL_TEXTURE_BUFFER, self.__valTexture)
+                glTexBuffer(GL_TEXTURE_BUFFER, GL_R32F, self.__valBuffer)
+                glActiveTexture(GL_TEXTURE0)
+                glUniform1i(glGetUniformLocation(program, "elementValues"), 1)
+            else:
+                glBindBuffer(GL_ARRAY_BUFFER, self.__valBuffer)
+                glTexCoordPointer(1, GL_FLOAT, 0, None)
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, idxBuffer)
+            glDrawElements(GL_TRIANGLES, nbIdx, GL_UNSIGNED_INT, None)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        count("trianglesDrawn", nbIdx//3)
+
+        # only the requested region is read, centered in a padded pixel
+        # buffer, the transfer to the pixel buffer object is asynchronous
+        self.__packSlot = 1 - self.__packSlot
+        nbBytes = 4*imageSize.width()*imageSize.height()
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.__packBuffers[self.__packSlot])
+        if self.__packSizes[self.__packSlot] != nbBytes:
+            glBufferData(GL_PIXEL_PACK_BUFFER, nbBytes, None, GL_STREAM_READ)
+            self.__packSizes[self.__packSlot] = nbBytes
+        glPixelStorei(GL_PACK_ALIGNMENT, 4)
+        with stage("readback"):
+            glReadPixels((targetSize.width() - imageSize.width())//2,
+                         (targetSize.height() - imageSize.height())//2,
+                         imageSize.width(), imageSize.height(),
+                         GL_BGRA, GL_UNSIGNED_INT_8_8_8_8_REV, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        if fbo:
+            fbo.release()
         self.__pixBuf.doneCurrent()
+        return (self.__packSlot, imageSize)
 
-        return img.copy( .5*(roundupSz.width()-imageSize.width()),
-                         .5*(roundupSz.height()-imageSize.height()),
-                         imageSize.width(), imageSize.height())
 
 
+def _readOnly(array):
+    """return a read only view of array"""
+    array = array.view()
+    array.flags.writeable = False
+    return array
+
+def _sameValues(a, b):
+    """return True if arrays a and b have the same shape and values,
+    NaNs being equal"""
+    return a.shape == b.shape and bool(numpy.all(numpy.logical_or(a == b,
+        numpy.logical_and(numpy.isnan(a), numpy.isnan(b)))))
 
 bgra_dtype = numpy.dtype({'b': (numpy.uint8, 0),
                           'g': (numpy.uint8, 1),
@@ -615,6 +1198,20 @@ def rgb2qimage(rgb):
 	result.ndarray = bgra
 	return result
 
+def bgra2qimage(bgra):
+	"""Wrap the (height, width, 4) uint8 array `bgra` of premultiplied colors
+	in a QImage without copy, the QImage keeps a reference to the array in
+	its `ndarray` attribute.
+
+	ATTENTION: copies of the QImage made on the C++ side (QImage(img), queued
+	signals, painters) share the array memory without keeping it alive, the
+	wrapper must outlive them, or the image be detached with copy()."""
+	bgra = numpy.require(bgra, numpy.uint8, 'C')
+	h, w = bgra.shape[:2]
+	result = QImage(bgra.data, w, h, QImage.Format_ARGB32_Premultiplied)
+	result.ndarray = bgra
+	return result
+
 if __name__ == "__main__":
 
     import sys
@@ -667,5 +1264,12 @@ if __name__ == "__main__":
             )
     img.save('/tmp/test_gl_flat.png')
 
-
-
+    # unchanged values are not uploaded again, float64 and NaN included
+    from instrumentation import Frame, recording
+    mesh.setColorPerElement(False)
+    values = numpy.array((.01, numpy.nan, .5*33.01, 33, 33, .1), dtype=numpy.float64)
+    mesh.array(values, QSize(800,600), (0,0), (8.0/800, 6.0/600))
+    frame = Frame()
+    with recording(frame):
+        mesh.array(values.copy(), QSize(800,600), (0,0), (8.0/800, 6.0/600))
+    assert not frame.counters.get("bytesUploaded"), frame.counters
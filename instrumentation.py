@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    from qgis.core import QgsMessageLog
+except ImportError:
+    QgsMessageLog = None
+
+# stages of a frame, in the order they happen
+STAGES = ("hopWait", "reprojection", "elementExpansion", "shaderCompile",
+        "upload", "draw", "readback", "composite", "crop", "paint", "total")
+
+# counters of a frame
+COUNTERS = ("bytesUploaded", "trianglesDrawn", "cacheHits")
+
+# number of frames kept per layer for percentiles
+WINDOW = 256
+
+# the frame being recorded by the current thread
+_local = threading.local()
+
+class Frame(object):
+    """durations in seconds of the stages of a rendered frame and counters,
+    stages recorded several times are summed"""
+
+    __slots__ = ('start', 'durations', 'counters')
+
+    def __init__(self):
+        self.start = time.time()
+        self.durations = {}
+        self.counters = {}
+
+    def add(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0.) + seconds
+
+    def count(self, counter, n):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+class _Stage(object):
+    __slots__ = ('frame', 'name', 'start')
+
+    def __init__(self, frame, name):
+        self.frame = frame
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        self.frame.add(self.name, time.time() - self.start)
+
+class _NoStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+_NO_STAGE = _NoStage()
+
+def currentFrame():
+    """return the frame recorded by the current thread, None if the
+    thread does not record"""
+    return getattr(_local, 'frame', None)
+
+def stage(name):
+    """return a context manager adding its duration to the stage of the
+    current frame, it does nothing if the thread does not record"""
+    frame = getattr(_local, 'frame', None)
+    return _NO_STAGE if frame is None else _Stage(frame, name)
+
+def count(counter, n):
+    """add n to the counter of the current frame, if any"""
+    frame = getattr(_local, 'frame', None)
+    if frame is not None:
+        frame.count(counter, n)
+
+@contextmanager
+def recording(frame):
+    """make frame, which may be None, the current frame of the thread"""
+    previous = getattr(_local, 'frame', None)
+    _local.frame = frame
+    try:
+        yield frame
+    finally:
+        _local.frame = previous
+
+class Instrumentation(object):
+    """Per layer recorder of the last frames with their stage durations and
+    counters, disabled by default.
+
+    A frame is started with frame(), made current in the threads that
+    work on it with recording() and stored with record(), the functions
+    stage() and count() of this module add to the current frame of the
+    thread, they cost a thread local lookup when nothing is recorded.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.__enabled = False
+        self.__lock = threading.Lock()
+        self.__frames = deque(maxlen=window)
+        self.__nbFrames = 0
+
+    def setEnabled(self, flag):
+        self.__enabled = flag
+
+    def isEnabled(self):
+        return self.__enabled
+
+    def frame(self):
+        """return a new Frame, None if disabled"""
+        return Frame() if self.__enabled else None
+
+    def record(self, frame):
+        """store a frame, its total duration is the time since its start
+        if the 'total' stage is not set"""
+        if frame is None:
+            return
+        if 'total' not in frame.durations:
+            frame.durations['total'] = time.time() - frame.start
+        with self.__lock:
+            self.__frames.append(frame)
+            self.__nbFrames += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__frames.clear()
+            self.__nbFrames = 0
+
+    def frames(self):
+        """return the list of the last frames, oldest first"""
+        with self.__lock:
+            return list(self.__frames)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """return a dictionary with the number of 'frames' recorded, the
+        number of frames in the 'window' and for each 'stages' and
+        'counters' the number of frames it appears in, its 'max' and
+        percentiles over the window, e.g. 'p90'. Durations are in seconds"""
+        with self.__lock:
+            frames = list(self.__frames)
+            nbFrames = self.__nbFrames
+        summary = {'frames': nbFrames, 'window': len(frames), 'stages': {}, 'counters': {}}
+        for kind, names, attribute in (('stages', STAGES, 'durations'),
+                                       ('counters', COUNTERS, 'counters')):
+            for name in names:
+                values = [getattr(f, attribute)[name] for f in frames if name in getattr(f, attribute)]
+                if not values:
+                    continue
+                entry = {'count': len(values), 'max': max(values)}
+                for p, v in zip(percentiles, numpy.percentile(values, percentiles)):
+                    entry['p%g'%p] = float(v)
+                summary[kind][name] = entry
+        return summary
+
+    def toJson(self, **kwargs):
+        """return the summary as a JSON string, kwargs are passed to
+        json.dumps"""
+        return json.dumps(self.summary(), **kwargs)
+
+    def log(self, title, tag="meshlayer"):
+        """write the median and 90th percentile of each stage and counter
+        to the QGIS message log"""
+        summary = self.summary((50, 90))
+        lines = ["%s: %d frames"%(title, summary['frames'])]
+        for name in STAGES:
+            if name in summary['stages']:
+                s = summary['stages'][name]
+                lines.append("%20s p50 %9.2fms p90 %9.2fms"%(name, 1e3*s['p50'], 1e3*s['p90']))
+        for name in COUNTERS:
+            if name in summary['counters']:
+                s = summary['counters'][name]
+                lines.append("%20s p50 %12d p90 %12d"%(name, s['p50'], s['p90']))
+        text = '\n'.join(lines)
+        if QgsMessageLog is not None:
+            QgsMessageLog.logMessage(text, tag, QgsMessageLog.INFO)
+        return text
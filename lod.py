@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+from math import sqrt
+
+from spatialindex import TriangleGrid
+
+class MeshHierarchy(object):
+    """Multi-resolution versions of a triangular mesh built by vertex clustering.
+
+    Level 0 is the mesh itself, the nodes of level i are the clusters of
+    nodes falling in the same cell of a grid of size cellSize(i), which
+    doubles from one level to the next. Coarse levels keep, for each
+    original node, the index of its cluster and, for each coarse triangle,
+    the index of one original triangle, so that node values are averaged
+    and element values picked from the original mesh. The triangles of a
+    level in view are found with its spatial index.
+    """
+
+    # levels are built until they have less triangles than this
+    MIN_TRIANGLES = 10000
+
+    def __init__(self, vtx, idx, minTriangles=MIN_TRIANGLES):
+        vtx = numpy.asarray(vtx)
+        idx = numpy.asarray(idx).reshape((-1, 3))
+        # (cellSize, vtx, idx, nodeCluster, clusterSize, element) for each coarse level
+        self.__levels = []
+        # spatial indices of the coarse levels by level, built on first use
+        self.__grids = {}
+        if len(idx) <= minTriangles:
+            return
+        xmin, ymin = vtx[:, 0].min(), vtx[:, 1].min()
+        area = max((vtx[:, 0].max() - xmin)*(vtx[:, 1].max() - ymin), 1e-24)
+        # mean triangle size, the first level has about four times less triangles
+        cellSize = 2*sqrt(area/len(idx))
+        nbTriangles = len(idx)
+        while nbTriangles > minTriangles:
+            level = MeshHierarchy.__cluster(vtx, idx, xmin, ymin, cellSize)
+            if len(level[2]) >= .9*nbTriangles:
+                # clustering does not simplify the mesh anymore
+                cellSize *= 2
+                continue
+            self.__levels.append(level)
+            nbTriangles = len(level[2])
+            cellSize *= 2
+
+    @staticmethod
+    def __cluster(vtx, idx, xmin, ymin, cellSize):
+        ix = numpy.floor((vtx[:, 0] - xmin)/cellSize).astype(numpy.int64)
+        iy = numpy.floor((vtx[:, 1] - ymin)/cellSize).astype(numpy.int64)
+        key, nodeCluster = numpy.unique(ix*(iy.max() + 1) + iy, return_inverse=True)
+        nbNodes = len(key)
+        count = numpy.bincount(nodeCluster, minlength=nbNodes)
+        coarseVtx = numpy.empty((nbNodes, vtx.shape[1]), dtype=numpy.float32)
+        for dim in range(vtx.shape[1]):
+            coarseVtx[:, dim] = numpy.bincount(nodeCluster,
+                    weights=vtx[:, dim], minlength=nbNodes)/count
+
+        tri = nodeCluster[idx]
+        # triangles with two nodes in the same cluster are dropped, triangles
+        # with the same nodes are merged
+        keep = numpy.nonzero(numpy.logical_and(numpy.logical_and(
+            tri[:, 0] != tri[:, 1], tri[:, 1] != tri[:, 2]), tri[:, 2] != tri[:, 0]))[0]
+        srt = numpy.sort(tri[keep], axis=1)
+        # rows are compared as such, a key combining the three nodes would
+        # overflow beyond two million clusters. The sort is stable so the
+        # first triangle of equal ones is kept
+        order = numpy.lexsort((srt[:, 2], srt[:, 1], srt[:, 0]))
+        srt = srt[order]
+        first = numpy.ones((len(order),), dtype=bool)
+        first[1:] = numpy.any(srt[1:] != srt[:-1], axis=1)
+        element = keep[numpy.sort(order[first])]
+        return (cellSize, coarseVtx, numpy.require(tri[element], numpy.int32, 'C'),
+                numpy.require(nodeCluster, numpy.int32), count, element)
+
+    def arrays(self):
+        """return the dictionary of arrays defining the levels and the
+        spatial indices built so far, see fromArrays"""
+        arrays = {'cellSize': numpy.array([coarse[0] for coarse in self.__levels],
+            dtype=numpy.float64)}
+        for i, coarse in enumerate(self.__levels):
+            for name, array in zip(("vertices", "triangles", "nodeCluster",
+                    "clusterSize", "elements"), coarse[1:]):
+                arrays["%s_%d"%(name, i + 1)] = array
+        for level, grid in self.__grids.items():
+            for name, array in grid.arrays().items():
+                arrays["grid_%d_%s"%(level, name)] = array
+        return arrays
+
+    @staticmethod
+    def fromArrays(arrays):
+        """return the hierarchy defined by arrays, as returned by arrays(),
+        without building it, e.g. from memory maps shared by several
+        processes"""
+        hierarchy = MeshHierarchy.__new__(MeshHierarchy)
+        hierarchy.__levels = [(float(cellSize),) + tuple(arrays["%s_%d"%(name, i + 1)]
+                for name in ("vertices", "triangles", "nodeCluster", "clusterSize", "elements"))
+            for i, cellSize in enumerate(arrays['cellSize'])]
+        hierarchy.__grids = {}
+        for level in range(1, len(hierarchy.__levels) + 1):
+            prefix = "grid_%d_"%level
+            grid = dict((name[len(prefix):], array) for name, array in arrays.items()
+                    if name.startswith(prefix))
+            if grid:
+                hierarchy.__grids[level] = TriangleGrid.fromArrays(
+                        hierarchy.vertices(level), hierarchy.triangles(level), grid)
+        return hierarchy
+
+    def nbLevels(self):
+        """return the number of levels, the original mesh included"""
+        return len(self.__levels) + 1
+
+    def cellSize(self, level):
+        return self.__levels[level - 1][0] if level else 0.
+
+    def level(self, mapUnitsPerPixel):
+        """return the coarsest level whose clusters are not larger than a pixel"""
+        pixelSize = min(mapUnitsPerPixel)
+        level = 0
+        for i, coarse in enumerate(self.__levels):
+            if coarse[0] <= pixelSize:
+                level = i + 1
+        return level
+
+    def vertices(self, level):
+        return self.__levels[level - 1][1]
+
+    def triangles(self, level):
+        return self.__levels[level - 1][2]
+
+    def spatialIndex(self, level):
+        """return the spatial index of the triangles of a coarse level, built
+        on first call"""
+        grid = self.__grids.get(level)
+        if grid is None:
+            grid = TriangleGrid(self.vertices(level), self.triangles(level))
+            self.__grids[level] = grid
+        return grid
+
+    def elements(self, level):
+        """return for each triangle of level the index of an original triangle"""
+        return self.__levels[level - 1][5]
+
+    def nodes(self, level):
+        """return for each node of level the index of an original node of its cluster"""
+        unused, first = numpy.unique(self.__levels[level - 1][3], return_index=True)
+        return first
+
+    def nbytes(self):
+        """return the size of the levels in bytes"""
+        return sum(numpy.asarray(array).nbytes for array in self.arrays().values())
+
+    def nodeValues(self, level, values):
+        """return values at the nodes of level, the mean of original node values"""
+        nodeCluster, count = self.__levels[level - 1][3:5]
+        return numpy.require(numpy.bincount(nodeCluster,
+            weights=numpy.asarray(values, dtype=numpy.float64).reshape((-1,)),
+            minlength=len(count))/count, numpy.float32)
+
+    def elementValues(self, level, values):
+        """return values at the triangles of level"""
+        return numpy.asarray(values)[self.elements(level)]
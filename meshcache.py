@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+from qgis.core import QgsApplication
+
+import numpy
+import os
+import shutil
+import hashlib
+import tempfile
+
+# size of the cache beyond which the least recently used entries are removed
+MAX_BYTES = 4 << 30
+
+# name of the file of an entry holding the key of its provider and uri
+SOURCE_FILE = "source"
+
+def _replace(src, dst):
+    """rename src to dst, replacing dst atomically if it exists"""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    elif os.name == 'nt':
+        import ctypes
+        # MOVEFILE_REPLACE_EXISTING
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst), 1):
+            raise OSError("cannot rename %s to %s"%(src, dst))
+    else:
+        os.rename(src, dst)
+
+class MeshCacheEntry(object):
+    """Arrays of one mesh stored as .npy files in a directory, they
+    are memory mapped when read"""
+
+    def __init__(self, directory):
+        self.__directory = directory
+
+    def directory(self):
+        return self.__directory
+
+    def __file(self, name):
+        return os.path.join(self.__directory, name + ".npy")
+
+    def array(self, name):
+        """return the read-only memory map of the stored array, None if
+        it is not stored"""
+        if not os.path.exists(self.__file(name)):
+            return None
+        try:
+            return numpy.load(self.__file(name), mmap_mode='r')
+        except (IOError, ValueError):
+            # truncated or corrupted file
+            return None
+
+    def setArray(self, name, array):
+        """store an array, the file is written aside and renamed so that
+        readers never see a partial file"""
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=self.__directory)
+        try:
+            with os.fdopen(fd, 'wb') as fil:
+                numpy.save(fil, numpy.asarray(array))
+            _replace(tmp, self.__file(name))
+        except (IOError, OSError):
+            # e.g. a full disk, the partial file is not left behind
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def get(self, name, compute):
+        """return the stored array, compute() is called and its
+        result stored if it is not. The result is returned even if it
+        cannot be stored"""
+        array = self.array(name)
+        if array is None:
+            array = compute()
+            try:
+                self.setArray(name, array)
+            except (IOError, OSError):
+                pass
+        return array
+
+    def arrays(self, prefix):
+        """return the dictionary of the arrays stored by setArrays under
+        prefix, None if they are not all stored"""
+        names = self.array(prefix + "names")
+        if names is None:
+            return None
+        arrays = {}
+        for name in names:
+            array = self.array(prefix + str(name))
+            if array is None:
+                return None
+            arrays[str(name)] = array
+        return arrays
+
+    def setArrays(self, prefix, arrays):
+        """store a dictionary of arrays, the list of their names is
+        written last so that arrays() never returns a partial set"""
+        for name, array in arrays.items():
+            self.setArray(prefix + name, array)
+        self.setArray(prefix + "names", numpy.array(sorted(arrays.keys())))
+
+    def index(self, prefix, fromArrays, build):
+        """return fromArrays(arrays) of the arrays stored under prefix,
+        if they are not stored the object is built by build() and its
+        arrays(), e.g. those of a TriangleGrid or a MeshHierarchy,
+        stored for next sessions"""
+        arrays = self.arrays(prefix)
+        if arrays is not None:
+            try:
+                return fromArrays(arrays)
+            except (KeyError, ValueError):
+                # stored by another version
+                pass
+        obj = build()
+        try:
+            self.setArrays(prefix, obj.arrays())
+        except (IOError, OSError):
+            pass
+        return obj
+
+class MeshCache(object):
+    """On disk cache of mesh coordinates, connectivity and derived arrays.
+
+    Entries are keyed by the provider key and URI and by the size and
+    modification time of the provider source files, a change of the
+    source files gives a new entry and removes the previous entries of
+    the provider. Providers that do not report their source files (see
+    MeshDataProvider.sourceFiles) are not cached.
+
+    The least recently used entries are removed when the cache grows
+    beyond maxBytes.
+    """
+
+    def __init__(self, directory=None, maxBytes=MAX_BYTES):
+        self.__directory = directory or os.path.join(
+                QgsApplication.qgisSettingsDirPath(), "meshlayer_cache")
+        self.__maxBytes = maxBytes
+
+    def directory(self):
+        return self.__directory
+
+    @staticmethod
+    def key(provider):
+        """return the key of the provider entry, None if the provider
+        cannot be cached"""
+        files = provider.sourceFiles()
+        if not files:
+            return None
+        sha = hashlib.sha1()
+        sha.update(provider.name().encode('utf-8'))
+        sha.update(provider.dataSourceUri().encode('utf-8'))
+        for fil in sorted(files):
+            stat = os.stat(fil)
+            sha.update(("%s %d %r"%(fil, stat.st_size, stat.st_mtime)).encode('utf-8'))
+        return sha.hexdigest()
+
+    @staticmethod
+    def sourceKey(provider):
+        """return the key of the provider key and uri, shared by the
+        entries of all versions of its source files"""
+        sha = hashlib.sha1()
+        sha.update(provider.name().encode('utf-8'))
+        sha.update(provider.dataSourceUri().encode('utf-8'))
+        return sha.hexdigest()
+
+    def entry(self, provider):
+        """return the cache entry of the provider, None if the provider
+        cannot be cached"""
+        key = MeshCache.key(provider)
+        if not key:
+            return None
+        directory = os.path.join(self.__directory, key)
+        sourceKey = MeshCache.sourceKey(provider)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process
+                pass
+        with open(os.path.join(directory, SOURCE_FILE), 'w') as fil:
+            fil.write(sourceKey)
+        # the modification time orders entries by use
+        os.utime(directory, None)
+        self.prune(key, sourceKey)
+        return MeshCacheEntry(directory)
+
+    def prune(self, keep=None, sourceKey=None):
+        """remove the entries of sourceKey other than keep, then the least
+        recently used entries other than keep while the cache is larger
+        than maxBytes. Entries in use by another process may not be
+        removed"""
+        if not os.path.isdir(self.__directory):
+            return
+        entries = []
+        for key in os.listdir(self.__directory):
+            directory = os.path.join(self.__directory, key)
+            if key == keep or not os.path.isdir(directory):
+                continue
+            try:
+                with open(os.path.join(directory, SOURCE_FILE)) as fil:
+                    stale = sourceKey is not None and fil.read() == sourceKey
+            except IOError:
+                stale = False
+            if stale:
+                shutil.rmtree(directory, ignore_errors=True)
+            else:
+                entries.append(directory)
+
+        size = lambda d: sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d)) \
+                if os.path.isdir(d) else 0
+        nbBytes = sum(size(d) for d in entries) + (size(os.path.join(self.__directory, keep)) if keep else 0)
+        for directory in sorted(entries, key=os.path.getmtime):
+            if nbBytes <= self.__maxBytes:
+                break
+            nbBytes -= size(directory)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def clear(self):
+        if os.path.isdir(self.__directory):
+            shutil.rmtree(self.__directory)
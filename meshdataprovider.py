@@ -5,6 +5,18 @@ from qgis.core import *
 from PyQt4.QtCore import *
 
 import numpy
+import shlex
+import threading
+
+def normalizedUri(uri):
+    """return a hashable form of a data source uri that does not depend
+    on the order of its parameters and on spaces between them"""
+    uri = unicode(uri)
+    try:
+        return tuple(sorted(p.decode('utf-8') for p in shlex.split(uri.encode('utf-8'))))
+    except ValueError:
+        # unbalanced quotes
+        return (uri.strip(),)
 
 class MeshDataProvider(QgsDataProvider):
     """base class for mesh data providers, please note that this class
@@ -20,6 +32,7 @@ class MeshDataProvider(QgsDataProvider):
         QgsDataProvider.__init__(self, uri)
         self.__didx = 0
         self.__dates = []
+        self.__dateLock = threading.RLock()
 
     def name(self):
         return MeshDataProvider.PROVIDER_KEY
@@ -43,6 +56,20 @@ class MeshDataProvider(QgsDataProvider):
         watch out: indices start at zero"""
         return numpy.empty((0,3), dtype=numpy.int32)
 
+    def geometryKey(self):
+        """return a hashable key identifying the node coordinates and
+        triangles, layers of providers with the same key share them.
+        Providers reading several variables of a file with one uri per
+        variable should reimplement this method to return the same key
+        for all variables"""
+        return (self.name(), normalizedUri(self.dataSourceUri()))
+
+    def sourceFiles(self):
+        """return the list of files the mesh is read from, their size and
+        modification time are used to validate the on disk mesh cache,
+        providers that do not reimplement this method are not cached"""
+        return []
+
     def setDates(self, dates):
         """set list of dates in case node values vary with time"""
         self.__dates = dates
@@ -53,9 +80,16 @@ class MeshDataProvider(QgsDataProvider):
 
     def setDate(self, didx):
         """in case the node values can vary"""
-        self.__didx = didx
+        with self.__dateLock:
+            self.__didx = didx
         self.dataChanged.emit()
 
+    def dateLock(self):
+        """return the reentrant lock held while the current date is changed
+        by setDate or dateValues, threads reading the values of the
+        current date while another thread may change it should hold it"""
+        return self.__dateLock
+
     def date(self):
         return self.__didx
 
@@ -70,6 +104,30 @@ class MeshDataProvider(QgsDataProvider):
         """return values at elements"""
         return numpy.empty((0,), dtype=numpy.float32)
 
+    def dateValues(self, didx):
+        """return node values, or element values if valueAtElement(), for
+        the date index didx. The current date is changed and restored
+        holding dateLock(), so the values of another date are only safe
+        to read concurrently with readers holding the lock. Providers that
+        can read a date directly should reimplement this method and
+        threadSafeDateValues"""
+        with self.__dateLock:
+            current = self.__didx
+            if didx == current:
+                return self.elementValues() if self.valueAtElement() else self.nodeValues()
+            blocked = self.blockSignals(True)
+            try:
+                self.setDate(didx)
+                return self.elementValues() if self.valueAtElement() else self.nodeValues()
+            finally:
+                self.setDate(current)
+                self.blockSignals(blocked)
+
+    def threadSafeDateValues(self):
+        """return True if dateValues reads a date without changing the
+        current date and can be called from any thread"""
+        return False
+
     def dataSourceUri(self):
         return self.__uri.uri()
 
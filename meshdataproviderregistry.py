@@ -1,5 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import numpy
+import weakref
+
+from meshdataprovider import normalizedUri
+from reprojection import CoordinateCache
+
+def _readOnly(array):
+    """return a read only view of array"""
+    array = numpy.asarray(array).view()
+    array.flags.writeable = False
+    return array
+
+class MeshGeometry(object):
+    """Read only node coordinates and triangles of a mesh and the cache of
+    their reprojections, shared by the layers of the providers with the
+    same geometryKey"""
+
+    def __init__(self, key, nodeCoord, triangles):
+        self.key = key
+        self.nodeCoord = _readOnly(nodeCoord)
+        self.triangles = _readOnly(triangles)
+        self.coordinateCache = CoordinateCache()
+
 class MeshDataProviderRegistry(object):
     """a singleton to register MeshDataProviders"""
 
@@ -8,12 +31,23 @@ class MeshDataProviderRegistry(object):
     class __MeshDataProviderRegistry(object):
         def __init__(self):
             self.__providers = {}
+            # shared providers and their reference count by (key, normalized uri)
+            self.__pool = {}
+            # geometries by geometry key, kept while they are referenced
+            self.__geometries = weakref.WeakValueDictionary()
 
-        def provider(self, providerKey, dataSource):
-            """returns a mesh provider instance"""
+        def provider(self, providerKey, dataSource, shared=True):
+            """returns a mesh provider instance, if shared the instance is
+            pooled by providerKey and normalized dataSource and returned to
+            the next callers until they all release it"""
             if not providerKey:
                 raise RuntimeError("Missing providerKey")
 
+            key = (providerKey, normalizedUri(dataSource))
+            if shared and key in self.__pool:
+                self.__pool[key][1] += 1
+                return self.__pool[key][0]
+
             prvdr = self.__providers[providerKey](dataSource)
 
             if not prvdr:
@@ -21,8 +55,45 @@ class MeshDataProviderRegistry(object):
             if not prvdr.isValid():
                 raise RuntimeError("Invalid provider "+providerKey+" from uri:"+dataSource)
 
+            if shared:
+                self.__pool[key] = [prvdr, 1]
             return prvdr
 
+        def release(self, provider):
+            """release a provider returned by provider(), it is stopped if it
+            has a stop method when it is not used anymore: at once if it is
+            not shared, otherwise when its last user releases it and it is
+            removed from the pool"""
+            for key, entry in list(self.__pool.items()):
+                if entry[0] is provider:
+                    entry[1] -= 1
+                    if entry[1]:
+                        return
+                    del self.__pool[key]
+                    break
+            if hasattr(provider, 'stop'):
+                provider.stop()
+
+        def referenceCount(self, provider):
+            """return the number of users of a pooled provider"""
+            for prvdr, count in self.__pool.values():
+                if prvdr is provider:
+                    return count
+            return 0
+
+        def geometry(self, provider, load=None):
+            """return the MeshGeometry of the provider, shared with the other
+            providers of the same geometryKey while it is referenced.
+            load() returns (nodeCoord, triangles), the provider arrays by
+            default"""
+            key = provider.geometryKey()
+            geometry = self.__geometries.get(key)
+            if geometry is None:
+                nodeCoord, triangles = load() if load else (provider.nodeCoord(), provider.triangles())
+                geometry = MeshGeometry(key, nodeCoord, triangles)
+                self.__geometries[key] = geometry
+            return geometry
+
         def addDataProviderType(self, providerKey, type_):
             """add provider type to registry"""
             self.__providers[providerKey] = type_
@@ -18,14 +18,19 @@ import time
 import traceback
 
 from glmesh import GlMesh, ColorLegend
+from numpymesh import NumpyMesh
 from opengl_layer import OpenGlLayer
 
 from meshdataproviderregistry import MeshDataProviderRegistry
 from meshlayerpropertydialog import MeshLayerPropertyDialog
 
-from utilities import Timer
-from shapely.ops import linemerge
-from shapely.geometry import LineString, MultiLineString
+from instrumentation import stage
+from contour import MarchingTriangles, elementToNodeValues, meshEdges
+from reprojection import crsKey, cacheName
+from spatialindex import TriangleGrid
+from meshcache import MeshCache
+from meshstatistics import MeshStatistics
+from partitionedmesh import PartitionedMesh, PartitionedMeshDataProvider
 
 class MeshLayerType(QgsPluginLayerType):
     def __init__(self):
@@ -102,16 +107,53 @@ class MeshLayer(OpenGlLayer):
 
     LAYER_TYPE="mesh_layer"
 
+    # directory of the on disk mesh cache, None for the default one
+    MESH_CACHE_DIRECTORY = None
+
+    # mesh renderers, the numpy one does not need an OpenGL context
+    BACKENDS = {"opengl": GlMesh, "numpy": NumpyMesh}
+
+    # default memory budget of the blocks of partitioned meshes in bytes
+    BLOCK_MEMORY_BUDGET = 1 << 30
+
     def __init__(self, uri=None, name=None, providerKey=None):
         """optional parameters are here only in the case the layer is created from
         .gqs file, without them the layer is invalid"""
         OpenGlLayer.__init__(self, MeshLayer.LAYER_TYPE, name)
         self.__meshDataProvider = None
         self.__legend = None
+        self.__contour = None
+        self.__pointLocator = None
+        # node coordinates and triangles shared with the layers of the same
+        # mesh, each layer has its own provider holding its date and uri
+        self.__geometry = None
+        self.__meshVersion = 0
+        # bumped when the values of the current date change
+        self.__dataVersion = 0
+        self.__date = None
+        self.__meshCacheEntry = None
+        self.__statistics = None
+        self.__backend = "opengl"
+        self.__blockMemoryBudget = MeshLayer.BLOCK_MEMORY_BUDGET
         if uri:
-            self.__load(MeshDataProviderRegistry.instance().provider(providerKey, uri))
+            self.__load(MeshDataProviderRegistry.instance().provider(providerKey, uri, False))
         self.__destCRS = None
-        self.__timing = False
+        QgsMapLayerRegistry.instance().layerWillBeRemoved.connect(self.__layerWillBeRemoved)
+
+    def __releaseProvider(self):
+        """stop using the provider"""
+        if self.__meshDataProvider:
+            self.__meshDataProvider.dataChanged.disconnect(self.__dataChanged)
+            MeshDataProviderRegistry.instance().release(self.__meshDataProvider)
+        if self.__statistics:
+            self.__statistics.stop()
+
+    def __layerWillBeRemoved(self, layerId):
+        if layerId == self.id():
+            self.__releaseProvider()
+            self.__meshDataProvider = None
+            self.__statistics = None
+            self.__geometry = None
 
     def setColorLegend(self, legend):
         if self.__legend:
@@ -119,6 +161,7 @@ class MeshLayer(OpenGlLayer):
         self.__legend = legend
         self.__glMesh.setLegend(self.__legend)
         self.__legend.symbologyChanged.connect(self.__symbologyChanged)
+        self.clearImageCache()
 
     def colorLegend(self):
         return self.__legend
@@ -126,22 +169,123 @@ class MeshLayer(OpenGlLayer):
     def __load(self, meshDataProvider):
         self.setCrs(meshDataProvider.crs())
         self.setExtent(meshDataProvider.extent())
+        self.__releaseProvider()
         self.__meshDataProvider = meshDataProvider
-        self.__meshDataProvider.dataChanged.connect(self.triggerRepaint)
+        self.__meshDataProvider.dataChanged.connect(self.__dataChanged)
+        self.__date = meshDataProvider.date()
+        self.clearImageCache()
+        self.__contour = None
+        self.__pointLocator = None
+        self.__geometry = None
+        self.__meshVersion += 1
+        self.__destCRS = None
+        try:
+            self.__meshCacheEntry = MeshCache(MeshLayer.MESH_CACHE_DIRECTORY).entry(meshDataProvider)
+        except (IOError, OSError) as e:
+            # e.g. a read only or full disk, the mesh is not cached
+            QgsMessageLog.logMessage("mesh cache disabled for %s: %s"%(
+                meshDataProvider.dataSourceUri(), e), "meshlayer", QgsMessageLog.WARNING)
+            self.__meshCacheEntry = None
+        self.__statistics = MeshStatistics(meshDataProvider)
 
         self.__legend = ColorLegend()
         self.__legend.setParent(self)
         self.__legend.symbologyChanged.connect(self.__symbologyChanged)
-        assert QApplication.instance().thread() == QThread.currentThread()
-        self.__glMesh = GlMesh(
-                meshDataProvider.nodeCoord(),
-                meshDataProvider.triangles(),
-                self.__legend
-                )
+        self.__createMesh()
         self.setValid(self.__meshDataProvider.isValid())
         self.__symbologyChanged()
 
+    def __loadGeometry(self):
+        """node coordinates and triangles, memory mapped from the mesh
+        cache if possible"""
+        if self.__meshCacheEntry:
+            return (self.__meshCacheEntry.get("nodeCoord", self.__meshDataProvider.nodeCoord),
+                    self.__meshCacheEntry.get("triangles", self.__meshDataProvider.triangles))
+        return self.__meshDataProvider.nodeCoord(), self.__meshDataProvider.triangles()
+
+    def __meshGeometry(self):
+        """geometry shared with the layers of the same mesh, loaded on first call"""
+        if self.__geometry is None:
+            self.__geometry = MeshDataProviderRegistry.instance().geometry(
+                    self.__meshDataProvider, self.__loadGeometry)
+            self.__geometry.coordinateCache.setMeshCacheEntry(self.__meshCacheEntry)
+        return self.__geometry
+
+    def __nodeCoord(self):
+        return self.__meshGeometry().nodeCoord
+
+    def __triangles(self):
+        return self.__meshGeometry().triangles
+
+    def __partitioned(self):
+        """return True if the provider mesh is drawn by blocks"""
+        return isinstance(self.__meshDataProvider, PartitionedMeshDataProvider)
+
+    def __createMesh(self):
+        assert QApplication.instance().thread() == QThread.currentThread()
+        if self.__partitioned():
+            self.__glMesh = PartitionedMesh(
+                    self.__meshDataProvider,
+                    MeshLayer.BACKENDS[self.__backend],
+                    self.__legend,
+                    self.__blockMemoryBudget)
+        else:
+            self.__glMesh = MeshLayer.BACKENDS[self.__backend](
+                    self.__nodeCoord(),
+                    self.__triangles(),
+                    self.__legend,
+                    self.__meshGeometry().key
+                    )
+            self.__glMesh.setIndexCache(self.__meshCacheEntry)
+        # coordinates are reprojected on next render
+        self.__destCRS = None
+
+    def setBackend(self, backend):
+        """set the renderer used to draw the mesh, one of BACKENDS keys"""
+        if backend not in MeshLayer.BACKENDS:
+            raise RuntimeError("Unknown mesh layer backend "+backend)
+        if backend == self.__backend:
+            return
+        self.__backend = backend
+        if self.__meshDataProvider:
+            self.__createMesh()
+            self.clearImageCache()
+            self.triggerRepaint()
+
+    def backend(self):
+        return self.__backend
+
+    def setBlockMemoryBudget(self, maxBytes):
+        """set the memory budget of the loaded blocks of a partitioned
+        mesh, see PartitionedMeshDataProvider"""
+        self.__blockMemoryBudget = maxBytes
+        if self.__partitioned():
+            self.__glMesh.setMemoryBudget(maxBytes)
+
+    def blockMemoryBudget(self):
+        return self.__blockMemoryBudget
+
+    def threadSafe(self):
+        return self.__backend == "numpy"
+
+    def __dataChanged(self):
+        # images of other dates stay valid when the date changes
+        if self.__meshDataProvider.date() == self.__date:
+            self.__dataVersion += 1
+            self.clearImageCache()
+        self.__date = self.__meshDataProvider.date()
+        self.triggerRepaint()
+
+    def cacheKey(self, rendererContext, size):
+        return OpenGlLayer.cacheKey(self, rendererContext, size) + (
+                self.__meshVersion,
+                self.__backend,
+                self.__meshDataProvider.date(),
+                self.__dataVersion,
+                self.__legend.fingerprint())
+
     def __symbologyChanged(self):
+        self.clearImageCache()
         self.__layerLegend = MeshLayerLegend(self, self.__legend)
         self.setLegend(self.__layerLegend)
         self.legendChanged.emit()
@@ -151,10 +295,12 @@ class MeshLayer(OpenGlLayer):
         element = node.toElement()
         provider = node.namedItem("meshDataProvider").toElement()
         meshDataProvider = MeshDataProviderRegistry.instance().provider(
-                provider.attribute("name"), provider.attribute("uri"))
+                provider.attribute("name"), provider.attribute("uri"), False)
         if not meshDataProvider.readXml(node.namedItem("meshDataProvider")):
             return False
 
+        if element.hasAttribute("backend"):
+            self.setBackend(element.attribute("backend"))
         self.__load(meshDataProvider)
 
         if not self.__legend.readXml(node.namedItem("colorLegend")):
@@ -167,6 +313,7 @@ class MeshLayer(OpenGlLayer):
         element.setAttribute("debug", "just a test")
         element.setAttribute("type", "plugin")
         element.setAttribute("name", MeshLayer.LAYER_TYPE)
+        element.setAttribute("backend", self.__backend)
 
         dataProvider = doc.createElement("meshDataProvider")
         if not self.__meshDataProvider.writeXml(dataProvider, doc):
@@ -182,8 +329,11 @@ class MeshLayer(OpenGlLayer):
     def dataProvider(self):
         return self.__meshDataProvider
 
+    def statistics(self):
+        """return the statistics service of the provider values"""
+        return self.__statistics
+
     def image(self, rendererContext, size):
-        timer = Timer() if self.__timing else None
         transform = rendererContext.coordinateTransform()
         ext = rendererContext.extent()
         mapToPixel = rendererContext.mapToPixel()
@@ -192,78 +342,133 @@ class MeshLayer(OpenGlLayer):
                      (ext.yMaximum()-ext.yMinimum())/mapToPixel.mapUnitsPerPixel()) \
                              if abs(mapToPixel.mapRotation()) < .01 else size
 
+        # the renderer context extent is in the layer CRS
+        if not ext.intersects(self.extent()):
+            img = QImage(size, QImage.Format_ARGB32)
+            img.fill(Qt.transparent)
+            return img
+
         if transform:
             ext = transform.transform(ext)
             if transform.destCRS() != self.__destCRS:
                 self.__destCRS = transform.destCRS()
-                vtx = numpy.array(self.__meshDataProvider.nodeCoord())
-                def transf(x):
-                    p = transform.transform(x[0], x[1])
-                    return [p.x(), p.y(), x[2]]
-                vtx = numpy.apply_along_axis(transf, 1, vtx)
-                self.__glMesh.resetCoord(vtx)
+                with stage("reprojection"):
+                    if self.__partitioned():
+                        # blocks are reprojected when they are loaded
+                        self.__glMesh.setCrs(transform.sourceCrs(), transform.destCRS())
+                    else:
+                        # reprojections are shared with the layers of the same mesh
+                        self.__glMesh.resetCoord(self.__meshGeometry().coordinateCache.coordinates(
+                            self.__nodeCoord(),
+                            transform.sourceCrs(),
+                            transform.destCRS()),
+                            (self.__meshGeometry().key, crsKey(transform.destCRS())))
+                        self.__glMesh.setIndexCache(self.__meshCacheEntry,
+                                cacheName(transform.sourceCrs(), transform.destCRS()) + ".")
+        elif self.__destCRS is not None:
+            self.__destCRS = None
+            with stage("reprojection"):
+                if self.__partitioned():
+                    self.__glMesh.setCrs(None, None)
+                else:
+                    self.__glMesh.resetCoord(self.__nodeCoord(), self.__meshGeometry().key)
+                    self.__glMesh.setIndexCache(self.__meshCacheEntry)
 
         self.__glMesh.setColorPerElement(self.__meshDataProvider.valueAtElement())
+        if self.__partitioned():
+            # the values of visible blocks are read by the mesh
+            values = self.__meshDataProvider.date()
+        else:
+            # the current date may be switched by dateValues in another thread
+            with self.__meshDataProvider.dateLock():
+                if self.__meshDataProvider.valueAtElement():
+                    values = self.__meshDataProvider.elementValues()
+                else:
+                    values = self.__meshDataProvider.nodeValues()
         img = self.__glMesh.image(
-                self.__meshDataProvider.elementValues()
-                   if self.__meshDataProvider.valueAtElement() else
-                   self.__meshDataProvider.nodeValues(),
+                values,
                 size,
                 (.5*(ext.xMinimum() + ext.xMaximum()),
                  .5*(ext.yMinimum() + ext.yMaximum())),
                 (mapToPixel.mapUnitsPerPixel(),
                  mapToPixel.mapUnitsPerPixel()),
                  mapToPixel.mapRotation())
-        if self.__timing:
-            print timer.reset("render 2D mesh image")
         return img
 
+    def contour(self):
+        """return the contouring engine of the mesh, the edge table is
+        built on first call"""
+        if not self.__contour:
+            edges, triangleEdges = None, None
+            if self.__meshCacheEntry:
+                edges = self.__meshCacheEntry.array("edges")
+                triangleEdges = self.__meshCacheEntry.array("triangleEdges")
+                if edges is None or triangleEdges is None:
+                    edges, triangleEdges = meshEdges(self.__triangles())
+                    try:
+                        self.__meshCacheEntry.setArray("edges", edges)
+                        self.__meshCacheEntry.setArray("triangleEdges", triangleEdges)
+                    except (IOError, OSError):
+                        # not cached, e.g. the disk is full
+                        pass
+            self.__contour = MarchingTriangles(
+                    self.__nodeCoord(),
+                    self.__triangles(),
+                    edges, triangleEdges)
+        return self.__contour
+
+    def valuesAt(self, points, dateIndex=None):
+        """return the array of values interpolated at points, an (n, 2) array
+        of coordinates in the layer CRS, NaN for points outside the mesh.
+        Values are those of the current date unless dateIndex is specified"""
+        if not self.__pointLocator:
+            # finer than the rendering grid to test fewer triangles per point
+            build = lambda: TriangleGrid(self.__nodeCoord(), self.__triangles(), .5)
+            if self.__meshCacheEntry:
+                self.__pointLocator = self.__meshCacheEntry.index("locator.",
+                        lambda arrays: TriangleGrid.fromArrays(
+                            self.__nodeCoord(), self.__triangles(), arrays),
+                        build)
+            else:
+                self.__pointLocator = build()
+        tri, barycentric = self.__pointLocator.locate(points)
+        val = numpy.asarray(self.__meshDataProvider.dateValues(
+            self.__meshDataProvider.date() if dateIndex is None else dateIndex))
+        inside = tri >= 0
+        out = numpy.empty((len(tri),), dtype=numpy.float64)
+        out.fill(numpy.nan)
+        if self.__meshDataProvider.valueAtElement():
+            out[inside] = val[tri[inside]]
+        else:
+            nodes = numpy.asarray(self.__triangles())[tri[inside]]
+            out[inside] = (barycentric[inside]*val[nodes]).sum(axis=1)
+        return out
+
+    def __currentNodeValues(self):
+        """return the node values of the current date, element values are
+        averaged at nodes"""
+        with self.__meshDataProvider.dateLock():
+            if self.__meshDataProvider.valueAtElement():
+                return elementToNodeValues(self.__triangles(),
+                        self.__meshDataProvider.elementValues(),
+                        len(self.__nodeCoord()))
+            return self.__meshDataProvider.nodeValues()
+
     def isovalues(self, values):
         """return a list of multilinestring, one for each value in values"""
-        idx = self.__meshDataProvider.triangles()
-        vtx = self.__meshDataProvider.nodeCoord()
-        lines = []
-        for value in values:
-            lines.append([])
-            if self.__meshDataProvider.valueAtElement():
-                val = self.__meshDataProvider.elementValues() - float(value)
-            else:
-                val = self.__meshDataProvider.nodeValues() - float(value)
-
-            # we filter triangles in which the value is negative on at least
-            # one node and positive on at leat one node
-            filtered = idx[numpy.logical_or(
-                val[idx[:, 0]]*val[idx[:, 1]] <= 0,
-                val[idx[:, 0]]*val[idx[:, 2]] <= 0
-                ).reshape((-1,))]
-            # create line segments
-            for tri in filtered:
-                line = []
-                # the edges are sorted to avoid interpolation error
-                for edge in [sorted([tri[0], tri[1]]),
-                             sorted([tri[1], tri[2]]),
-                             sorted([tri[2], tri[0]])]:
-                    if val[edge[0]]*val[edge[1]] <= 0:
-                        if val[edge[1]] != val[edge[0]]:
-                            alpha = -val[edge[0]]/(val[edge[1]] - val[edge[0]])
-                            assert alpha >= 0 and alpha <= 1
-                            line.append(tuple((1-alpha)*vtx[edge[0]] + alpha*vtx[edge[1]]))
-                        else: # the edge is part of the isoline
-                            print "meshlayer:isovalues: ", value, edge[0], edge[1], val[edge[0]], val[edge[1]], vtx[edge[0]], vtx[edge[1]]
-                            line.append(tuple(vtx[edge[0]]))
-                            line.append(tuple(vtx[edge[1]]))
-                # avoiding loops
-                l = list(set(line))
-                if len(l) > 1:
-                    lines[-1].append(l)
-            if len(lines[-1]):
-                m = linemerge([LineString(l) for l in lines[-1]])
-                if isinstance(m, LineString):
-                    lines[-1] = [list(m.coords)]
-                else:
-                    assert(isinstance(m, MultiLineString))
-                    lines[-1] = [list(l.coords) for l in m]
-        return lines
+        val = self.__currentNodeValues()
+        return [[[tuple(p) for p in line.tolist()] for line in multiline]
+                for multiline in self.contour().lines(val, values)]
+
+    def isobands(self, classes=None):
+        """return a list of multipolygons, one for each (min, max) in classes,
+        the classes of the color legend graduation by default, see
+        MarchingTriangles.bands and multiPolygonWkb for bulk insertion"""
+        if classes is None:
+            classes = [(min_, max_) for c, min_, max_ in self.__legend.graduation()]
+        val = self.__currentNodeValues()
+        return [[[[tuple(p) for p in ring.tolist()] for ring in polygon] for polygon in multipolygon]
+                for multipolygon in self.contour().bands(val, classes)]
 
 
 if __name__ == "__main__":
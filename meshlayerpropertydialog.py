@@ -6,6 +6,7 @@ from PyQt4 import uic
 
 from utilities import format_, complete_filename
 from glmesh import ColorLegend
+from meshstatistics import quantileBreaks, jenksBreaks, standardDeviationBreaks
 from math import exp, log
 
 from qgis.core import *
@@ -17,6 +18,10 @@ class MeshLayerPropertyDialog(QDialog):
     __classColorChanged = pyqtSignal(str)
     DEFAULT_NB_OF_CLASSES = 10
 
+    # class bounds computed from the value statistics, by index of the
+    # classification combobox, the first one uses the legend values
+    CLASSIFICATIONS = [None, quantileBreaks, jenksBreaks, standardDeviationBreaks]
+
     def __init__(self, layer):
         super(MeshLayerPropertyDialog, self).__init__()
         uic.loadUi(complete_filename('meshlayerproperties.ui'), self)
@@ -53,9 +58,28 @@ class MeshLayerPropertyDialog(QDialog):
         self.minValue.setValidator(floatValidator)
         self.maxValue.setValidator(floatValidator)
 
+        # statistics of the current date are computed while the dialog is used
+        layer.statistics().request(layer.dataProvider().date())
+
+        def currentStatistics():
+            """return the statistics of the current date, None if they
+            cannot be computed or there is no finite value"""
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            try:
+                stats = layer.statistics().statistics()
+            except RuntimeError as e:
+                QgsMessageLog.logMessage(str(e), "meshlayer", QgsMessageLog.WARNING)
+                stats = None
+            finally:
+                QApplication.restoreOverrideCursor()
+            return stats if stats is not None and stats.count else None
+
         def updateMinMax():
-            min_ = layer.dataProvider().minValue()
-            max_ = layer.dataProvider().maxValue()
+            stats = currentStatistics()
+            if stats is None:
+                # the legend values are kept
+                return
+            min_, max_ = stats.minValue, stats.maxValue
             fmt = format_(min_, max_)
             self.minValue.setText(fmt%min_)
             self.maxValue.setText(fmt%max_)
@@ -94,8 +118,11 @@ class MeshLayerPropertyDialog(QDialog):
             colorItem.setFlags(colorItem.flags() & ~Qt.ItemIsSelectable & ~Qt.ItemIsEditable)
             colorItem.setBackground(QBrush(Qt.red))
             self.tableWidget.setItem(idx, 0, colorItem)
-            min_ = layer.dataProvider().minValue()
-            max_ = layer.dataProvider().maxValue()
+            stats = currentStatistics()
+            if stats is not None:
+                min_, max_ = stats.minValue, stats.maxValue
+            else:
+                min_, max_ = layer.colorLegend().minValue(), layer.colorLegend().maxValue()
             fmt = format_(min_, max_)
             self.tableWidget.setItem(idx, 1, QTableWidgetItem(fmt%min_))
             self.tableWidget.setItem(idx, 2, QTableWidgetItem(fmt%max_))
@@ -162,7 +189,19 @@ class MeshLayerPropertyDialog(QDialog):
         def classify(flag=None):
             self.tableWidget.setRowCount(0)
             nbClass = self.nbClassesSpinBox.value()
-            values = layer.colorLegend().values(nbClass+1)
+            breaks = MeshLayerPropertyDialog.CLASSIFICATIONS[
+                    self.classificationComboBox.currentIndex()]
+            stats = currentStatistics() if breaks else None
+            if breaks and stats is None:
+                # without values the classes are those of the legend
+                self.classificationComboBox.setCurrentIndex(0)
+                breaks = None
+            if breaks:
+                # in decreasing order, like legend values
+                values = list(reversed(breaks(stats, nbClass)))
+                nbClass = len(values) - 1
+            else:
+                values = layer.colorLegend().values(nbClass+1)
             fmt = format_(min(values), max(values))
             for i in range(nbClass):
                 self.tableWidget.setRowCount(self.tableWidget.rowCount()+1)
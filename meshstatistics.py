@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+from PyQt4.QtCore import *
+
+import numpy
+import threading
+
+# number of values read at once
+CHUNK_SIZE = 1 << 20
+
+# number of histogram bins
+NB_BINS = 1024
+
+class ValueStatistics(object):
+    """Count, min, max, mean and variance of a set of values with a histogram
+    of fixed size bins between min and max. Non finite values are ignored."""
+
+    def __init__(self, count, minValue, maxValue, mean, variance, histogram):
+        self.count = count
+        self.minValue = minValue
+        self.maxValue = maxValue
+        self.mean = mean
+        self.variance = variance
+        self.histogram = histogram
+
+    def binEdges(self):
+        return numpy.linspace(self.minValue, self.maxValue, len(self.histogram) + 1)
+
+    def __cumulative(self, values):
+        """return the approximate number of values below each of values,
+        values are considered evenly spread inside bins"""
+        if self.maxValue > self.minValue:
+            return numpy.interp(values, self.binEdges(),
+                    numpy.concatenate(([0], numpy.cumsum(self.histogram))))
+        return numpy.where(numpy.asarray(values) >= self.minValue, self.count, 0)
+
+    def percentiles(self, p):
+        """return the approximate values below which lie p percents of
+        values, p is a sequence of numbers in [0, 100]"""
+        p = numpy.asarray(p, dtype=numpy.float64)
+        if not self.count:
+            return numpy.full(p.shape, numpy.nan)
+        cumulative = numpy.concatenate(([0], numpy.cumsum(self.histogram)))
+        target = numpy.clip(p, 0, 100)*.01*self.count
+        # interpolation of the inverse cumulative distribution, empty
+        # bins are skipped
+        keep = numpy.concatenate(([True], numpy.diff(cumulative) > 0))
+        return numpy.interp(target, cumulative[keep], self.binEdges()[keep])
+
+    def percentile(self, p):
+        return float(self.percentiles([p])[0])
+
+    @staticmethod
+    def merge(statistics, nbBins=NB_BINS):
+        """return the statistics of the union of several sets of values, the
+        histograms are rebinned between the overall min and max"""
+        statistics = [s for s in statistics if s.count]
+        if not statistics:
+            return ValueStatistics(0, numpy.nan, numpy.nan, numpy.nan, numpy.nan,
+                    numpy.zeros((nbBins,), dtype=numpy.int64))
+        count = sum(s.count for s in statistics)
+        minValue = min(s.minValue for s in statistics)
+        maxValue = max(s.maxValue for s in statistics)
+        mean = sum(s.mean*s.count for s in statistics)/count
+        variance = max(sum((s.variance + s.mean**2)*s.count for s in statistics)/count - mean**2, 0.)
+        edges = numpy.linspace(minValue, maxValue, nbBins + 1)
+        cumulative = numpy.zeros((nbBins + 1,))
+        for s in statistics:
+            cumulative += s.__cumulative(edges)
+        histogram = numpy.diff(cumulative)
+        # values equal to min fall in the first bin
+        histogram[0] += cumulative[0]
+        return ValueStatistics(count, minValue, maxValue, mean, variance,
+                numpy.rint(histogram).astype(numpy.int64))
+
+def computeStatistics(values, nbBins=NB_BINS, chunkSize=CHUNK_SIZE):
+    """return the ValueStatistics of an array of values, read by chunks
+    in two passes so that memory mapped arrays are not loaded at once"""
+    values = numpy.asarray(values).reshape((-1,))
+    count, total, totalSquares = 0, 0., 0.
+    minValue, maxValue = numpy.inf, -numpy.inf
+    for start in range(0, len(values), chunkSize):
+        chunk = numpy.asarray(values[start:start + chunkSize], dtype=numpy.float64)
+        chunk = chunk[numpy.isfinite(chunk)]
+        if len(chunk):
+            count += len(chunk)
+            total += chunk.sum()
+            totalSquares += numpy.dot(chunk, chunk)
+            minValue = min(minValue, chunk.min())
+            maxValue = max(maxValue, chunk.max())
+
+    histogram = numpy.zeros((nbBins,), dtype=numpy.int64)
+    if not count:
+        return ValueStatistics(0, numpy.nan, numpy.nan, numpy.nan, numpy.nan, histogram)
+    scale = nbBins/(maxValue - minValue) if maxValue > minValue else 0.
+    for start in range(0, len(values), chunkSize):
+        chunk = numpy.asarray(values[start:start + chunkSize], dtype=numpy.float64)
+        chunk = chunk[numpy.isfinite(chunk)]
+        bins = numpy.minimum(((chunk - minValue)*scale).astype(numpy.int64), nbBins - 1)
+        histogram += numpy.bincount(bins, minlength=nbBins)
+    mean = total/count
+    return ValueStatistics(count, float(minValue), float(maxValue), mean,
+            max(totalSquares/count - mean**2, 0.), histogram)
+
+def _atLeastOneClass(bounds, statistics):
+    """return bounds if they define a class, [min, max] otherwise, widened
+    around the value if all values are equal, or around 0 without value"""
+    if len(bounds) >= 2:
+        return bounds
+    if statistics.count and statistics.minValue < statistics.maxValue:
+        return [statistics.minValue, statistics.maxValue]
+    value = statistics.minValue if statistics.count else 0.
+    delta = max(abs(value)*1e-6, 1e-6)
+    return [value - delta, value + delta]
+
+def quantileBreaks(statistics, nbClasses):
+    """return the sorted class bounds such that classes hold about the same
+    number of values, there may be less than nbClasses classes if many
+    values are equal"""
+    return _atLeastOneClass([float(b) for b in numpy.unique(
+        statistics.percentiles(numpy.linspace(0, 100, nbClasses + 1)))], statistics)
+
+def standardDeviationBreaks(statistics, nbClasses):
+    """return the sorted class bounds of classes one standard deviation wide
+    centered on the mean, the extreme classes extend to min and max, there
+    may be less than nbClasses classes if the deviation is small"""
+    std = numpy.sqrt(statistics.variance)
+    breaks = statistics.mean + (numpy.arange(nbClasses + 1) - .5*nbClasses)*std
+    breaks = numpy.clip(breaks, statistics.minValue, statistics.maxValue)
+    breaks[0], breaks[-1] = statistics.minValue, statistics.maxValue
+    return _atLeastOneClass([float(b) for b in numpy.unique(breaks)], statistics)
+
+def jenksBreaks(statistics, nbClasses):
+    """return the sorted class bounds of natural breaks, that minimize the
+    sum of squared deviations from class means. The optimization is done
+    on the histogram, the values of a bin being taken at its center, so
+    bounds are bin edges"""
+    edges = statistics.binEdges()
+    nonEmpty = numpy.nonzero(statistics.histogram)[0]
+    if len(nonEmpty) <= nbClasses:
+        return _atLeastOneClass([float(b) for b in numpy.unique(
+            numpy.concatenate((edges[nonEmpty], [statistics.maxValue])))], statistics)
+
+    w = statistics.histogram[nonEmpty].astype(numpy.float64)
+    x = .5*(edges[nonEmpty] + edges[nonEmpty + 1])
+    sums = [numpy.concatenate(([0.], numpy.cumsum(a))) for a in (w, w*x, w*x*x)]
+    n = len(w)
+    first = numpy.arange(n)[:, numpy.newaxis]
+    last = numpy.arange(n)[numpy.newaxis, :]
+    # squared deviations of the class made of bins first to last
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        s0, s1, s2 = [a[last + 1] - a[first] for a in sums]
+        deviation = numpy.where(first <= last, s2 - s1*s1/s0, numpy.inf)
+
+    # cost of the best partition of bins 0 to last in k classes and first
+    # bin of its last class
+    cost = deviation[0]
+    start = []
+    for k in range(1, nbClasses):
+        total = cost[:-1, numpy.newaxis] + deviation[1:, :]
+        best = numpy.argmin(total, axis=0)
+        cost = total[best, numpy.arange(n)]
+        start.append(best + 1)
+
+    bounds = []
+    last = n - 1
+    for begin in reversed(start):
+        bounds.append(edges[nonEmpty[begin[last]]])
+        last = begin[last] - 1
+    return [statistics.minValue] + sorted(float(b) for b in bounds) + [statistics.maxValue]
+
+class MeshStatistics(QObject):
+    """Statistics of the values of a MeshDataProvider, per date and for
+    all dates, computed in a background thread.
+
+    Results are cached by provider URI and date index for the session,
+    they are dropped when the provider data change without a change
+    of date.
+
+    Values are read by the background thread if the provider dateValues
+    is thread safe, otherwise they are read one date at a time in the
+    main thread, where the instance must be created and used.
+    """
+
+    # key used for the statistics of all dates
+    ALL_DATES = -1
+
+    # emitted with the date index, or ALL_DATES, when statistics are ready
+    # or their computation failed, cached then returns None
+    statisticsReady = pyqtSignal(int)
+
+    # emitted by the background thread when it needs values read in the
+    # main thread
+    __valuesNeeded = pyqtSignal()
+
+    # statistics by (provider name, uri, date index), shared by instances
+    __cache = {}
+
+    # guards the cache and the queues of all instances
+    __condition = threading.Condition()
+
+    def __init__(self, provider, nbBins=NB_BINS):
+        QObject.__init__(self)
+        self.__provider = provider
+        self.__nbBins = nbBins
+        self.__date = provider.date()
+        self.__queue = []
+        self.__stopped = False
+        # incremented when the cache is cleared, so that results computed
+        # from previous data are not stored
+        self.__generation = 0
+        self.__threadSafe = provider.threadSafeDateValues()
+        # date index whose values are needed by the background thread and
+        # values read for it in the main thread
+        self.__needed = None
+        self.__values = {}
+        # error messages of the failed computations by date index
+        self.__errors = {}
+        self.__valuesNeeded.connect(self.__readNeeded)
+        self.__provider.dataChanged.connect(self.__dataChanged)
+        self.__worker = threading.Thread(target=self.__work)
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def __key(self, didx):
+        return (self.__provider.name(), self.__provider.dataSourceUri(), didx)
+
+    def __dates(self, didx):
+        """return the date indices needed for the statistics of didx"""
+        if didx != MeshStatistics.ALL_DATES:
+            return [didx]
+        return list(range(len(self.__provider.dates()))) or [self.__provider.date()]
+
+    def cached(self, didx):
+        """return the statistics of the date index didx, or ALL_DATES,
+        None if they are not computed yet"""
+        with MeshStatistics.__condition:
+            return MeshStatistics.__cache.get(self.__key(didx))
+
+    def request(self, didx):
+        """queue the computation of the statistics of didx, or ALL_DATES,
+        statisticsReady is emitted when they are available"""
+        with MeshStatistics.__condition:
+            if self.__key(didx) in MeshStatistics.__cache:
+                return
+            # a failed computation is tried again
+            self.__errors.pop(didx, None)
+            if didx not in self.__queue:
+                self.__queue.append(didx)
+                MeshStatistics.__condition.notify_all()
+
+    def statistics(self, didx=None):
+        """return the statistics of didx, the current date by default, or
+        ALL_DATES, waiting for the background computation if needed.
+        Return None if stopped, raise RuntimeError if the computation
+        failed, e.g. values could not be read"""
+        didx = self.__provider.date() if didx is None else didx
+        self.request(didx)
+        while True:
+            with MeshStatistics.__condition:
+                if didx in self.__errors:
+                    raise RuntimeError("cannot compute statistics: " + self.__errors[didx])
+                if self.__key(didx) in MeshStatistics.__cache or self.__stopped:
+                    return MeshStatistics.__cache.get(self.__key(didx))
+            # the background thread may wait for values read here
+            self.__readNeeded()
+            with MeshStatistics.__condition:
+                if self.__key(didx) not in MeshStatistics.__cache and not self.__stopped \
+                        and didx not in self.__errors:
+                    MeshStatistics.__condition.wait(.1)
+
+    def __readNeeded(self):
+        """read the values needed by the background thread, in the main
+        thread"""
+        with MeshStatistics.__condition:
+            didx, self.__needed = self.__needed, None
+        if didx is None:
+            return
+        try:
+            values = self.__provider.dateValues(didx)
+        except Exception as e:
+            # raised by the background thread
+            values = e
+        with MeshStatistics.__condition:
+            self.__values[didx] = values
+            MeshStatistics.__condition.notify_all()
+
+    def __dateValues(self, didx):
+        """return the values of a date index, read in the main thread if
+        the provider dateValues is not thread safe, None if stopped"""
+        if self.__threadSafe:
+            return self.__provider.dateValues(didx)
+        with MeshStatistics.__condition:
+            self.__needed = didx
+        # queued to the main thread
+        self.__valuesNeeded.emit()
+        with MeshStatistics.__condition:
+            while didx not in self.__values and not self.__stopped:
+                MeshStatistics.__condition.wait()
+            values = self.__values.pop(didx, None)
+        if isinstance(values, Exception):
+            raise values
+        return values
+
+    def __work(self):
+        while True:
+            with MeshStatistics.__condition:
+                while not self.__queue and not self.__stopped:
+                    MeshStatistics.__condition.wait()
+                if self.__stopped:
+                    return
+                didx = self.__queue[0]
+                generation = self.__generation
+            perDate = []
+            try:
+                for date in self.__dates(didx):
+                    stats = self.cached(date)
+                    if stats is None:
+                        values = self.__dateValues(date)
+                        if values is None:
+                            return
+                        stats = computeStatistics(values, self.__nbBins)
+                        with MeshStatistics.__condition:
+                            if generation == self.__generation:
+                                MeshStatistics.__cache[self.__key(date)] = stats
+                    perDate.append(stats)
+            except Exception as e:
+                # the request fails, the thread keeps serving the others
+                with MeshStatistics.__condition:
+                    self.__errors[didx] = "%s: %s"%(type(e).__name__, e)
+                    if self.__queue and self.__queue[0] == didx:
+                        self.__queue.pop(0)
+                    MeshStatistics.__condition.notify_all()
+                self.statisticsReady.emit(didx)
+                continue
+            with MeshStatistics.__condition:
+                if generation != self.__generation:
+                    # data changed, the request is computed again
+                    continue
+                if didx == MeshStatistics.ALL_DATES:
+                    MeshStatistics.__cache[self.__key(didx)] = ValueStatistics.merge(perDate, self.__nbBins)
+                if self.__queue and self.__queue[0] == didx:
+                    self.__queue.pop(0)
+                MeshStatistics.__condition.notify_all()
+            # queued to the main thread
+            self.statisticsReady.emit(didx)
+
+    def stop(self):
+        """stop the background computation, queued requests are dropped"""
+        with MeshStatistics.__condition:
+            self.__stopped = True
+            self.__queue = []
+            MeshStatistics.__condition.notify_all()
+
+    def clear(self):
+        """drop the cached statistics of the provider"""
+        name, uri = self.__provider.name(), self.__provider.dataSourceUri()
+        with MeshStatistics.__condition:
+            self.__generation += 1
+            for key in [k for k in MeshStatistics.__cache if k[:2] == (name, uri)]:
+                del MeshStatistics.__cache[key]
+
+    def __dataChanged(self):
+        # a change of date does not change the values of dates
+        if self.__provider.date() == self.__date:
+            self.clear()
+        self.__date = self.__provider.date()
+
+# run as script for testing
+if __name__ == "__main__":
+    values = numpy.random.RandomState(0).normal(10., 2., 100000)
+    stats = computeStatistics(values, chunkSize=4096)
+    assert(stats.count == len(values))
+    assert(abs(stats.mean - values.mean()) < 1e-9 and abs(stats.variance - values.var()) < 1e-6)
+    assert(abs(stats.percentile(50) - numpy.median(values)) < 2e-2)
+    for breaks in (quantileBreaks, jenksBreaks, standardDeviationBreaks):
+        bounds = breaks(stats, 5)
+        assert(len(bounds) == 6 and bounds == sorted(bounds))
+        assert(bounds[0] == stats.minValue and bounds[-1] == stats.maxValue)
+
+    # constant or missing values still give one class containing them,
+    # classes are (min, max]
+    for values in (numpy.full((1000,), 3.5), numpy.zeros((10,)), numpy.array([numpy.nan])):
+        stats = computeStatistics(values)
+        for breaks in (quantileBreaks, jenksBreaks, standardDeviationBreaks):
+            bounds = breaks(stats, 5)
+            assert(len(bounds) == 2 and bounds[0] < bounds[1])
+            if stats.count:
+                assert(bounds[0] < stats.minValue <= bounds[1])
+
+    # a provider failing to read values gives an error instead of a wait
+    # without end, whether values are read in the background or not
+    class FailingProvider(QObject):
+        dataChanged = pyqtSignal()
+        def __init__(self, threadSafe):
+            QObject.__init__(self)
+            self.__threadSafe = threadSafe
+        def name(self): return "failing"
+        def dataSourceUri(self): return str(self.__threadSafe)
+        def date(self): return 0
+        def dates(self): return ["d0", "d1"]
+        def threadSafeDateValues(self): return self.__threadSafe
+        def dateValues(self, didx): raise IOError("cannot read values")
+    for threadSafe in (True, False):
+        meshStatistics = MeshStatistics(FailingProvider(threadSafe))
+        for didx in (0, MeshStatistics.ALL_DATES):
+            try:
+                meshStatistics.statistics(didx)
+                assert(False)
+            except RuntimeError as e:
+                assert("cannot read values" in str(e))
+            assert(meshStatistics.cached(didx) is None)
+        meshStatistics.stop()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+from math import sin, cos, radians
+
+from spatialindex import TriangleGrid, viewExtent
+from lod import MeshHierarchy
+from instrumentation import stage, count
+from utilities import SharedObjects
+
+# maximum number of (triangle, pixel) pairs processed at once
+BATCH_SIZE = 1 << 21
+
+def pixelCoordinates(vtx, imageSize, center, mapUnitsPerPixel, rotation=0):
+    """return the (nbNodes, 2) float64 array of the (column, row) position of
+    vertices in an image, with the same transformation as GlMesh.image"""
+    width, height = imageSize
+    c, s = cos(radians(-rotation)), sin(radians(-rotation))
+    vtx = numpy.asarray(vtx)
+    x = vtx[:, 0].astype(numpy.float64) - center[0]
+    y = vtx[:, 1].astype(numpy.float64) - center[1]
+    out = numpy.empty((len(x), 2))
+    out[:, 0] = (c*x - s*y)/mapUnitsPerPixel[0] + .5*width
+    out[:, 1] = .5*height - (s*x + c*y)/mapUnitsPerPixel[1]
+    return out
+
+def rasterize(vtx, idx, values, imageSize, center, mapUnitsPerPixel, rotation=0,
+        perElement=False, tileSize=256):
+    """return a (height, width) float32 array of values interpolated at pixel
+    centers, NaN where no triangle is drawn.
+    Values are defined at nodes, or at triangles if perElement is true.
+    The image is processed in bands of tileSize rows and the triangles of a band
+    in batches, so that memory stays bounded whatever the triangle sizes."""
+    width, height = imageSize
+    out = numpy.empty((height, width), dtype=numpy.float32)
+    out.fill(numpy.nan)
+    idx = numpy.asarray(idx).reshape((-1, 3))
+    val = numpy.asarray(values, dtype=numpy.float64)
+    if not len(idx) or not width or not height:
+        return out
+
+    pix = pixelCoordinates(vtx, imageSize, center, mapUnitsPerPixel, rotation)
+    x = pix[idx, 0]
+    y = pix[idx, 1]
+    # range of pixel centers covered by the triangle bounding boxes
+    col0 = numpy.maximum(numpy.ceil(x.min(axis=1) - .5), 0).astype(numpy.int64)
+    col1 = numpy.minimum(numpy.floor(x.max(axis=1) - .5), width - 1).astype(numpy.int64)
+    row0 = numpy.maximum(numpy.ceil(y.min(axis=1) - .5), 0).astype(numpy.int64)
+    row1 = numpy.minimum(numpy.floor(y.max(axis=1) - .5), height - 1).astype(numpy.int64)
+    det = (y[:, 1] - y[:, 2])*(x[:, 0] - x[:, 2]) + (x[:, 2] - x[:, 1])*(y[:, 0] - y[:, 2])
+    visible = numpy.nonzero(numpy.logical_and(
+        numpy.logical_and(col0 <= col1, row0 <= row1), det != 0))[0]
+    if not len(visible):
+        return out
+    x, y, det = x[visible], y[visible], det[visible]
+    col0, col1, row0, row1 = col0[visible], col1[visible], row0[visible], row1[visible]
+
+    # barycentric coordinates are l0 = a0*px + b0*py + c0, same for l1
+    a0 = (y[:, 1] - y[:, 2])/det
+    b0 = (x[:, 2] - x[:, 1])/det
+    c0 = -a0*x[:, 2] - b0*y[:, 2]
+    a1 = (y[:, 2] - y[:, 0])/det
+    b1 = (x[:, 0] - x[:, 2])/det
+    c1 = -a1*x[:, 2] - b1*y[:, 2]
+    triVal = val[visible] if perElement else val[idx[visible]]
+
+    for bandStart in range(0, height, tileSize):
+        bandEnd = min(bandStart + tileSize, height) - 1
+        inBand = numpy.nonzero(numpy.logical_and(row0 <= bandEnd, row1 >= bandStart))[0]
+        if not len(inBand):
+            continue
+        r0 = numpy.maximum(row0[inBand], bandStart)
+        r1 = numpy.minimum(row1[inBand], bandEnd)
+        nx = col1[inBand] - col0[inBand] + 1
+        count = nx*(r1 - r0 + 1)
+        cumCount = numpy.cumsum(count)
+        start = 0
+        while start < len(inBand):
+            # a batch is at least one triangle, at most one band wide
+            offset = cumCount[start - 1] if start else 0
+            end = max(start + 1, int(numpy.searchsorted(cumCount, offset + BATCH_SIZE, 'right')))
+            batch = numpy.arange(start, end)
+            nb = count[batch]
+            first = numpy.cumsum(nb) - nb
+            local = numpy.arange(int(nb.sum())) - numpy.repeat(first, nb)
+            b = numpy.repeat(batch, nb)
+            tri = inBand[b]
+            px = col0[tri] + local % nx[b]
+            py = r0[b] + local // nx[b]
+            fx, fy = px + .5, py + .5
+            l0 = a0[tri]*fx + b0[tri]*fy + c0[tri]
+            l1 = a1[tri]*fx + b1[tri]*fy + c1[tri]
+            l2 = 1. - l0 - l1
+            inside = numpy.logical_and(numpy.logical_and(l0 >= 0, l1 >= 0), l2 >= 0)
+            if perElement:
+                v = triVal[tri[inside]]
+            else:
+                v = l0[inside]*triVal[tri[inside], 0] \
+                  + l1[inside]*triVal[tri[inside], 1] \
+                  + l2[inside]*triVal[tri[inside], 2]
+            out[py[inside], px[inside]] = v
+            start = end
+    return out
+
+def colorize(values, colorParameters):
+    """return a (height, width, 4) uint8 array of premultiplied BGRA colors
+    (the memory layout of QImage.Format_ARGB32_Premultiplied) for a
+    (height, width) array of values, with the same color mapping as the
+    ColorLegend shader, colorParameters is given by ColorLegend.colorParameters()"""
+    val = numpy.asarray(values, dtype=numpy.float64)
+    rgba = numpy.zeros(val.shape + (4,), dtype=numpy.float64)
+    defined = numpy.logical_not(numpy.isnan(val))
+    if colorParameters['graduated']:
+        # the first matching class wins, as in the shader
+        for r, g, b, min_, max_ in reversed(colorParameters['graduation']):
+            rgba[numpy.logical_and(min_ < val, val <= max_)] = (r, g, b, 1.)
+    else:
+        min_, max_ = colorParameters['minValue'], colorParameters['maxValue']
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            if colorParameters['logscale']:
+                normalized = (numpy.log(val) - numpy.log(min_))/(numpy.log(max_) - numpy.log(min_))
+            else:
+                normalized = (val - min_)/(max_ - min_)
+        normalized[numpy.isnan(normalized)] = 0
+        table = colorParameters['colorTable']
+        rgba[defined] = table[numpy.rint(
+            numpy.clip(normalized[defined], 0., 1.)*(len(table) - 1)).astype(numpy.int64)]
+    rgba[numpy.logical_not(defined)] = 0
+    rgba *= 1. - colorParameters['transparency']
+    bgra = numpy.empty(val.shape + (4,), dtype=numpy.uint8)
+    bgra[..., 0] = numpy.rint(rgba[..., 2]*255)
+    bgra[..., 1] = numpy.rint(rgba[..., 1]*255)
+    bgra[..., 2] = numpy.rint(rgba[..., 0]*255)
+    bgra[..., 3] = numpy.rint(rgba[..., 3]*255)
+    return bgra
+
+class NumpyMesh(object):
+    """Software rendering of results on a 2D mesh, this class provides the
+    same interface as GlMesh but does not need an OpenGL context: it can
+    be used in any thread, and the rasterize and colorize functions can
+    be used in other processes. Qt is only imported by image, so that the
+    module can be imported without it.
+
+    Instances created with the same geometryKey share their spatial index
+    and level of detail hierarchy.
+    """
+
+    # indices shared by geometry key
+    __shared = SharedObjects()
+
+    def __init__(self, vtx, idx, legend, geometryKey=None):
+        self.__geometryKey = geometryKey
+        # coordinates keep their dtype, float32 when shared with other
+        # meshes, they are converted by pixelCoordinates
+        self.__vtx = numpy.asarray(vtx)
+        self.__idx = numpy.require(idx, numpy.int32)
+        self.__legend = legend
+        self.__colorPerElement = False
+        self.__colorParameters = None
+        self.__grid = None
+        self.__hierarchy = None
+        # (MeshCacheEntry, prefix) the indices are stored in, if any
+        self.__indexCache = None
+        self.__legend.symbologyChanged.connect(self.__symbologyChanged)
+
+    def __symbologyChanged(self):
+        self.__colorParameters = None
+
+    def setLegend(self, legend):
+        self.__legend.symbologyChanged.disconnect(self.__symbologyChanged)
+        self.__legend = legend
+        self.__legend.symbologyChanged.connect(self.__symbologyChanged)
+        self.__colorParameters = None
+
+    def setColorPerElement(self, flag):
+        self.__colorPerElement = flag
+
+    def colorPerElement(self):
+        return self.__colorPerElement
+
+    def __sharedKey(self, name):
+        return (name, self.__geometryKey) if self.__geometryKey is not None else None
+
+    def setIndexCache(self, entry, prefix=""):
+        """set the MeshCacheEntry the spatial index and hierarchy of the
+        current coordinates are stored in, under names starting with
+        prefix, so that they are read instead of built by next sessions"""
+        self.__indexCache = (entry, prefix) if entry else None
+
+    def __index(self, name, fromArrays, build):
+        if self.__indexCache is None:
+            return build()
+        entry, prefix = self.__indexCache
+        return entry.index(prefix + name + ".", fromArrays, build)
+
+    def resetCoord(self, vtx, geometryKey=None):
+        """set the node coordinates, geometryKey identifies them to share
+        indices with other instances"""
+        self.__geometryKey = geometryKey
+        self.__vtx = numpy.asarray(vtx)
+        self.__grid = None
+        self.__hierarchy = None
+        self.__indexCache = None
+
+    def resetMesh(self, vtx, idx, geometryKey=None):
+        """set the node coordinates and triangles, e.g. to draw the blocks of
+        a partitioned mesh with the same instance"""
+        self.__geometryKey = geometryKey
+        self.__vtx = numpy.asarray(vtx)
+        self.__idx = numpy.require(idx, numpy.int32)
+        self.__grid = None
+        self.__hierarchy = None
+        self.__indexCache = None
+
+    def sharedResources(self):
+        """return (resources, nbBytes), the list of the spatial index and
+        hierarchy, shared with the instances of the same geometryKey while
+        the list is referenced, and their size in bytes. They are only
+        listed once created by a draw"""
+        resources = [r for r in (self.__grid, self.__hierarchy) if r is not None]
+        return resources, sum(r.nbytes() for r in resources)
+
+    def hierarchy(self):
+        """return the level of detail hierarchy, built on first call
+        after each change of coordinates"""
+        hierarchy = self.__hierarchy
+        if hierarchy is None:
+            hierarchy = NumpyMesh.__shared.get(self.__sharedKey("hierarchy"),
+                    lambda: self.__index("hierarchy", MeshHierarchy.fromArrays,
+                        lambda: MeshHierarchy(self.__vtx, self.__idx)))
+            self.__hierarchy = hierarchy
+        return hierarchy
+
+    def spatialIndex(self):
+        """return the spatial index of triangles, built on first call
+        after each change of coordinates"""
+        grid = self.__grid
+        if grid is None:
+            grid = NumpyMesh.__shared.get(self.__sharedKey("grid"),
+                    lambda: self.__index("grid",
+                        lambda arrays: TriangleGrid.fromArrays(self.__vtx, self.__idx, arrays),
+                        lambda: TriangleGrid(self.__vtx, self.__idx)))
+            self.__grid = grid
+        return grid
+
+    def image(self, values, imageSize, center, mapUnitsPerPixel, rotation=0):
+        """Return the rendered image of a given size for values defined at each vertex
+        or at each element depending on setColorPerElement."""
+        from PyQt4.QtGui import QImage
+        bgra = self.array(values, imageSize, center, mapUnitsPerPixel, rotation)
+        with stage("crop"):
+            # the image owns its pixels, copies of the QImage made on the
+            # C++ side would not keep the array alive
+            return QImage(bgra.data, imageSize.width(), imageSize.height(),
+                    QImage.Format_ARGB32_Premultiplied).copy()
+
+    def array(self, values, imageSize, center, mapUnitsPerPixel, rotation=0):
+        """Return the rendered image as a (height, width, 4) uint8 array of
+        premultiplied BGRA colors, the memory layout of
+        QImage.Format_ARGB32_Premultiplied"""
+        extent = viewExtent((imageSize.width(), imageSize.height()),
+                center, mapUnitsPerPixel, rotation)
+        visible = self.spatialIndex().query(*extent) if len(values) else []
+        if not len(visible):
+            return numpy.zeros((imageSize.height(), imageSize.width(), 4), dtype=numpy.uint8)
+
+        # the legend may change in the main thread while we draw
+        colorParameters = self.__colorParameters
+        if colorParameters is None:
+            colorParameters = self.__legend.colorParameters()
+            self.__colorParameters = colorParameters
+
+        # zoomed out, the triangles of a coarse level in view are drawn
+        hierarchy = self.hierarchy()
+        level = hierarchy.level(mapUnitsPerPixel)
+        if level:
+            vtx, idx = hierarchy.vertices(level), hierarchy.triangles(level)
+            values = hierarchy.elementValues(level, values) if self.__colorPerElement \
+                    else hierarchy.nodeValues(level, values)
+            visible = hierarchy.spatialIndex(level).query(*extent)
+        else:
+            vtx, idx = self.__vtx, self.__idx
+        idx = idx[visible]
+        if self.__colorPerElement:
+            with stage("elementExpansion"):
+                values = numpy.asarray(values)[visible]
+
+        with stage("draw"):
+            val = rasterize(vtx, idx, values,
+                    (imageSize.width(), imageSize.height()),
+                    center, mapUnitsPerPixel, rotation, self.__colorPerElement)
+            bgra = colorize(val, colorParameters)
+        count("trianglesDrawn", len(idx))
+        return bgra
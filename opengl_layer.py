@@ -9,9 +9,34 @@ from PyQt4.QtOpenGL import QGLPixelBuffer, QGLFormat
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
-from .utilities import Timer
+from .reprojection import crsKey
+from .instrumentation import Instrumentation, recording, stage, count
 
 import os
+import time
+import traceback
+from collections import OrderedDict
+
+class RenderRequest(object):
+    """A render job waiting for its image to be drawn in the main thread,
+    attributes are guarded by the mutex of the layer request queue"""
+
+    def __init__(self, rendererContext, size, frame=None):
+        # the original context tells if the job is cancelled, the copy
+        # without painter is passed to image
+        self.rendererContext = rendererContext
+        self.context = QgsRenderContext(rendererContext)
+        self.context.setPainter(None)
+        self.size = size
+        # instrumentation frame of the draw, None if not recorded
+        self.frame = frame
+        self.image = None
+        self.error = None
+        self.done = False
+        self.cancelled = False
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
 
 class OpenGlLayerType(QgsPluginLayerType):
     def __init__(self, type_=None):
@@ -33,13 +58,26 @@ class OpenGlLayer(QgsPluginLayer):
     passed to the main thread.
 
     Child class must implement the image method
+
+    Rendered images are kept in a cache with a memory budget and reused
+    while the key returned by cacheKey does not change, child classes
+    must add the state their image depends on to the key
+
+    The stages of each draw are recorded by the instrumentation when
+    it is enabled
     """
 
     LAYER_TYPE = "opengl_layer"
 
+    # default memory budget of the image cache in bytes
+    IMAGE_CACHE_BYTES = 64*1024*1024
+
+    # period in ms at which a waiting render thread checks for cancellation
+    CANCEL_POLL_PERIOD = 10
+
     __msg = pyqtSignal(str)
     __drawException = pyqtSignal(str)
-    __imageChangeRequested = pyqtSignal()
+    __renderRequested = pyqtSignal()
 
     def __print(self, msg):
         print msg
@@ -49,17 +87,25 @@ class OpenGlLayer(QgsPluginLayer):
 
     def __init__(self, type_=None, name=None):
         QgsPluginLayer.__init__(self, type_ if type_ is not None else OpenGlLayer.LAYER_TYPE, name)
-        self.__imageChangedMutex = QMutex()
-        self.__imageChangeRequested.connect(self.__drawInMainThread)
-        self.__img = None
-        self.__rendererContext = None
+        # render requests from the rendering threads, served in order by
+        # the main thread, the mutex guards the queue and the requests
+        self.__requestMutex = QMutex()
+        self.__requestDone = QWaitCondition()
+        self.__requests = []
+        self.__renderStatistics = {}
+        self.__renderRequested.connect(self.__processRequests, Qt.QueuedConnection)
         self.__drawException.connect(self.__raise)
         self.__msg.connect(self.__print)
         self.setExtent(QgsRectangle(-1e9, -1e9, 1e9, 1e9))
         self.setCrs(QgsCoordinateReferenceSystem('EPSG:2154'))
         #self.__destCRS = None
         self.setValid(True)
-        self.__timing = False
+        self.__instrumentation = Instrumentation()
+        # guards the image cache, used by the rendering threads
+        self.__imageCacheMutex = QMutex()
+        self.__imageCache = OrderedDict()
+        self.__imageCacheBytes = 0
+        self.__imageCacheMaxBytes = OpenGlLayer.IMAGE_CACHE_BYTES
 
     def image(self, rendererContext, size):
         """This is the function that should be overwritten
@@ -80,43 +126,193 @@ class OpenGlLayer(QgsPluginLayer):
         print "default image, we should not be here"
         return img
 
-    def __drawInMainThread(self):
-        self.__imageChangedMutex.lock()
-        self.__img = self.image(self.__rendererContext, self.__size)
-        self.__imageChangedMutex.unlock()
+    def threadSafe(self):
+        """return True if the image method can be called from the rendering
+        thread, in which case the main thread is not involved in the draw"""
+        return False
+
+    def instrumentation(self):
+        """return the recorder of the stages of draws, see
+        instrumentation.Instrumentation"""
+        return self.__instrumentation
+
+    def cacheKey(self, rendererContext, size):
+        """return a hashable key identifying the image rendered for the
+        context, or None if the image must not be cached. Child classes
+        extend the key with the state of their data and symbology"""
+        ext = rendererContext.extent()
+        mapToPixel = rendererContext.mapToPixel()
+        transform = rendererContext.coordinateTransform()
+        return (ext.xMinimum(), ext.yMinimum(), ext.xMaximum(), ext.yMaximum(),
+                size.width(), size.height(),
+                mapToPixel.mapUnitsPerPixel(), mapToPixel.mapRotation(),
+                crsKey(transform.destCRS()) if transform else None)
+
+    def setImageCacheSize(self, maxBytes):
+        """set the memory budget of the image cache, 0 disables the cache"""
+        locker = QMutexLocker(self.__imageCacheMutex)
+        self.__imageCacheMaxBytes = maxBytes
+        self.__evictImages()
+
+    def imageCacheSize(self):
+        return self.__imageCacheMaxBytes
+
+    def clearImageCache(self):
+        """remove all cached images, must be called when the rendered
+        images change without a change of their key"""
+        locker = QMutexLocker(self.__imageCacheMutex)
+        self.__imageCache.clear()
+        self.__imageCacheBytes = 0
+
+    def invalidateImageCache(self, predicate):
+        """remove the cached images whose key verifies predicate(key)"""
+        locker = QMutexLocker(self.__imageCacheMutex)
+        for key in [key for key in self.__imageCache if predicate(key)]:
+            self.__imageCacheBytes -= self.__imageCache.pop(key).byteCount()
+
+    def __cachedImage(self, key):
+        locker = QMutexLocker(self.__imageCacheMutex)
+        if key not in self.__imageCache:
+            return None
+        self.__imageCache[key] = self.__imageCache.pop(key)
+        return self.__imageCache[key]
+
+    def __cacheImage(self, key, img):
+        locker = QMutexLocker(self.__imageCacheMutex)
+        if key in self.__imageCache or img.byteCount() > self.__imageCacheMaxBytes:
+            return
+        self.__imageCache[key] = img
+        self.__imageCacheBytes += img.byteCount()
+        self.__evictImages()
+
+    def __evictImages(self):
+        # least recently used first, the mutex is locked by the caller
+        while self.__imageCacheBytes > self.__imageCacheMaxBytes and self.__imageCache:
+            self.__imageCacheBytes -= self.__imageCache.popitem(last=False)[1].byteCount()
+
+    def __processRequests(self):
+        """render the queued requests, called in the main thread"""
+        while True:
+            self.__requestMutex.lock()
+            if not self.__requests:
+                self.__requestMutex.unlock()
+                return
+            request = self.__requests.pop(0)
+            if request.rendererContext.renderingStopped():
+                # the job is cancelled, no need to render
+                request.cancelled = True
+                self.__requestDone.wakeAll()
+                self.__requestMutex.unlock()
+                continue
+            request.started = time.time()
+            if request.frame is not None:
+                request.frame.add("hopWait", request.started - request.queued)
+            self.__requestMutex.unlock()
+
+            self.__render(request)
+
+    def __render(self, request):
+        if request.started is None:
+            request.started = time.time()
+        image, error = None, None
+        try:
+            with recording(request.frame):
+                image = self.image(request.context, request.size)
+        except Exception:
+            error = traceback.format_exc()
+        locker = QMutexLocker(self.__requestMutex)
+        request.image = image
+        request.error = error
+        request.finished = time.time()
+        request.done = True
+        self.__record(request)
+        self.__requestDone.wakeAll()
+
+    def __record(self, request):
+        # the request mutex is locked by the caller
+        stats = self.__renderStatistics
+        stats['requests'] = stats.get('requests', 0) + 1
+        for name, duration in (("queueWait", request.started - request.queued),
+                               ("render", request.finished - request.started)):
+            stats[name+'Total'] = stats.get(name+'Total', 0.) + duration
+            stats[name+'Max'] = max(stats.get(name+'Max', 0.), duration)
+
+    def renderStatistics(self):
+        """return a dictionary with the number of render 'requests' served
+        by the main thread and the total and maximum time, in seconds,
+        spent waiting in the queue ('queueWaitTotal', 'queueWaitMax') and
+        rendering ('renderTotal', 'renderMax')"""
+        locker = QMutexLocker(self.__requestMutex)
+        return dict(self.__renderStatistics)
+
+    def resetRenderStatistics(self):
+        locker = QMutexLocker(self.__requestMutex)
+        self.__renderStatistics = {}
+
+    def __requestImage(self, rendererContext, size, frame=None):
+        """queue a request for the main thread and wait for its image,
+        return None if rendering is stopped before the image is ready"""
+        request = RenderRequest(rendererContext, size, frame)
+        locker = QMutexLocker(self.__requestMutex)
+        self.__requests.append(request)
+        self.__renderRequested.emit()
+        while not request.done:
+            # the event loop may be stopped when a render job is cancelled,
+            # the wait must not be unbounded
+            if rendererContext.renderingStopped():
+                request.cancelled = True
+                if request in self.__requests:
+                    self.__requests.remove(request)
+                return None
+            self.__requestDone.wait(self.__requestMutex, OpenGlLayer.CANCEL_POLL_PERIOD)
+        if request.error:
+            raise RuntimeError(request.error)
+        return request.image
 
     def draw(self, rendererContext):
         """This function is called by the rendering thread.
         GlMesh must be created in the main thread."""
-        timer = Timer() if self.__timing else None
+        frame = self.__instrumentation.frame()
         try:
             # /!\ DO NOT PRINT IN THREAD
-            painter = rendererContext.painter()
-            self.__imageChangedMutex.lock()
-            self.__rendererContext = QgsRenderContext(rendererContext)
-            self.__rendererContext.setPainter(None)
-            self.__size = painter.viewport().size()
-            self.__img = None
-            self.__imageChangedMutex.unlock()
-            if QApplication.instance().thread() != QThread.currentThread():
-                self.__imageChangeRequested.emit()
-                while not self.__img and not rendererContext.renderingStopped():
-                    # active wait to avoid deadlocking if event loop is stopped
-                    # this happens when a render job is cancellled
-                    QThread.msleep(1)
-                if rendererContext.renderingStopped():
-                    self.__msg.emit("rendering stopped")
-
-                if not rendererContext.renderingStopped():
-                    painter.drawImage(0, 0, self.__img)
-            else:
-                self.__drawInMainThread()
-                painter.drawImage(0, 0, self.__img)
-            if self.__timing:
-                self.__msg.emit(timer.reset("OpenGlLayer.draw"))
+            with recording(frame):
+                drawn = self.__draw(rendererContext, frame)
+            if drawn:
+                # cancelled frames are not recorded
+                self.__instrumentation.record(frame)
             return True
         except Exception as e:
             # since we are in a thread, we must re-raise the exception
             self.__drawException.emit(traceback.format_exc())
             return False
 
+    def __draw(self, rendererContext, frame):
+        """draw the image of the layer, return False if rendering is
+        stopped before the image is ready"""
+        painter = rendererContext.painter()
+        key = self.cacheKey(rendererContext, painter.viewport().size()) \
+                if self.__imageCacheMaxBytes else None
+        img = self.__cachedImage(key) if key is not None else None
+        if img is not None:
+            count("cacheHits", 1)
+        elif self.threadSafe():
+            context = QgsRenderContext(rendererContext)
+            context.setPainter(None)
+            img = self.image(context, painter.viewport().size())
+        elif QApplication.instance().thread() != QThread.currentThread():
+            img = self.__requestImage(rendererContext, painter.viewport().size(), frame)
+            if img is None:
+                self.__msg.emit("rendering stopped")
+                return False
+        else:
+            request = RenderRequest(rendererContext, painter.viewport().size(), frame)
+            self.__render(request)
+            if request.error:
+                raise RuntimeError(request.error)
+            img = request.image
+        with stage("paint"):
+            painter.drawImage(0, 0, img)
+        if key is not None:
+            self.__cacheImage(key, img)
+        return True
+
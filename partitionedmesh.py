@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+
+from qgis.core import QgsRectangle
+
+import numpy
+import os
+import json
+import threading
+from math import ceil, sqrt
+from collections import OrderedDict
+
+from meshdataprovider import MeshDataProvider
+from reprojection import transformCoordinates, crsKey
+from spatialindex import viewExtent
+from lod import MeshHierarchy
+from glmesh import bgra2qimage
+from instrumentation import stage
+
+# default memory budget of the blocks loaded by PartitionedMesh in bytes
+MAX_BYTES = 1 << 30
+
+# default number of triangles of the blocks written by partitionMesh
+TRIANGLES_PER_BLOCK = 1 << 20
+
+# number of triangles processed at once by partitionMesh
+CHUNK_SIZE = 1 << 22
+
+# maximum number of triangles of the overview of a block
+OVERVIEW_TRIANGLES = 1 << 12
+
+def meshOverview(vtx, idx, valueAtElement=False, nbTriangles=OVERVIEW_TRIANGLES):
+    """return (vtx, idx, indices) the coarsest level with triangles of the
+    MeshHierarchy of a mesh, with less than about nbTriangles triangles,
+    indices are the indices of the node values, or element values if
+    valueAtElement, taken for the coarse nodes or triangles. The mesh itself
+    is returned if it is small enough"""
+    hierarchy = MeshHierarchy(vtx, idx, nbTriangles)
+    level = hierarchy.nbLevels() - 1
+    while level and not len(hierarchy.triangles(level)):
+        level -= 1
+    if not level:
+        idx = numpy.asarray(idx).reshape((-1, 3))
+        return (numpy.asarray(vtx), idx,
+                numpy.arange(len(idx) if valueAtElement else len(vtx)))
+    return (hierarchy.vertices(level), hierarchy.triangles(level),
+            hierarchy.elements(level) if valueAtElement else hierarchy.nodes(level))
+
+class PartitionedMeshDataProvider(MeshDataProvider):
+    """Base class of providers of meshes split in spatial blocks that can be
+    read separately, each block has its own node coordinates, connectivity
+    with indices local to the block and values per date. Nodes on block
+    boundaries are duplicated in each block.
+
+    Child classes must implement blockExtents, blockNodeCoord, blockTriangles
+    and blockValues and may implement blockOverview to return precomputed
+    overviews. MeshLayer draws the blocks separately, the whole mesh
+    methods (nodeCoord, triangles, nodeValues...) assemble all blocks and
+    are only meant for meshes that fit in memory.
+    """
+
+    def blockExtents(self):
+        """return the (nbBlocks, 4) array of (xmin, ymin, xmax, ymax) of blocks"""
+        return numpy.empty((0, 4))
+
+    def blockNodeCoord(self, block):
+        """return the (nbNodes, 3) array of node coordinates of a block"""
+        return numpy.empty((0, 3), dtype=numpy.float32)
+
+    def blockTriangles(self, block):
+        """return the (nbTriangles, 3) array of triangles of a block,
+        indices start at zero for each block"""
+        return numpy.empty((0, 3), dtype=numpy.int32)
+
+    def blockValues(self, block, didx):
+        """return the node values, or element values if valueAtElement(),
+        of a block for the date index didx"""
+        return numpy.empty((0,), dtype=numpy.float32)
+
+    def blockOverview(self, block):
+        """return (vtx, idx, indices) the coarse version of a block drawn when
+        the visible blocks do not fit in memory, indices are the indices of
+        the block values taken for its nodes, or elements, see meshOverview.
+        It is computed from the block by default"""
+        return meshOverview(self.blockNodeCoord(block), self.blockTriangles(block),
+                self.valueAtElement())
+
+    def nbBlocks(self):
+        return len(self.blockExtents())
+
+    def extent(self):
+        extents = numpy.asarray(self.blockExtents()).reshape((-1, 4))
+        if not len(extents):
+            return QgsRectangle()
+        return QgsRectangle(extents[:, 0].min(), extents[:, 1].min(),
+                extents[:, 2].max(), extents[:, 3].max())
+
+    def nodeCoord(self):
+        return numpy.concatenate([self.blockNodeCoord(b) for b in range(self.nbBlocks())]
+                or [numpy.empty((0, 3), dtype=numpy.float32)])
+
+    def triangles(self):
+        triangles, offset = [numpy.empty((0, 3), dtype=numpy.int32)], 0
+        for b in range(self.nbBlocks()):
+            triangles.append(numpy.asarray(self.blockTriangles(b)) + offset)
+            offset += len(self.blockNodeCoord(b))
+        return numpy.concatenate(triangles).astype(numpy.int32)
+
+    def nodeValues(self):
+        return self.dateValues(self.date())
+
+    def elementValues(self):
+        return self.dateValues(self.date())
+
+    def dateValues(self, didx):
+        return numpy.concatenate([self.blockValues(b, didx) for b in range(self.nbBlocks())]
+                or [numpy.empty((0,), dtype=numpy.float32)])
+
+    def threadSafeDateValues(self):
+        # blocks are read by date
+        return True
+
+class NpyPartitionedMeshDataProvider(PartitionedMeshDataProvider):
+    """Partitioned mesh written by partitionMesh in the directory given by
+    the 'directory' parameter of the uri, e.g.
+        'directory=/data/ocean crs=EPSG:4326'
+    the arrays are memory mapped. The provider must be registered to be
+    restored from a project file:
+        MeshDataProviderRegistry.instance().addDataProviderType(
+            NpyPartitionedMeshDataProvider.PROVIDER_KEY, NpyPartitionedMeshDataProvider)
+    """
+
+    PROVIDER_KEY = "partitioned_mesh"
+
+    def __init__(self, uri):
+        PartitionedMeshDataProvider.__init__(self, uri)
+        self.__open()
+
+    def __open(self):
+        self.__directory = self.uri().param('directory')
+        self.__extents = numpy.empty((0, 4))
+        self.__valueAtElement = False
+        self.__values = {}
+        if not os.path.isfile(self.__file("mesh.json")):
+            return
+        with open(self.__file("mesh.json")) as fil:
+            description = json.load(fil)
+        self.__valueAtElement = description['valueAtElement']
+        self.__extents = numpy.load(self.__file("extents.npy"))
+        self.setDates(description['dates'])
+
+    def __file(self, *path):
+        return os.path.join(self.__directory, *path)
+
+    def name(self):
+        return NpyPartitionedMeshDataProvider.PROVIDER_KEY
+
+    def description(self):
+        return "partitioned mesh data provider"
+
+    def isValid(self):
+        return PartitionedMeshDataProvider.isValid(self) \
+                and os.path.isfile(self.__file("mesh.json"))
+
+    def valueAtElement(self):
+        return self.__valueAtElement
+
+    def blockExtents(self):
+        return self.__extents
+
+    def blockNodeCoord(self, block):
+        return numpy.load(self.__file(str(block), "nodeCoord.npy"), mmap_mode='r')
+
+    def blockTriangles(self, block):
+        return numpy.load(self.__file(str(block), "triangles.npy"), mmap_mode='r')
+
+    def blockOverview(self, block):
+        # written by partitionMesh, computed for older directories
+        if not os.path.isfile(self.__file(str(block), "overviewIndices.npy")):
+            return PartitionedMeshDataProvider.blockOverview(self, block)
+        return tuple(numpy.load(self.__file(str(block), "overview%s.npy"%name))
+                for name in ("NodeCoord", "Triangles", "Indices"))
+
+    def blockValues(self, block, didx):
+        # the maps of values are kept, they do not hold memory
+        if block not in self.__values:
+            self.__values[block] = numpy.load(self.__file(str(block), "values.npy"), mmap_mode='r')
+        return self.__values[block][didx]
+
+    def readXml(self, node):
+        if not PartitionedMeshDataProvider.readXml(self, node):
+            return False
+        self.__open()
+        return True
+
+def partitionMesh(directory, vtx, idx, dateValues, nbDates, valueAtElement=False,
+        dates=None, trianglesPerBlock=TRIANGLES_PER_BLOCK):
+    """write a mesh split in blocks of about trianglesPerBlock triangles, and
+    their overviews, in directory, to be read by NpyPartitionedMeshDataProvider.
+    Triangles are assigned to the cell of a regular grid containing their
+    centroid.
+    dateValues(didx) returns the node values, or element values if
+    valueAtElement, of a date, it is called once per date. vtx and idx
+    may be memory mapped, they are read by chunks.
+    Return the number of blocks"""
+    nbTriangles = len(idx)
+    xmin, ymin = numpy.min(vtx[:, 0]), numpy.min(vtx[:, 1])
+    width = max(numpy.max(vtx[:, 0]) - xmin, 1e-12)
+    height = max(numpy.max(vtx[:, 1]) - ymin, 1e-12)
+    nbCells = max(int(ceil(float(nbTriangles)/trianglesPerBlock)), 1)
+    nx = max(int(round(sqrt(nbCells*width/height))), 1)
+    ny = max(int(ceil(float(nbCells)/nx)), 1)
+
+    cell = numpy.empty((nbTriangles,), dtype=numpy.int64)
+    for start in range(0, nbTriangles, CHUNK_SIZE):
+        tri = numpy.asarray(idx[start:start + CHUNK_SIZE])
+        centroid = numpy.asarray(vtx)[tri][:, :, :2].mean(axis=1)
+        i = numpy.clip(((centroid[:, 0] - xmin)*nx/width).astype(numpy.int64), 0, nx - 1)
+        j = numpy.clip(((centroid[:, 1] - ymin)*ny/height).astype(numpy.int64), 0, ny - 1)
+        cell[start:start + CHUNK_SIZE] = j*nx + i
+    order = numpy.argsort(cell, kind='mergesort')
+    bounds = numpy.searchsorted(cell[order], numpy.arange(nx*ny + 1))
+    del cell
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # original indices of the values of each block
+    valueIndices = []
+    extents = []
+    for c in range(nx*ny):
+        triangles = order[bounds[c]:bounds[c + 1]]
+        if not len(triangles):
+            continue
+        block = len(extents)
+        os.makedirs(os.path.join(directory, str(block)))
+        nodes, local = numpy.unique(numpy.asarray(idx)[triangles], return_inverse=True)
+        blockVtx = numpy.asarray(vtx)[nodes]
+        blockIdx = local.reshape((-1, 3)).astype(numpy.int32)
+        numpy.save(os.path.join(directory, str(block), "nodeCoord.npy"), blockVtx)
+        numpy.save(os.path.join(directory, str(block), "triangles.npy"), blockIdx)
+        for name, array in zip(("NodeCoord", "Triangles", "Indices"),
+                meshOverview(blockVtx, blockIdx, valueAtElement)):
+            numpy.save(os.path.join(directory, str(block), "overview%s.npy"%name), array)
+        extents.append((blockVtx[:, 0].min(), blockVtx[:, 1].min(),
+            blockVtx[:, 0].max(), blockVtx[:, 1].max()))
+        valueIndices.append(triangles if valueAtElement else nodes)
+    numpy.save(os.path.join(directory, "extents.npy"), numpy.array(extents).reshape((-1, 4)))
+
+    values = [numpy.lib.format.open_memmap(os.path.join(directory, str(block), "values.npy"),
+        'w+', numpy.float32, (nbDates, len(indices))) for block, indices in enumerate(valueIndices)]
+    for didx in range(nbDates):
+        val = numpy.asarray(dateValues(didx))
+        for blockValues, indices in zip(values, valueIndices):
+            blockValues[didx] = val[indices]
+    for blockValues in values:
+        blockValues.flush()
+    del values
+
+    # the description is written last, a partial directory is not valid
+    with open(os.path.join(directory, "mesh.json"), 'w') as fil:
+        json.dump({'dates': list(dates) if dates is not None else list(range(nbDates)),
+                   'valueAtElement': bool(valueAtElement),
+                   'nbBlocks': len(extents)}, fil)
+    return len(extents)
+
+class _Block(object):
+    """a block, or block overview, loaded by PartitionedMesh: the drawn arrays,
+    the indices of its values in the block values, None for all, and the
+    resources the backend mesh derived from them, kept while it is loaded"""
+
+    def __init__(self, vtx, idx, indices):
+        self.vtx = vtx
+        self.idx = idx
+        self.indices = indices
+        self.resources = []
+        self.arrayBytes = numpy.asarray(vtx).nbytes + numpy.asarray(idx).nbytes
+        self.nbBytes = self.arrayBytes
+
+class PartitionedMesh(object):
+    """Draws a PartitionedMeshDataProvider block by block with one mesh of the
+    backend class meshType (GlMesh or NumpyMesh), so that all blocks are
+    drawn in the same context. Only the blocks intersecting the view are
+    loaded, the least recently used ones are dropped when the size of the
+    loaded blocks exceeds the memory budget: their coordinates and
+    connectivity and the spatial indices, hierarchies and buffer objects
+    the backend derives from them. When the visible blocks do not fit in
+    the budget, their overviews are drawn instead (see
+    PartitionedMeshDataProvider.blockOverview). The images of the blocks
+    are composited.
+
+    Blocks are loaded in the thread that draws, as the backend mesh, draws
+    are serialized.
+    """
+
+    def __init__(self, provider, meshType, legend, maxBytes=MAX_BYTES):
+        self.__provider = provider
+        self.__legend = legend
+        self.__maxBytes = maxBytes
+        self.__colorPerElement = False
+        self.__sourceCrs = None
+        self.__destCrs = None
+        self.__extents = numpy.asarray(provider.blockExtents(), dtype=numpy.float64).reshape((-1, 4))
+        # the mesh all blocks are drawn with, one at a time
+        self.__mesh = meshType(numpy.empty((0, 3), dtype=numpy.float32),
+                numpy.empty((0, 3), dtype=numpy.int32), legend)
+        self.__drawLock = threading.Lock()
+        # guards the loaded blocks by block index, or ('overview', block
+        # index), least recently used first
+        self.__lock = threading.Lock()
+        self.__blocks = OrderedDict()
+        self.__nbBytes = 0
+        # (array bytes, bytes once drawn) of blocks drawn before and array
+        # bytes of the others, to tell if the visible blocks fit in the budget
+        self.__drawnBytes = {}
+        self.__arrayBytes = {}
+
+    def setLegend(self, legend):
+        self.__legend = legend
+        self.__mesh.setLegend(legend)
+
+    def setColorPerElement(self, flag):
+        if flag == self.__colorPerElement:
+            return
+        self.__colorPerElement = flag
+        with self.__drawLock:
+            self.__mesh.setColorPerElement(flag)
+        # the backend resources of the blocks depend on it
+        self.clear()
+
+    def colorPerElement(self):
+        return self.__colorPerElement
+
+    def setMemoryBudget(self, maxBytes):
+        with self.__lock:
+            self.__maxBytes = maxBytes
+            self.__evict(0)
+
+    def memoryBudget(self):
+        return self.__maxBytes
+
+    def loadedBytes(self):
+        return self.__nbBytes
+
+    def clear(self):
+        """drop the loaded blocks"""
+        with self.__lock:
+            self.__blocks.clear()
+            self.__nbBytes = 0
+            self.__drawnBytes = {}
+            self.__arrayBytes = {}
+
+    def setCrs(self, sourceCrs, destCrs):
+        """draw in destCrs, the blocks are reprojected when they are loaded,
+        destCrs None draws in the provider CRS"""
+        self.__sourceCrs, self.__destCrs = sourceCrs, destCrs
+        extents = numpy.asarray(self.__provider.blockExtents(), dtype=numpy.float64).reshape((-1, 4))
+        if destCrs is not None and len(extents):
+            # corners and middles of the sides of each extent
+            fx = numpy.array([0, .5, 1, 1, 1, .5, 0, 0])
+            fy = numpy.array([0, 0, 0, .5, 1, 1, 1, .5])
+            points = numpy.zeros((len(extents)*len(fx), 3))
+            points[:, 0] = (extents[:, 0:1] + fx*(extents[:, 2:3] - extents[:, 0:1])).reshape((-1,))
+            points[:, 1] = (extents[:, 1:2] + fy*(extents[:, 3:4] - extents[:, 1:2])).reshape((-1,))
+            points = transformCoordinates(points, sourceCrs, destCrs).reshape((len(extents), len(fx), 3))
+            extents = numpy.column_stack((points[:, :, 0].min(axis=1), points[:, :, 1].min(axis=1),
+                points[:, :, 0].max(axis=1), points[:, :, 1].max(axis=1)))
+        self.__extents = extents
+        self.clear()
+
+    def visibleBlocks(self, extent):
+        """return the array of indices of blocks intersecting the extent
+        (xmin, ymin, xmax, ymax)"""
+        e = self.__extents
+        return numpy.nonzero((e[:, 0] <= extent[2]) & (e[:, 2] >= extent[0])
+                & (e[:, 1] <= extent[3]) & (e[:, 3] >= extent[1]))[0]
+
+    def __estimatedBytes(self, blocks):
+        """return the size of blocks once drawn, measured for the blocks
+        drawn before, estimated from the size of their arrays for the others"""
+        with self.__lock:
+            drawn = list(self.__drawnBytes.values())
+            ratio = float(sum(d for a, d in drawn))/max(sum(a for a, d in drawn), 1) \
+                    if drawn else 1.
+            nbBytes = 0
+            for block in blocks:
+                if block in self.__drawnBytes:
+                    nbBytes += self.__drawnBytes[block][1]
+                    continue
+                if block not in self.__arrayBytes:
+                    # memory maps for most providers, nothing is read
+                    self.__arrayBytes[block] = \
+                            numpy.asarray(self.__provider.blockNodeCoord(block)).nbytes \
+                            + numpy.asarray(self.__provider.blockTriangles(block)).nbytes
+                nbBytes += int(ratio*self.__arrayBytes[block])
+        return nbBytes
+
+    def __evict(self, nbBytes):
+        # the lock is held by the caller
+        while self.__blocks and self.__nbBytes + nbBytes > self.__maxBytes:
+            self.__nbBytes -= self.__blocks.popitem(last=False)[1].nbBytes
+
+    def __block(self, key):
+        """return the block of a key, block index or ('overview', block
+        index), loaded if needed"""
+        with self.__lock:
+            if key in self.__blocks:
+                self.__blocks[key] = self.__blocks.pop(key)
+                return self.__blocks[key]
+        if isinstance(key, tuple):
+            vtx, idx, indices = self.__provider.blockOverview(key[1])
+        else:
+            vtx, idx, indices = self.__provider.blockNodeCoord(key), \
+                    self.__provider.blockTriangles(key), None
+        if self.__destCrs is not None:
+            with stage("reprojection"):
+                vtx = transformCoordinates(vtx, self.__sourceCrs, self.__destCrs)
+        block = _Block(vtx, idx, indices)
+        with self.__lock:
+            self.__evict(block.nbBytes)
+            self.__blocks[key] = block
+            self.__nbBytes += block.nbBytes
+        return block
+
+    def __setResources(self, key, block, resources, nbBytes):
+        """keep the backend resources of a drawn block and count their size"""
+        with self.__lock:
+            block.resources = resources
+            if self.__blocks.get(key) is block:
+                self.__nbBytes += block.arrayBytes + nbBytes - block.nbBytes
+            block.nbBytes = block.arrayBytes + nbBytes
+            if not isinstance(key, tuple):
+                self.__drawnBytes[key] = (block.arrayBytes, block.nbBytes)
+            self.__evict(0)
+
+    def __geometryKey(self, key):
+        return (self.__provider.geometryKey(),
+                crsKey(self.__destCrs) if self.__destCrs is not None else None, key)
+
+    def image(self, didx, imageSize, center, mapUnitsPerPixel, rotation=0):
+        """Return the rendered image of the values of the date index didx,
+        see GlMesh.image"""
+        bgra = self.array(didx, imageSize, center, mapUnitsPerPixel, rotation)
+        with stage("crop"):
+            # detached, see GlMesh.image
+            return bgra2qimage(bgra).copy()
+
+    def array(self, didx, imageSize, center, mapUnitsPerPixel, rotation=0):
+        """Return the rendered image as a (height, width, 4) uint8 array of
+        premultiplied BGRA colors, blocks are drawn over each other"""
+        extent = viewExtent((imageSize.width(), imageSize.height()),
+                center, mapUnitsPerPixel, rotation)
+        out = numpy.zeros((imageSize.height(), imageSize.width(), 4), dtype=numpy.uint8)
+        visible = self.visibleBlocks(extent)
+        overview = self.__estimatedBytes(visible) > self.__maxBytes
+        with self.__drawLock:
+            for b in visible:
+                key = ('overview', b) if overview else b
+                block = self.__block(key)
+                values = self.__provider.blockValues(b, didx)
+                if block.indices is not None:
+                    values = numpy.asarray(values)[block.indices]
+                self.__mesh.resetMesh(block.vtx, block.idx, self.__geometryKey(key))
+                bgra = self.__mesh.array(values, imageSize, center, mapUnitsPerPixel, rotation)
+                self.__setResources(key, block, *self.__mesh.sharedResources())
+                with stage("composite"):
+                    drawn = bgra[:, :, 3] > 0
+                    # premultiplied colors, out = src + (1 - src alpha)*out
+                    transparency = (255 - bgra[drawn][:, 3:4]).astype(numpy.uint16)
+                    out[drawn] = bgra[drawn] + ((out[drawn]*transparency + 127)//255).astype(numpy.uint8)
+        return out
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from qgis.core import QgsCoordinateTransform
+
+import numpy
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    from osgeo import osr
+except ImportError:
+    osr = None
+
+# number of nodes transformed in one call
+CHUNK_SIZE = 1 << 18
+
+def crsKey(crs):
+    """return a hashable key identifying a QgsCoordinateReferenceSystem"""
+    return crs.authid() or crs.toProj4()
+
+def cacheName(sourceCrs, destCrs):
+    """return the name identifying the reprojection in a MeshCacheEntry"""
+    return hashlib.sha1((crsKey(sourceCrs) + " " + crsKey(destCrs)).encode('utf-8')).hexdigest()
+
+def _osrTransformation(sourceCrs, destCrs):
+    src = osr.SpatialReference()
+    dst = osr.SpatialReference()
+    if src.ImportFromWkt(str(sourceCrs.toWkt())) or dst.ImportFromWkt(str(destCrs.toWkt())):
+        return None
+    # gdal >= 3 follows the authority axis order by default
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(src, dst)
+
+def transformCoordinates(vtx, sourceCrs, destCrs, chunkSize=CHUNK_SIZE):
+    """return a (nbNodes, 3) float64 array of the node coordinates vtx transformed
+    from sourceCrs to destCrs, the z coordinate is left unchanged.
+    The transformation is done in batches of chunkSize nodes with osr if
+    available, node by node with QgsCoordinateTransform otherwise"""
+    vtx = numpy.asarray(vtx)
+    out = numpy.array(vtx, dtype=numpy.float64)
+    transformation = _osrTransformation(sourceCrs, destCrs) if osr else None
+    if transformation:
+        for start in range(0, len(vtx), chunkSize):
+            xy = out[start:start+chunkSize, :2].tolist()
+            out[start:start+chunkSize, :2] = \
+                    numpy.array(transformation.TransformPoints(xy))[:, :2]
+    else:
+        transform = QgsCoordinateTransform(sourceCrs, destCrs)
+        for i, (x, y) in enumerate(out[:, :2].tolist()):
+            p = transform.transform(x, y)
+            out[i, 0], out[i, 1] = p.x(), p.y()
+    return out
+
+class CoordinateCache(object):
+    """keeps reprojected node coordinates keyed by
+    (source CRS, destination CRS, mesh version), the least recently
+    used arrays are dropped when more than maxSize are stored.
+    If a MeshCacheEntry is set, reprojected coordinates are also
+    stored on disk. The cache can be shared by several layers, from
+    several rendering threads"""
+
+    def __init__(self, maxSize=4):
+        self.__maxSize = maxSize
+        self.__cache = OrderedDict()
+        self.__entry = None
+        # held while coordinates are computed, they are computed once
+        self.__lock = threading.Lock()
+
+    def setMeshCacheEntry(self, entry):
+        self.__entry = entry
+
+    def coordinates(self, vtx, sourceCrs, destCrs, meshVersion=0):
+        """return vtx in destCrs, reprojected only on cache miss"""
+        with self.__lock:
+            key = (crsKey(sourceCrs), crsKey(destCrs), meshVersion)
+            if key in self.__cache:
+                self.__cache[key] = self.__cache.pop(key)
+            else:
+                compute = lambda: transformCoordinates(vtx, sourceCrs, destCrs)
+                if self.__entry:
+                    name = "coord_" + cacheName(sourceCrs, destCrs)
+                    self.__cache[key] = self.__entry.get(name, compute)
+                else:
+                    self.__cache[key] = compute()
+                while len(self.__cache) > self.__maxSize:
+                    self.__cache.popitem(last=False)
+            return self.__cache[key]
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
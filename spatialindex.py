@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+from math import sin, cos, radians, sqrt
+
+def viewExtent(imageSize, center, mapUnitsPerPixel, rotation=0):
+    """return (xmin, ymin, xmax, ymax) the bounding box of the area
+    rendered by GlMesh.image with the same parameters"""
+    c, s = abs(cos(radians(rotation))), abs(sin(radians(rotation)))
+    hx = .5*imageSize[0]*mapUnitsPerPixel[0]
+    hy = .5*imageSize[1]*mapUnitsPerPixel[1]
+    dx, dy = c*hx + s*hy, s*hx + c*hy
+    return (center[0] - dx, center[1] - dy, center[0] + dx, center[1] + dy)
+
+class TriangleGrid(object):
+    """Uniform grid over the bounding boxes of the triangles of a mesh.
+
+    Triangle indices are stored cell by cell in a single array, cells are
+    numbered row by row so that the triangles of a range of cells in a row
+    are contiguous. In a cell, triangles are sorted by decreasing overlap
+    of their bounding box with the cell, the ones most likely to contain
+    a point of the cell come first.
+    """
+
+    # average number of triangles per cell
+    TRIANGLES_PER_CELL = 4
+
+    def __init__(self, vtx, idx, trianglesPerCell=TRIANGLES_PER_CELL):
+        """a finer grid, with less than one triangle per cell, reduces
+        the number of triangles tested by locate"""
+        vtx = numpy.asarray(vtx)
+        idx = numpy.asarray(idx).reshape((-1, 3))
+        self.__vtx = vtx
+        self.__idx = idx
+        self.__coefficients = None
+        x = vtx[idx, 0]
+        y = vtx[idx, 1]
+        self.__nbTriangles = len(idx)
+        self.__triMin = numpy.column_stack((x.min(axis=1), y.min(axis=1))) \
+                if len(idx) else numpy.empty((0, 2))
+        self.__triMax = numpy.column_stack((x.max(axis=1), y.max(axis=1))) \
+                if len(idx) else numpy.empty((0, 2))
+        if not len(idx):
+            self.__extent = (0., 0., 0., 0.)
+            self.__shape = (1, 1)
+            self.__cellSize = (1., 1.)
+            self.__start = numpy.zeros((2,), dtype=numpy.int64)
+            self.__triangles = numpy.empty((0,), dtype=numpy.int32)
+            return
+
+        xmin, ymin = self.__triMin.min(axis=0)
+        xmax, ymax = self.__triMax.max(axis=0)
+        self.__extent = (float(xmin), float(ymin), float(xmax), float(ymax))
+        w, h = max(xmax - xmin, 1e-12), max(ymax - ymin, 1e-12)
+        nbCells = max(1., float(len(idx))/trianglesPerCell)
+        size = sqrt(w*h/nbCells)
+        nx = int(min(max(1, w/size), nbCells))
+        ny = int(min(max(1, h/size), nbCells))
+        self.__shape = (nx, ny)
+        self.__cellSize = (w/nx, h/ny)
+
+        ix0, iy0 = self.__cell(self.__triMin)
+        ix1, iy1 = self.__cell(self.__triMax)
+        nbx = ix1 - ix0 + 1
+        count = nbx*(iy1 - iy0 + 1)
+        first = numpy.cumsum(count) - count
+        local = numpy.arange(int(count.sum())) - numpy.repeat(first, count)
+        tri = numpy.repeat(numpy.arange(len(idx)), count)
+        cellX = ix0[tri] + local % nbx[tri]
+        cellY = iy0[tri] + local // nbx[tri]
+        cell = cellY*nx + cellX
+        cellXMin = xmin + cellX*self.__cellSize[0]
+        cellYMin = ymin + cellY*self.__cellSize[1]
+        # fraction of the cell covered by the bounding box, a sort key in
+        # [cell, cell + 1) orders triangles by cell, then by decreasing overlap
+        overlap = (numpy.minimum(self.__triMax[tri, 0], cellXMin + self.__cellSize[0])
+                - numpy.maximum(self.__triMin[tri, 0], cellXMin)) \
+            * (numpy.minimum(self.__triMax[tri, 1], cellYMin + self.__cellSize[1])
+                - numpy.maximum(self.__triMin[tri, 1], cellYMin)) \
+            / (self.__cellSize[0]*self.__cellSize[1])
+        order = numpy.argsort(cell + .5*(1. - numpy.clip(overlap, 0., 1.)), kind='mergesort')
+        self.__triangles = numpy.require(tri[order], numpy.int32)
+        self.__start = numpy.searchsorted(cell[order], numpy.arange(nx*ny + 1))
+
+    def __cell(self, xy):
+        """return cell indices (ix, iy) of points, clamped to the grid"""
+        ix = numpy.floor((xy[:, 0] - self.__extent[0])/self.__cellSize[0]).astype(numpy.int64)
+        iy = numpy.floor((xy[:, 1] - self.__extent[1])/self.__cellSize[1]).astype(numpy.int64)
+        return (numpy.clip(ix, 0, self.__shape[0] - 1),
+                numpy.clip(iy, 0, self.__shape[1] - 1))
+
+    def arrays(self):
+        """return the dictionary of arrays defining the grid, see fromArrays"""
+        return {'extent': numpy.array(self.__extent, dtype=numpy.float64),
+                'shape': numpy.array(self.__shape, dtype=numpy.int64),
+                'cellSize': numpy.array(self.__cellSize, dtype=numpy.float64),
+                'triMin': self.__triMin,
+                'triMax': self.__triMax,
+                'start': self.__start,
+                'triangles': self.__triangles}
+
+    @staticmethod
+    def fromArrays(vtx, idx, arrays):
+        """return the grid of the mesh (vtx, idx) defined by arrays, as returned
+        by arrays(), without building it, e.g. from memory maps shared
+        by several processes"""
+        grid = TriangleGrid.__new__(TriangleGrid)
+        grid.__vtx = numpy.asarray(vtx)
+        grid.__idx = numpy.asarray(idx).reshape((-1, 3))
+        grid.__coefficients = None
+        grid.__nbTriangles = len(grid.__idx)
+        grid.__extent = tuple(float(v) for v in arrays['extent'])
+        grid.__shape = tuple(int(v) for v in arrays['shape'])
+        grid.__cellSize = tuple(float(v) for v in arrays['cellSize'])
+        grid.__triMin = arrays['triMin']
+        grid.__triMax = arrays['triMax']
+        grid.__start = arrays['start']
+        grid.__triangles = arrays['triangles']
+        return grid
+
+    def nbytes(self):
+        """return the size of the grid in bytes, barycentric coefficients
+        included once computed"""
+        return sum(numpy.asarray(array).nbytes for array in self.arrays().values()) \
+                + (self.__coefficients.nbytes if self.__coefficients is not None else 0)
+
+    def extent(self):
+        """return (xmin, ymin, xmax, ymax) of the mesh"""
+        return self.__extent
+
+    def intersects(self, xmin, ymin, xmax, ymax):
+        """return True if the box intersects the mesh extent"""
+        return self.__nbTriangles > 0 \
+            and xmin <= self.__extent[2] and xmax >= self.__extent[0] \
+            and ymin <= self.__extent[3] and ymax >= self.__extent[1]
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """return the sorted array of indices of triangles whose bounding
+        box intersects the box"""
+        if not self.intersects(xmin, ymin, xmax, ymax):
+            return numpy.empty((0,), dtype=numpy.int64)
+        (ix0, ix1), (iy0, iy1) = self.__cell(numpy.array([[xmin, ymin], [xmax, ymax]]))
+        nx = self.__shape[0]
+        rows = numpy.arange(iy0, iy1 + 1)
+        begin = self.__start[rows*nx + ix0]
+        end = self.__start[rows*nx + ix1 + 1]
+        count = end - begin
+        first = numpy.cumsum(count) - count
+        pos = numpy.arange(int(count.sum())) - numpy.repeat(first - begin, count)
+        candidates = numpy.unique(self.__triangles[pos])
+        keep = numpy.logical_and(
+            numpy.logical_and(self.__triMin[candidates, 0] <= xmax, self.__triMax[candidates, 0] >= xmin),
+            numpy.logical_and(self.__triMin[candidates, 1] <= ymax, self.__triMax[candidates, 1] >= ymin))
+        return candidates[keep]
+
+    def locate(self, points):
+        """return a tuple (triangles, barycentric) for an (nbPoints, 2) array of
+        coordinates: triangles is the index of the triangle containing each
+        point, -1 for points outside the mesh, barycentric the (nbPoints, 3)
+        array of the point coordinates relative to the triangle nodes"""
+        points = numpy.asarray(points, dtype=numpy.float64).reshape((-1, 2))
+        triangles = -numpy.ones((len(points),), dtype=numpy.int64)
+        barycentric = numpy.zeros((len(points), 3))
+        xmin, ymin, xmax, ymax = self.__extent
+        inExtent = numpy.nonzero(numpy.logical_and(
+            numpy.logical_and(points[:, 0] >= xmin, points[:, 0] <= xmax),
+            numpy.logical_and(points[:, 1] >= ymin, points[:, 1] <= ymax)))[0]
+        if not self.__nbTriangles or not len(inExtent):
+            return triangles, barycentric
+
+        coef = self.__barycentricCoefficients()
+        ix, iy = self.__cell(points[inExtent])
+        cell = iy*self.__shape[0] + ix
+        # points are processed by cell for memory locality
+        order = numpy.argsort(cell)
+        inExtent, cell = inExtent[order], cell[order]
+        # position of the next candidate of each point not yet located
+        # and end of its candidates, the arrays of points are compacted
+        # as they are located so that they leave the search early
+        position = self.__start[cell]
+        end = self.__start[cell + 1]
+        x, y = points[inExtent, 0], points[inExtent, 1]
+        eps = -1e-10
+        while len(inExtent):
+            left = position < end
+            if not left.all():
+                inExtent, position, end, x, y = \
+                        inExtent[left], position[left], end[left], x[left], y[left]
+                if not len(inExtent):
+                    break
+            tri = self.__triangles[position]
+            c = coef[tri]
+            l0 = c[:, 0]*x + c[:, 1]*y + c[:, 2]
+            l1 = c[:, 3]*x + c[:, 4]*y + c[:, 5]
+            l2 = 1. - l0 - l1
+            inside = numpy.logical_and(numpy.logical_and(l0 >= eps, l1 >= eps), l2 >= eps)
+            found = inExtent[inside]
+            triangles[found] = tri[inside]
+            barycentric[found, 0] = l0[inside]
+            barycentric[found, 1] = l1[inside]
+            barycentric[found, 2] = l2[inside]
+            outside = numpy.logical_not(inside)
+            inExtent, position, end, x, y = \
+                    inExtent[outside], position[outside] + 1, end[outside], x[outside], y[outside]
+        return triangles, barycentric
+
+    def __barycentricCoefficients(self):
+        """return the (nbTriangles, 6) array (a0, b0, c0, a1, b1, c1) such that
+        the barycentric coordinates of (x, y) are l0 = a0*x + b0*y + c0 and
+        l1 = a1*x + b1*y + c1, coefficients of flat triangles are zero"""
+        if self.__coefficients is None:
+            nodes = self.__vtx[self.__idx, :2].astype(numpy.float64)
+            x, y = nodes[:, :, 0], nodes[:, :, 1]
+            det = (y[:, 1] - y[:, 2])*(x[:, 0] - x[:, 2]) + (x[:, 2] - x[:, 1])*(y[:, 0] - y[:, 2])
+            # a flat triangle has l0 = l1 = 0 and l2 = 1 everywhere, it is
+            # excluded by making l0 negative
+            flat = det == 0
+            det[flat] = 1
+            coef = numpy.empty((len(det), 6))
+            coef[:, 0] = (y[:, 1] - y[:, 2])/det
+            coef[:, 1] = (x[:, 2] - x[:, 1])/det
+            coef[:, 2] = -coef[:, 0]*x[:, 2] - coef[:, 1]*y[:, 2]
+            coef[:, 3] = (y[:, 2] - y[:, 0])/det
+            coef[:, 4] = (x[:, 0] - x[:, 2])/det
+            coef[:, 5] = -coef[:, 3]*x[:, 2] - coef[:, 4]*y[:, 2]
+            coef[flat] = 0
+            coef[flat, 2] = -1
+            self.__coefficients = coef
+        return self.__coefficients
+
+# run as script for testing
+if __name__ == "__main__":
+    # a square of 2*n*n triangles, the points on the diagonals of cells
+    # and out of the mesh included
+    n = 100
+    x, y = numpy.meshgrid(numpy.arange(n + 1.), numpy.arange(n + 1.))
+    vtx = numpy.column_stack((x.reshape((-1,)), y.reshape((-1,)), numpy.zeros(((n + 1)**2,))))
+    i, j = [a.reshape((-1,)) for a in numpy.meshgrid(numpy.arange(n), numpy.arange(n))]
+    a = j*(n + 1) + i
+    idx = numpy.vstack((numpy.column_stack((a, a + 1, a + n + 2)),
+        numpy.column_stack((a, a + n + 2, a + n + 1))))
+    points = numpy.vstack((numpy.random.RandomState(0).uniform(-1, n + 1, (100000, 2)),
+        [[.5, .5], [n, n], [0, 0]]))
+    for trianglesPerCell in (TriangleGrid.TRIANGLES_PER_CELL, .5):
+        grid = TriangleGrid(vtx, idx, trianglesPerCell)
+        triangles, barycentric = grid.locate(points)
+        inside = numpy.logical_and(numpy.all(points >= 0, axis=1), numpy.all(points <= n, axis=1))
+        assert((triangles >= 0).tolist() == inside.tolist())
+        assert(barycentric[inside].min() >= -1e-9)
+        located = (barycentric[inside, :, numpy.newaxis]*vtx[idx[triangles[inside]], :2]).sum(axis=1)
+        assert(numpy.abs(located - points[inside]).max() < 1e-9)
+
+        # the triangles whose bounding box intersects a box
+        box = (10.2, 20.7, 30.1, 25.)
+        candidates = grid.query(*box)
+        xy = vtx[idx, :2]
+        expected = numpy.nonzero(numpy.logical_and(
+            numpy.logical_and(xy[:, :, 0].min(axis=1) <= box[2], xy[:, :, 0].max(axis=1) >= box[0]),
+            numpy.logical_and(xy[:, :, 1].min(axis=1) <= box[3], xy[:, :, 1].max(axis=1) >= box[1])))[0]
+        assert(candidates.tolist() == expected.tolist())
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# qgis is only imported by exportTiles, worker processes import this
+# module without it
+
+import numpy
+import os
+import time
+import shutil
+import struct
+import zlib
+import tempfile
+
+from numpymesh import rasterize, colorize
+from spatialindex import TriangleGrid
+from lod import MeshHierarchy
+from utilities import processPool, imapByGroup
+
+TILE_SIZE = 256
+
+# number of dates whose values are saved for the workers ahead of the
+# tiles being rendered
+DATES_AHEAD = 2
+
+# half size of the web mercator square
+ORIGIN_SHIFT = 20037508.342789244
+
+def tileExtent(z, x, y):
+    """return (xmin, ymin, xmax, ymax) of a tile in EPSG:3857"""
+    span = 2*ORIGIN_SHIFT/(1 << z)
+    return (-ORIGIN_SHIFT + x*span, ORIGIN_SHIFT - (y + 1)*span,
+            -ORIGIN_SHIFT + (x + 1)*span, ORIGIN_SHIFT - y*span)
+
+def tileRange(z, extent):
+    """return (xmin, ymin, xmax, ymax) the range of tiles intersecting the
+    extent in EPSG:3857"""
+    span = 2*ORIGIN_SHIFT/(1 << z)
+    last = (1 << z) - 1
+    clamp = lambda v: min(max(int(v), 0), last)
+    return (clamp((extent[0] + ORIGIN_SHIFT)/span), clamp((ORIGIN_SHIFT - extent[3])/span),
+            clamp((extent[2] + ORIGIN_SHIFT)/span), clamp((ORIGIN_SHIFT - extent[1])/span))
+
+def writePng(fileName, bgra):
+    """write a (height, width, 4) array of premultiplied BGRA colors
+    as a RGBA png file"""
+    height, width = bgra.shape[:2]
+    alpha = bgra[..., 3].astype(numpy.float64)
+    scale = numpy.where(alpha > 0, 255./numpy.maximum(alpha, 1), 0)
+    rgba = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    for dst, src in ((0, 2), (1, 1), (2, 0)):
+        rgba[..., dst] = numpy.clip(numpy.rint(bgra[..., src]*scale), 0, 255)
+    rgba[..., 3] = bgra[..., 3]
+    # each row starts with filter type 0
+    raw = numpy.zeros((height, 1 + 4*width), dtype=numpy.uint8)
+    raw[:, 1:] = rgba.reshape((height, -1))
+    def chunk(tag, data):
+        return struct.pack("!I", len(data)) + tag + data \
+            + struct.pack("!I", zlib.crc32(tag + data) & 0xffffffff)
+    with open(fileName, 'wb') as fil:
+        fil.write(b"\x89PNG\r\n\x1a\n")
+        fil.write(chunk(b"IHDR", struct.pack("!2I5B", width, height, 8, 6, 0, 0, 0)))
+        fil.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        fil.write(chunk(b"IEND", b""))
+
+# state of a worker process, set by _initWorker
+_worker = {}
+
+def _saveArrays(directory, prefix, arrays):
+    """save a dictionary of arrays as prefix<name>.npy files"""
+    for name, array in arrays.items():
+        numpy.save(os.path.join(directory, prefix+name+".npy"), numpy.asarray(array))
+
+def _loadArrays(directory, prefix):
+    """return the dictionary of memory maps of arrays saved by _saveArrays"""
+    return dict((fileName[len(prefix):-len(".npy")],
+            numpy.load(os.path.join(directory, fileName), mmap_mode='r'))
+        for fileName in os.listdir(directory)
+        if fileName.startswith(prefix) and fileName.endswith(".npy"))
+
+def _initWorker(meshDirectory, perElement, colorParameters, outputDirectory):
+    vtx = numpy.load(os.path.join(meshDirectory, "nodeCoord.npy"), mmap_mode='r')
+    idx = numpy.load(os.path.join(meshDirectory, "triangles.npy"), mmap_mode='r')
+    _worker.clear()
+    _worker.update({
+        'meshDirectory': meshDirectory,
+        'vtx': vtx,
+        'idx': idx,
+        'grid': TriangleGrid.fromArrays(vtx, idx, _loadArrays(meshDirectory, "grid.")),
+        'hierarchy': MeshHierarchy.fromArrays(_loadArrays(meshDirectory, "hierarchy.")),
+        'perElement': perElement,
+        'colorParameters': colorParameters,
+        'outputDirectory': outputDirectory,
+        'values': {}})
+
+def _values(didx, level):
+    """return values of a date at a level of detail, cached for the current date"""
+    cache = _worker['values']
+    if cache.get('date') != didx:
+        cache.clear()
+        cache['date'] = didx
+        cache[0] = numpy.load(os.path.join(_worker['meshDirectory'], "values_%d.npy"%didx),
+                mmap_mode='r')
+    if level not in cache:
+        hierarchy = _worker['hierarchy']
+        cache[level] = hierarchy.elementValues(level, cache[0]) if _worker['perElement'] \
+                else hierarchy.nodeValues(level, cache[0])
+    return cache[level]
+
+def _renderTile(task):
+    """render and write a tile, return True if the tile is written, False if it
+    is empty"""
+    didx, z, x, y = task
+    xmin, ymin, xmax, ymax = tileExtent(z, x, y)
+    visible = _worker['grid'].query(xmin, ymin, xmax, ymax)
+    if not len(visible):
+        return False
+    center = (.5*(xmin + xmax), .5*(ymin + ymax))
+    resolution = (xmax - xmin)/TILE_SIZE
+    hierarchy = _worker['hierarchy']
+    level = hierarchy.level((resolution, resolution))
+    values = _values(didx, level)
+    if level:
+        vtx, idx = hierarchy.vertices(level), hierarchy.triangles(level)
+        visible = hierarchy.spatialIndex(level).query(xmin, ymin, xmax, ymax)
+    else:
+        vtx, idx = _worker['vtx'], _worker['idx']
+    idx = idx[visible]
+    if _worker['perElement']:
+        values = values[visible]
+    bgra = colorize(rasterize(vtx, idx, values, (TILE_SIZE, TILE_SIZE),
+            center, (resolution, resolution), 0, _worker['perElement']),
+            _worker['colorParameters'])
+    if not bgra[..., 3].any():
+        return False
+    directory = os.path.join(_worker['outputDirectory'], str(didx), str(z), str(x))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another worker
+            pass
+    writePng(os.path.join(directory, "%d.png"%y), bgra)
+    return True
+
+def exportTiles(provider, legend, outputDirectory, minZoom, maxZoom, dates=None,
+        processes=None, progress=None, cancelled=None):
+    """render the mesh of a MeshDataProvider colored by a ColorLegend as web map
+    tiles written in outputDirectory/<date index>/<z>/<x>/<y>.png for the zoom
+    levels minZoom to maxZoom and each date index in dates (the current date
+    by default). Tiles are rendered by a pool of processes (one per cpu by
+    default) that memory map the mesh, its spatial index and level of detail
+    hierarchy, built once, tiles that do not intersect the mesh or are empty
+    are not written. The values of a date are saved for the workers
+    DATES_AHEAD dates before its tiles are rendered and removed after.
+    progress(done, total, tilesPerSecond) is called as tiles are rendered,
+    the export stops as soon as cancelled(), if provided, returns True.
+    Return a dictionary with the number of tiles 'written', 'empty',
+    if the export was 'cancelled', the 'seconds' spent and 'tilesPerSecond'"""
+    from qgis.core import QgsCoordinateReferenceSystem
+    from reprojection import transformCoordinates
+
+    start = time.time()
+    dates = [provider.date()] if dates is None else list(dates)
+    meshDirectory = tempfile.mkdtemp(prefix="meshlayer_tiles_")
+    written, done, isCancelled = 0, 0, False
+    try:
+        vtx = transformCoordinates(provider.nodeCoord(), provider.crs(),
+                QgsCoordinateReferenceSystem('EPSG:3857'))
+        idx = numpy.require(provider.triangles(), numpy.int32).reshape((-1, 3))
+        numpy.save(os.path.join(meshDirectory, "nodeCoord.npy"), vtx)
+        numpy.save(os.path.join(meshDirectory, "triangles.npy"), idx)
+        _saveArrays(meshDirectory, "grid.", TriangleGrid(vtx, idx).arrays())
+        # the spatial indices of the levels are built once too
+        hierarchy = MeshHierarchy(vtx, idx)
+        for level in range(1, hierarchy.nbLevels()):
+            hierarchy.spatialIndex(level)
+        _saveArrays(meshDirectory, "hierarchy.", hierarchy.arrays())
+
+        extent = (vtx[:, 0].min(), vtx[:, 1].min(), vtx[:, 0].max(), vtx[:, 1].max())
+        tiles = []
+        for z in range(minZoom, maxZoom + 1):
+            x0, y0, x1, y1 = tileRange(z, extent)
+            tiles += [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+        total = len(dates)*len(tiles)
+
+        valuesFile = lambda didx: os.path.join(meshDirectory, "values_%d.npy"%didx)
+        def saveValues(didx):
+            numpy.save(valuesFile(didx),
+                    numpy.require(provider.dateValues(didx), numpy.float32))
+        def removeValues(didx):
+            try:
+                os.remove(valuesFile(didx))
+            except OSError:
+                # still mapped by a worker on Windows, removed with the directory
+                pass
+
+        pool = processPool(processes, _initWorker,
+                (meshDirectory, provider.valueAtElement(), legend.colorParameters(),
+                    outputDirectory))
+        try:
+            for isWritten in imapByGroup(pool, _renderTile,
+                    [(didx, [(didx,) + tile for tile in tiles]) for didx in dates],
+                    saveValues, removeValues, 16, DATES_AHEAD):
+                done += 1
+                written += int(isWritten)
+                if progress:
+                    progress(done, total, done/(time.time() - start))
+                if cancelled and cancelled():
+                    isCancelled = True
+                    break
+            if isCancelled:
+                pool.terminate()
+            else:
+                pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        shutil.rmtree(meshDirectory)
+
+    seconds = time.time() - start
+    return {'written': written,
+            'empty': done - written,
+            'cancelled': isCancelled,
+            'seconds': seconds,
+            'tilesPerSecond': done/seconds if seconds else 0.}
+
+def exportLayerTiles(layer, outputDirectory, minZoom, maxZoom, dates=None,
+        processes=None, progress=None, cancelled=None):
+    """export the tiles of a MeshLayer with its color legend, see exportTiles"""
+    return exportTiles(layer.dataProvider(), layer.colorLegend(), outputDirectory,
+            minZoom, maxZoom, dates, processes, progress, cancelled)
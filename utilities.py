@@ -2,8 +2,14 @@
 
 import time
 import os
+import sys
+import weakref
+import threading
+import multiprocessing
+from collections import deque
 from math import log, exp as exp_
-from collections import defaultdict
+
+import numpy
 
 def complete_filename(name):
     return os.path.join(os.path.dirname(__file__), name)
@@ -25,47 +31,146 @@ def multiplier(value):
             mult = x
     return mult, multiplyers[mult]
 
+def _runRank(*keys):
+    """return the rank of each element in its run of equal keys, keys are
+    arrays sorted together"""
+    n = len(keys[0])
+    first = numpy.ones((n,), dtype=bool)
+    for k in keys:
+        first[1:] |= k[1:] != k[:-1]
+    position = numpy.arange(n)
+    return position - numpy.maximum.accumulate(numpy.where(first, position, 0))
+
+def stitch(starts, ends, directed=False):
+    """Returns the list of polylines formed by chaining the segments joining
+    the integer vertex identifiers starts[i] and ends[i], as arrays of
+    vertex identifiers, closed polylines end with their first vertex.
+
+    Segments sharing a vertex are paired in their order, if directed only
+    the end of a segment is paired with the start of another and polylines
+    follow the segments direction. Polylines are walked iteratively from
+    their open ends, then around the remaining loops, each segment is
+    visited once."""
+    starts = numpy.asarray(starts, dtype=numpy.int64).reshape((-1,))
+    ends = numpy.asarray(ends, dtype=numpy.int64).reshape((-1,))
+    n = len(starts)
+    if not n:
+        return []
+
+    # half i < n is the start of segment i, half i + n is its end
+    vertices = numpy.concatenate((starts, ends))
+    if directed:
+        side = numpy.repeat(numpy.array([0, 1]), n)
+        order = numpy.lexsort((side, vertices))
+        rank = numpy.empty((2*n,), dtype=numpy.int64)
+        rank[order] = _runRank(vertices[order], side[order])
+        order = numpy.lexsort((side, rank, vertices))
+        v, r, s = vertices[order], rank[order], side[order]
+        paired = (v[1:] == v[:-1]) & (r[1:] == r[:-1]) & (s[1:] != s[:-1])
+    else:
+        order = numpy.argsort(vertices, kind='mergesort')
+        v = vertices[order]
+        paired = (v[1:] == v[:-1]) & (_runRank(v)[:-1] % 2 == 0)
+    other = numpy.full((2*n,), -1, dtype=numpy.int64)
+    other[order[:-1][paired]] = order[1:][paired]
+    other[order[1:][paired]] = order[:-1][paired]
+
+    heads = numpy.nonzero(other < 0)[0]
+    if directed:
+        heads = heads[heads < n]
+    other = other.tolist()
+    vertices = vertices.tolist()
+    visited = [False]*n
+    lines = []
+    for h in heads.tolist() + list(range(n)):
+        if visited[h if h < n else h - n]:
+            continue
+        line = [vertices[h]]
+        while True:
+            s = h if h < n else h - n
+            if visited[s]:
+                break
+            visited[s] = True
+            # leave the segment by its other half
+            h = h + n if h < n else h - n
+            line.append(vertices[h])
+            h = other[h]
+            if h < 0:
+                break
+        lines.append(numpy.array(line, dtype=numpy.int64))
+    return lines
+
 def linemerge(lines):
-    """Returns a (set of) LineString(s) formed by sewing together a multilinestring."""
-    graph = defaultdict(set)
-    # first build a bidirectional graph
-    for line in lines:
-        b = tuple(line[0])
-        e = tuple(line[-1])
-        graph[b].add(e)
-        graph[e].add(b)
-    for k, v in graph.iteritems():
-        assert(len(v) in (1,2))
-
-    # now consume the graph
-    if not len(graph):
+    """Returns a list of lists of points formed by sewing together the end
+    points of lines, see stitch"""
+    if not len(lines):
         return []
+    points = numpy.array([(line[0], line[-1]) for line in lines], dtype=numpy.float64)
+    points = points.reshape((2*len(lines), -1))
+    # equal points get the same identifier
+    order = numpy.lexsort(points.T[::-1])
+    different = numpy.ones((len(points),), dtype=bool)
+    different[1:] = numpy.any(points[order[1:]] != points[order[:-1]], axis=1)
+    ids = numpy.empty((len(points),), dtype=numpy.int64)
+    ids[order] = numpy.cumsum(different) - 1
+    unique = points[order[different]]
+    return [[tuple(p) for p in unique[line].tolist()]
+            for line in stitch(ids[0::2], ids[1::2])]
 
-    def depth_first_append(graph, node):
-        connected=[node]
-        direction = "first"
-        neigbors = graph[node]
-        del graph[node]
-        for n in neigbors:
-            if n in graph:
-                if direction == "first":
-                    connected += depth_first_append(graph, n)
-                #else:
-                #    connected = list(reversed(depth_first_append(graph, n))) + connected
-            direction = "second"
-        return connected
-
-    out = []
-    while len(graph):
-        nxt = graph.iterkeys().next()
-        out.append(depth_first_append(graph, nxt))
-    return out
+def processPool(processes, initializer, initargs):
+    """return a multiprocessing.Pool whose processes run the python
+    interpreter, not the application embedding it, e.g. QGIS on Windows
+    where processes are spawned with sys.executable"""
+    if os.name == 'nt' and os.path.basename(sys.executable).lower() \
+            not in ('python.exe', 'pythonw.exe'):
+        python = os.path.join(sys.exec_prefix, 'pythonw.exe')
+        if os.path.exists(python):
+            multiprocessing.set_executable(python)
+    return multiprocessing.Pool(processes, initializer, initargs)
 
-# run as script for testing
-if __name__ == "__main__":
-    #@todo: unit test multiplier
-    #@todo: unit test linemerge
-    pass
+def imapByGroup(pool, func, groups, prepare, release, chunkSize=1, ahead=2):
+    """yield the results of func for the tasks of groups, a sequence of
+    (key, tasks), group after group and in no particular order in a group.
+    prepare(key) is called before the tasks of a group are submitted, at
+    most ahead groups before they are done, and release(key) when they
+    are done, e.g. to save the input of a group for the workers and
+    remove it"""
+    pending = deque()
+    groups = iter(groups)
+    def submit():
+        for key, tasks in groups:
+            prepare(key)
+            pending.append((key, pool.imap_unordered(func, tasks, chunkSize)))
+            return
+    for i in range(ahead):
+        submit()
+    while pending:
+        key, results = pending.popleft()
+        for result in results:
+            yield result
+        release(key)
+        submit()
+
+class SharedObjects(object):
+    """objects shared by key while they are referenced, e.g. arrays and
+    indices derived from the same geometry by several meshes"""
+
+    def __init__(self):
+        self.__objects = weakref.WeakValueDictionary()
+        self.__lock = threading.Lock()
+
+    def get(self, key, create):
+        """return the object of key, create() is called if there is none,
+        a None key is never shared"""
+        if key is None:
+            return create()
+        with self.__lock:
+            obj = self.__objects.get(key)
+        if obj is None:
+            obj = create()
+            with self.__lock:
+                obj = self.__objects.setdefault(key, obj)
+        return obj
 
 class Timer(object):
     def __init__(self):
@@ -75,5 +180,53 @@ class Timer(object):
         self.start = time.time()
         return "%30s % 8.4f sec"%(text, (self.start - s))
 
+# run as script for testing
+if __name__ == "__main__":
+    #@todo: unit test multiplier
+
+    # groups are prepared ahead of the pool and released once done
+    events = []
+    def prepare(key):
+        events.append(("prepare", key))
+    def release(key):
+        events.append(("release", key))
+    pool = multiprocessing.Pool(2)
+    results = list(imapByGroup(pool, abs, [(k, range(-10*k, 0)) for k in range(4)],
+        prepare, release, 3))
+    pool.close()
+    pool.join()
+    assert(sorted(results) == sorted(abs(v) for k in range(4) for v in range(-10*k, 0)))
+    assert(events == [("prepare", 0), ("prepare", 1), ("release", 0), ("prepare", 2),
+        ("release", 1), ("prepare", 3), ("release", 2), ("release", 3)])
+
+    # open chains and closed loops, in any segment order and direction
+    lines = stitch([5, 1, 0, 2, 7], [6, 2, 1, 0, 8])
+    assert(len(lines) == 3)
+    loops = [l for l in lines if l[0] == l[-1]]
+    assert(len(loops) == 1 and sorted(loops[0][:-1].tolist()) == [0, 1, 2])
+    assert(sorted(l.tolist() for l in lines if l[0] != l[-1]) == [[5, 6], [7, 8]])
+    lines = stitch([3, 1, 1], [2, 0, 2])
+    assert(len(lines) == 1 and lines[0].tolist() in ([0, 1, 2, 3], [3, 2, 1, 0]))
+    assert(stitch([], []) == [])
+
+    # directed chains follow segments, the ones meeting twice at a vertex
+    # are passed through in order
+    lines = stitch([1, 3, 2], [2, 1, 3], directed=True)
+    assert(len(lines) == 1 and lines[0].tolist() in ([1, 2, 3, 1], [2, 3, 1, 2], [3, 1, 2, 3]))
+    lines = stitch([0, 1, 2, 2, 3, 4], [1, 2, 0, 3, 4, 2], directed=True)
+    assert(len(lines) == 1 and len(lines[0]) == 7 and lines[0][0] == lines[0][-1])
+    lines = stitch([0, 2], [1, 1], directed=True)
+    assert(sorted(l.tolist() for l in lines) == [[0, 1], [2, 1]])
 
+    # long chains are walked without recursion
+    n = 200000
+    order = numpy.random.RandomState(0).permutation(n + 1)
+    lines = stitch(order[:-1], order[1:])
+    assert(len(lines) == 1 and lines[0].tolist() in (order.tolist(), order[::-1].tolist()))
+    lines = linemerge([[(float(i), 0.), (float(i + 1), 0.)] for i in range(n)])
+    assert(len(lines) == 1 and len(lines[0]) == n + 1)
 
+    # points are sewn by their coordinates
+    lines = linemerge([[(0, 0), (1, 0)], [(1, 1), (1, 0)], [(5, 5), (6, 6)], [(1, 1), (0, 0)]])
+    assert(sorted(len(l) for l in lines) == [2, 4])
+    assert([l for l in lines if len(l) == 4][0][0] == [l for l in lines if len(l) == 4][0][-1])